@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Benchmarks of broker hot paths, with SQLite and an in-process
+Redis stand-in (fakeredis if installed, otherwise a dict), no network.
+
+    python3 benchmarks/bench_broker.py                  # run all
+    python3 benchmarks/bench_broker.py -k load          # names with 'load'
+    python3 benchmarks/bench_broker.py --save base.json
+    python3 benchmarks/bench_broker.py --baseline base.json
+
+With --baseline, exits with 1 if any benchmark is slower than its
+baseline by more than --tolerance (relative, default 0.25).
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+from sqlalchemy import Column, Integer, String, DateTime, Date, Numeric
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from joker.broker.access import Conf, ResourceBroker
+from joker.broker.base import DeclBase, StandardToolkit
+from joker.broker.interfaces import static
+
+
+class BenchItem(DeclBase):
+    __tablename__ = 'bench_items'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50))
+    created = Column(DateTime)
+    day = Column(Date)
+    price = Column(Numeric(10, 2))
+
+
+class DictCache(dict):
+    """a dict-based stand-in of RedisInterface"""
+
+    def set(self, name, value, **_):
+        self[name] = value
+
+    def set_many(self, kvpairs, **kwargs):
+        for name, value in kvpairs:
+            self.set(name, value, **kwargs)
+
+    def get_many(self, names):
+        return [self.get(n) for n in names]
+
+    def delete(self, *names):
+        for name in names:
+            self.pop(name, None)
+
+
+def make_cache():
+    """
+    :return: a fakeredis client with get_many() and set_many()
+        like those of RedisInterface, or a DictCache
+    """
+    try:
+        import fakeredis
+    except ImportError:
+        return DictCache()
+
+    class FakeRedisInterface(fakeredis.FakeRedis):
+        def get_many(self, names):
+            pipe = self.pipeline(transaction=False)
+            for name in names:
+                pipe.get(name)
+            return pipe.execute()
+
+        def set_many(self, kvpairs, **kwargs):
+            pipe = self.pipeline(transaction=False)
+            for name, value in kvpairs:
+                pipe.set(name, value, **kwargs)
+            pipe.execute()
+
+    return FakeRedisInterface()
+
+
+def make_item(i):
+    return BenchItem(
+        id=i,
+        name='item-{}'.format(i),
+        created=datetime.datetime(2021, 3, 4, 5, 6, 7, 89),
+        day=datetime.date(2021, 3, 4),
+        price=Decimal('12.50'),
+    )
+
+
+def make_records(start, count):
+    return [{'id': i, 'name': 'item-{}'.format(i)}
+            for i in range(start, start + count)]
+
+
+class Context(object):
+    """Fixtures shared by benchmarks"""
+
+    def __init__(self, tmpdir, rows=10000):
+        self.tmpdir = tmpdir
+        self.rows = rows
+        self.conf_path = os.path.join(tmpdir, 'broker.json')
+        conf = {
+            'primary': {
+                'type': 'sql',
+                'url': 'sqlite:///' + os.path.join(tmpdir, 'primary.db'),
+            },
+            'standby_01': {
+                'type': 'sql',
+                'url': 'sqlite:///' + os.path.join(tmpdir, 'primary.db'),
+            },
+            'cache': {'type': 'nullredis'},
+            'general': {'extensions': []},
+            'secret': {
+                'type': 'secret',
+                'session': 'GoY/iz5hZXxWX0yNVjTrB0!F9AK4N~',
+            },
+        }
+        with open(self.conf_path, 'w') as fout:
+            json.dump(conf, fout)
+        # modified long ago, so that the stat of the file is trusted,
+        # see joker.broker.interfaces.static._stat_grace
+        os.utime(self.conf_path, (1e9, 1e9))
+        self.engine = create_engine('sqlite://')
+        BenchItem.metadata.create_all(self.engine)
+        self.session = Session(bind=self.engine)
+        self.session.add_all(make_item(i) for i in range(1, rows + 1))
+        self.session.commit()
+        self.cache = make_cache()
+        items = self.session.query(BenchItem)
+        self.cache.set_many([(o.cache_key, o.serialize()) for o in items])
+        self.session.expunge_all()
+        self.item = make_item(1)
+        self.counter = rows
+        # built once, so that only the operations are timed
+        self.rb = ResourceBroker(Conf.load(self.conf_path), lazy=True)
+        # the same table in the primary database for bulk_insert
+        BenchItem.metadata.create_all(self.rb.primary.engine)
+        self.toolkit = StandardToolkit(self.rb, self.session)
+        self.toolkit.cache = self.cache
+
+    def close(self):
+        self.session.close()
+        self.engine.dispose()
+        self.rb.primary.engine.dispose()
+
+
+def bench_conf_load(ctx):
+    # read, hashed and parsed again
+    static._parsed_entries.clear()
+    Conf.cached_instances.clear()
+    Conf.load(ctx.conf_path)
+
+
+def bench_conf_load_cached(ctx):
+    Conf.load(ctx.conf_path)
+
+
+def bench_broker_init(ctx):
+    ResourceBroker(Conf.load(ctx.conf_path))
+
+
+def bench_broker_init_lazy(ctx):
+    ResourceBroker(Conf.load(ctx.conf_path), lazy=True)
+
+
+def _make_serialize(fmt):
+    def _bench(ctx):
+        ctx.item.serialize(fmt)
+    return _bench
+
+
+def _make_unserialize(fmt):
+    data = make_item(1).serialize(fmt)
+
+    def _bench(_):
+        BenchItem.unserialize(data)
+    return _bench
+
+
+def _make_load(hit_ratio):
+    def _bench(ctx):
+        ident = ctx.counter % ctx.rows + 1
+        ctx.counter += 1
+        if ident % 100 >= hit_ratio * 100:
+            ctx.cache.delete(BenchItem.format_cache_key(ident))
+        BenchItem.load(ident, ctx.session, ctx.cache)
+        ctx.session.expunge_all()
+    return _bench
+
+
+def _make_load_many(hit_ratio, count=100):
+    def _bench(ctx):
+        start = ctx.counter % (ctx.rows - count) + 1
+        ctx.counter += count
+        idents = list(range(start, start + count))
+        misses = [i for i in idents if i % 100 >= hit_ratio * 100]
+        if misses:
+            ctx.cache.delete(*[BenchItem.format_cache_key(i) for i in misses])
+        BenchItem.load_many(idents, ctx.session, ctx.cache)
+        ctx.session.expunge_all()
+    return _bench
+
+
+def _make_find(start, limit=100):
+    def _bench(ctx):
+        BenchItem.find({}, ctx.session, start=start, limit=limit)
+        ctx.session.expunge_all()
+    return _bench
+
+
+def bench_bulk_insert(ctx):
+    ctx.counter += 1000
+    ctx.toolkit.bulk_insert(BenchItem, make_records(ctx.counter, 1000))
+
+
+def bench_persist(ctx):
+    ctx.counter += 10
+    ctx.toolkit.persist(*[make_item(ctx.counter + i) for i in range(10)])
+    ctx.session.expunge_all()
+
+
+benchmarks = {
+    'conf_load': bench_conf_load,
+    'conf_load_cached': bench_conf_load_cached,
+    'broker_init': bench_broker_init,
+    'broker_init_lazy': bench_broker_init_lazy,
+    'serialize_json': _make_serialize('json'),
+    'serialize_orjson': _make_serialize('orjson'),
+    'unserialize_json': _make_unserialize('json'),
+    'unserialize_orjson': _make_unserialize('orjson'),
+    'load_hit_100': _make_load(1.),
+    'load_hit_90': _make_load(.9),
+    'load_hit_0': _make_load(0.),
+    'load_many_100x_hit_100': _make_load_many(1.),
+    'load_many_100x_hit_50': _make_load_many(.5),
+    'load_many_100x_hit_0': _make_load_many(0.),
+    'find_offset_0': _make_find(0),
+    'find_offset_1000': _make_find(1000),
+    'find_offset_9000': _make_find(9000),
+    'bulk_insert_1000': bench_bulk_insert,
+    'persist_10': bench_persist,
+}
+
+
+def measure(func, ctx, repeat=5, min_time=.2):
+    """
+    :return: (dict) seconds per call, median and min of `repeat` rounds
+    """
+    # warm up, and find the number of calls per round
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            func(ctx)
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_time / repeat or number >= 100000:
+            break
+        number *= 2
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            func(ctx)
+        timings.append((time.perf_counter() - t0) / number)
+    return {
+        'median': statistics.median(timings),
+        'min': min(timings),
+        'number': number,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: (list) names of benchmarks slower than baseline
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        ratio = result['median'] / base['median']
+        result['ratio'] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def report(results, regressions):
+    for name, result in results.items():
+        line = '{:<28} {:>12.2f} us'.format(name, result['median'] * 1e6)
+        if 'ratio' in result:
+            line += '  x{:.2f}'.format(result['ratio'])
+        if name in regressions:
+            line += '  REGRESSION'
+        print(line)
+
+
+def main(argv=None):
+    desc = 'benchmarks of joker.broker'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('-k', '--keyword', help='run names containing it')
+    parser.add_argument('--save', help='save results as a baseline')
+    parser.add_argument('--baseline', help='compare with a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=.25)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=.2,
+                        help='seconds per benchmark, roughly')
+    args = parser.parse_args(argv)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ctx = Context(tmpdir)
+        for name, func in benchmarks.items():
+            if args.keyword and args.keyword not in name:
+                continue
+            results[name] = measure(func, ctx, args.repeat, args.min_time)
+        ctx.close()
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+        regressions = compare(results, baseline, args.tolerance)
+    report(results, regressions)
+
+    if args.save:
+        data = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results,
+        }
+        with open(args.save, 'w') as fout:
+            json.dump(data, fout, indent=2, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-__version__ = '0.5.0'
+__version__ = '0.6.0'
 
-from joker.broker.access import ResourceBroker
+from joker.broker.access import ResourceBroker, AsyncResourceBroker
 
 
 def get_resource_broker(path=None):
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import fnmatch
+import logging
 import os
-import random
+import pickle
+import threading
 import weakref
 from collections import defaultdict
 
+_logger = logging.getLogger(__name__)
+
 
 def _factory():
     return defaultdict(_factory)
@@ -27,6 +32,9 @@ def compute_hash(path, algor='md5', chunksize=1024):
 
 class Conf(defaultdict):
     cached_instances = weakref.WeakValueDictionary()
+    # cache parsed conf files on disk, in a private directory;
+    # see joker.broker.interfaces.static.load_conf_file()
+    use_parsed_cache = False
 
     def __init__(self, *args, **kwargs):
         super(Conf, self).__init__(_factory, *args, **kwargs)
@@ -38,13 +46,14 @@ class Conf(defaultdict):
         if path in cls.cached_instances:
             return cls.cached_instances[path]
 
-        sha1 = compute_hash(path, 'sha1')
+        # hashed only if modified, by stat
+        from joker.broker.interfaces.static import _load_parsed_entry
+        _, sha1, blob = _load_parsed_entry(path, cls.use_parsed_cache)
         if sha1 in cls.cached_instances:
             return cls.cached_instances[sha1]
 
-        # parse from conf file
-        from joker.broker.interfaces.static import deserialize_conf
-        conf = cls(deserialize_conf(path))
+        # unpickle the parsed conf data
+        conf = cls(pickle.loads(blob))
 
         # Note: not cls.loaded_confs.
         # All sub-classes use the same dict
@@ -100,38 +109,177 @@ _interface_types = {
 }
 
 
-class ResourceBroker(object):
-    cached_instances = weakref.WeakValueDictionary()
+def _setup_async_sql_interface(conf_section):
+    from joker.broker.interfaces.aio import AsyncSQLInterface
+    if conf_section is None:
+        # fallback to in-memory SQLite;
+        return AsyncSQLInterface.from_default()
+    return AsyncSQLInterface.from_conf(conf_section)
+
+
+def _setup_async_redis_interface(conf_section):
+    from joker.broker.interfaces import aio
+    if conf_section is None:
+        return aio.AsyncNullRedisInterface()
+    return aio.AsyncRedisInterface.from_conf(conf_section)
+
+
+def _setup_async_nullredis_interface(_):
+    from joker.broker.interfaces.aio import AsyncNullRedisInterface
+    return AsyncNullRedisInterface()
+
 
-    def __init__(self, conf):
+_async_interface_types = {
+    'nullredis': _setup_async_nullredis_interface,
+    'redis': _setup_async_redis_interface,
+    'secret': _setup_secret_interface,
+    'sql': _setup_async_sql_interface,
+}
+
+
+def _register_at_fork():
+    # os.register_at_fork is available since Python 3.7, POSIX only
+    global _at_fork_registered
+    if _at_fork_registered or not hasattr(os, 'register_at_fork'):
+        return
+    os.register_at_fork(after_in_child=ResourceBroker.just_after_fork)
+    _at_fork_registered = True
+
+
+_at_fork_registered = False
+
+
+class ResourceBroker(object):
+    # (cls, id(conf), lazy) => instance; conf is kept alive by the instance
+    cached_instances = {}
+    _registry_lock = threading.Lock()
+    interface_types = _interface_types
+    # seconds to wait before closing connections of replaced interfaces
+    drain_delay = 30.
+    # seconds to read from primary after a commit with writes,
+    # see joker.broker.sessions
+    sticky_window = 2.
+    # max number of threads of rb.fan_out()
+    fan_out_workers = 16
+
+    def __init__(self, conf, lazy=False):
         """
         :param conf: (joker.broker.Conf)
+        :param lazy: (bool) set up each interface on its first access
         """
         # interfaces are slow to import, so import when needed
         self.conf = conf
+        # the registry key of self; kept alive after reloads
+        self._initial_conf = conf
+        self.conf_path = None
         self.interfaces = {}
         self.session_klass = None
-        self.standby_interfaces = []
+        self.session_tracker = None
+        self._scoped_session = None
+        self.standby_names = []
+        self._router = None
+        self._metrics_registry = None
+        self._setups = {}
+        # name => {path: stat key}, extension files of set-up interfaces
+        self._section_stats = {}
+        self._watcher = None
+        self._executor = None
+        self._lock = threading.RLock()
         # why I did this?
         # section_names = list(conf.keys())
         # section_names.sort()
 
+        self.lazy = lazy
+        self._setups, self.standby_names = self._parse_conf(conf)
+        if not lazy:
+            for name in self._setups:
+                self._setup_interface(name)
+
+    def _parse_conf(self, conf):
+        setups = {}
+        standby_names = []
         for name, section in conf.items():
             typ = section.get('type')
             _setup = _setup_general_interface
-            _setup = _interface_types.get(typ, _setup)
-            interf = _setup(section)
-            self.interfaces[name] = interf
+            setups[name] = self.interface_types.get(typ, _setup)
             if name.lower().startswith('standby'):
-                self.standby_interfaces.append(interf)
+                standby_names.append(name)
+        return setups, standby_names
+
+    def _setup_interface(self, name):
+        try:
+            return self.interfaces[name]
+        except KeyError:
+            pass
+        with self._lock:
+            # double-checked: another thread may have done it meanwhile
+            if name in self.interfaces:
+                return self.interfaces[name]
+            interf = self._build_interface(name, self.conf)
+            self.interfaces[name] = interf
+            return interf
+
+    def _build_interface(self, name, conf):
+        from joker.broker import reloading
+        section = conf[name]
+        paths = reloading.get_section_files(section)
+        stats = reloading.stat_files(paths)
+        # pass a copy: some interfaces pop items from the section
+        interf = self._setups[name](dict(section))
+        self._instrument(name, interf)
+        self._section_stats[name] = stats
+        return interf
+
+    def _instrument(self, name, interf):
+        if self._metrics_registry is None:
+            return
+        from joker.broker.metrics import instrument_interface
+        instrument_interface(interf, name, self._metrics_registry)
+
+    def _uninstrument(self, interf):
+        if self._metrics_registry is None:
+            return
+        from joker.broker.metrics import uninstrument_interface
+        uninstrument_interface(interf, self._metrics_registry)
+
+    def instrument(self, registry=None):
+        """
+        Collect latency of SQL queries, Redis commands and pool checkouts
+        of all interfaces, including those set up later
+
+        :param registry: (joker.broker.metrics.MetricsRegistry)
+            default to joker.broker.metrics.default_registry
+        """
+        from joker.broker import metrics
+        if registry is None:
+            registry = metrics.default_registry
+        with self._lock:
+            if self._metrics_registry is not None:
+                return
+            self._metrics_registry = registry
+            for name, interf in self.interfaces.items():
+                self._instrument(name, interf)
+
+    @property
+    def standby_interfaces(self):
+        return [self._setup_interface(n) for n in self.standby_names]
 
     @classmethod
-    def create(cls, path):
+    def create(cls, path, lazy=False):
         conf = Conf.load(path)
-        if id(conf) in cls.cached_instances:
-            return cls.cached_instances[id(conf)]
-        else:
-            return cls(conf)
+        key = cls, id(conf), bool(lazy)
+        with cls._registry_lock:
+            try:
+                return cls.cached_instances[key]
+            except KeyError:
+                pass
+            rb = cls(conf, lazy=lazy)
+            rb.conf_path = os.path.abspath(path)
+            # Note: not cls.cached_instances.
+            # All sub-classes use the same dict
+            ResourceBroker.cached_instances[key] = rb
+            _register_at_fork()
+            return rb
 
     @classmethod
     def just_after_fork(cls):
@@ -139,40 +287,257 @@ class ResourceBroker(object):
         http://docs.sqlalchemy.org/en/latest/core/pooling.html\
         #using-connection-pools-with-multiprocessing
         """
-        from joker.broker.interfaces.sequel import SQLInterface
-        for rb in cls.cached_instances.values():
-            for res in rb.resources.values():
-                if isinstance(res, SQLInterface):
-                    res.just_after_fork()
+        for rb in list(ResourceBroker.cached_instances.values()):
+            # sessions of the parent process must not be reused here
+            rb._scoped_session = None
+            # threads of the parent process are not in the child
+            rb._executor = None
+            for interf in list(rb.interfaces.values()):
+                # interfaces not set up yet need nothing
+                func = getattr(interf, 'just_after_fork', None)
+                if callable(func):
+                    func()
 
     def __getitem__(self, interface_name):
-        try:
-            return self.interfaces[interface_name]
-        except LookupError:
-            msg = 'section "{}" not in your config file or mis-configured'
-            msg = msg.format(interface_name)
-            raise ResourceNotFoundError(msg)
+        if interface_name in self._setups:
+            return self._setup_interface(interface_name)
+        msg = 'section "{}" not in your config file or mis-configured'
+        msg = msg.format(interface_name)
+        raise ResourceNotFoundError(msg)
 
     def _get_interface(self, name, typ):
-        try:
-            return self.interfaces[name]
-        except KeyError:
-            interface = _interface_types.get(typ, _setup_general_interface)(None)
-            self.interfaces[name] = interface
-            return interface
+        if name in self._setups:
+            return self._setup_interface(name)
+        with self._lock:
+            try:
+                return self.interfaces[name]
+            except KeyError:
+                _setup = self.interface_types.get(
+                    typ, _setup_general_interface)
+                interface = _setup(None)
+                self._instrument(name, interface)
+                self.interfaces[name] = interface
+                return interface
+
+    def _find_changed_sections(self, conf):
+        from joker.broker import reloading
+        changed = set()
+        for name, interf in self.interfaces.items():
+            if name not in self._setups:
+                # fallback interfaces, e.g. NullRedisInterface for cache
+                if name in conf:
+                    changed.add(name)
+                continue
+            if name not in conf or conf[name] != self.conf[name]:
+                changed.add(name)
+                continue
+            old_stats = self._section_stats.get(name, {})
+            if reloading.stat_files(old_stats) != old_stats:
+                changed.add(name)
+        return changed
+
+    def reload(self, path=None):
+        """
+        Reload the conf file and rebuild interfaces of changed sections
+        (including those with extension files modified). Replaced
+        interfaces are swapped out at once, and their connections
+        closed after self.drain_delay seconds.
+
+        :param path: (str) default to the path given to create()
+        :return: (set) names of rebuilt, removed or added sections
+        """
+        from joker.broker import reloading
+        from joker.broker.interfaces.static import load_conf_file
+        path = path or self.conf_path
+        if path is None:
+            raise ValueError('path of the conf file is unknown')
+        conf = Conf(load_conf_file(path, Conf.use_parsed_cache))
+        with self._lock:
+            changed = self._find_changed_sections(conf)
+            setups, standby_names = self._parse_conf(conf)
+            old_setups = self._setups
+            self._setups = setups
+            try:
+                # build all before swapping any
+                rebuilt = {
+                    name: self._build_interface(name, conf)
+                    for name in changed if name in setups
+                }
+            except Exception:
+                self._setups = old_setups
+                raise
+            replaced = []
+            for name in changed:
+                old = self.interfaces.pop(name, None)
+                if name in rebuilt:
+                    self.interfaces[name] = rebuilt[name]
+                else:
+                    self._section_stats.pop(name, None)
+                if old is not None:
+                    self._uninstrument(old)
+                    replaced.append(old)
+            self.conf = conf
+            self.conf_path = os.path.abspath(path)
+            old_standby_names = self.standby_names
+            # before _reset_routing(), which may rebuild the router
+            self.standby_names = standby_names
+            sql_names = set(standby_names) | {'primary'}
+            if set(standby_names) != set(old_standby_names) \
+                    or changed & sql_names:
+                self._reset_routing()
+            added = set(setups) - set(old_setups)
+            changed.update(added)
+            if not self.lazy:
+                for name in added:
+                    self._setup_interface(name)
+        for old in replaced:
+            reloading.drain_later(old, self.drain_delay)
+        if changed:
+            _logger.info('reloaded sections: %s', sorted(changed))
+        return changed
+
+    def _reset_routing(self):
+        self.session_klass = None
+        router = self._router
+        self._router = None
+        if router is None:
+            return
+        router.close()
+        if router.probing_interval is not None:
+            self.router.start_probing(router.probing_interval)
+
+    def watch(self, interval=5.):
+        """
+        Call self.reload() whenever the conf file or any extension
+        file is modified, polled every `interval` seconds in a thread
+
+        :rtype: joker.broker.reloading.ConfWatcher
+        """
+        from joker.broker.reloading import ConfWatcher
+        with self._lock:
+            if self._watcher is None:
+                self._watcher = ConfWatcher(self, interval)
+                self._watcher.start()
+            return self._watcher
+
+    @property
+    def router(self):
+        """:rtype: joker.broker.routing.StandbyRouter"""
+        if self._router is None:
+            from joker.broker.routing import StandbyRouter
+            with self._lock:
+                if self._router is None:
+                    self._router = StandbyRouter.from_broker(self)
+        return self._router
 
     def get_session(self):
         """
-        Get a RoutingSession instance, which is modified from
-        http://docs.sqlalchemy.org/en/latest/orm/persistence_techniques.html
-        #custom-vertical-partitioning
+        Get a RoutingSession instance, which reads from standbys,
+        and from primary after writes; see joker.broker.sessions
+        :rtype: joker.broker.sessions.RoutingSession
         """
         if self.session_klass is None:
-            from joker.relational.tools.sessions import get_session_klass
-            self.session_klass = \
-                get_session_klass(self.primary, self.standby_interfaces)
+            from joker.broker.sessions import make_session_klass
+            self.session_klass = make_session_klass(
+                self, self.sticky_window, self.session_tracker)
         return self.session_klass()
 
+    @property
+    def scoped_session(self):
+        """
+        A registry of sessions of self.get_session(),
+        one per thread or asyncio task
+        :rtype: joker.broker.sessions.TaskScopedSession
+        """
+        if self._scoped_session is None:
+            from joker.broker.sessions import TaskScopedSession
+            with self._lock:
+                if self._scoped_session is None:
+                    self._scoped_session = \
+                        TaskScopedSession(self.get_session)
+        return self._scoped_session
+
+    def session_scope(self):
+        """
+        with rb.session_scope() as session:
+            # the session of this thread or task, closed at the end of
+            # the outermost scope; commit explicitly
+        """
+        from joker.broker.sessions import session_scope
+        return session_scope(self.scoped_session)
+
+    def track_sessions(self, threshold=30., interval=10., capture_stack=False):
+        """
+        Log sessions holding a connection for more than `threshold`
+        seconds, checked every `interval` seconds (None to check only
+        on calls of tracker.check()); sessions created before are not tracked
+
+        :rtype: joker.broker.sessions.SessionTracker
+        """
+        from joker.broker.sessions import SessionTracker
+        with self._lock:
+            if self.session_tracker is None:
+                self.session_tracker = \
+                    SessionTracker(threshold, capture_stack)
+                self.session_klass = None
+            if interval is not None:
+                self.session_tracker.start(interval)
+            return self.session_tracker
+
+    def _select_interfaces(self, names):
+        if names is None:
+            names = list(self._setups)
+        elif isinstance(names, str):
+            names = fnmatch.filter(self._setups, names)
+        interfaces = {}
+        for name in names:
+            try:
+                interfaces[name] = self[name]
+            except Exception as e:
+                # e.g. ResourceNotFoundError, or failed to set up
+                interfaces[name] = e
+        return interfaces
+
+    def fan_out(self, func, names=None, mode='all', timeout=None):
+        """
+        Call func(interface) for interfaces concurrently, on a thread pool
+        of at most self.fan_out_workers threads; see joker.broker.fanout
+
+            rb.fan_out(lambda interf: interf.ping(), 'standby*')
+
+        :param func: called with each interface
+        :param names: a list of section names, a glob pattern like
+            'standby*', or None for all sections
+        :param mode: 'all', 'partial' or 'first'
+        :param timeout: (float) seconds for all calls, since submitted
+        :return: {name: result}, a FanOutResult or (name, result), by mode
+        """
+        from joker.broker import fanout
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = fanout.make_executor(self.fan_out_workers)
+        interfaces = self._select_interfaces(names)
+        return fanout.fan_out(self._executor, func, interfaces, mode, timeout)
+
+    @staticmethod
+    def read_from_primary():
+        """
+        with rb.read_from_primary():
+            # all reads go to primary, including rb.standby
+        """
+        from joker.broker.sessions import read_from_primary
+        return read_from_primary()
+
+    @staticmethod
+    def read_only():
+        """
+        with rb.read_only():
+            # all reads go to standbys; flushes are forbidden
+        """
+        from joker.broker.sessions import read_only
+        return read_only()
+
     # some preset interfaces:
     # general, secret, primary, standby, lite, cache, kvstore
     @property
@@ -196,11 +561,16 @@ class ResourceBroker(object):
     @property
     def standby(self):
         """
-        Intend to be a standby (slave) RDB instance
+        Intend to be a standby (slave) RDB instance,
+        chosen by self.router among healthy ones; fallback to primary,
+        or primary in a `with rb.read_from_primary():` block
         :rtype: joker.broker.interfaces.sequel.SQLInterface
         """
-        if self.standby_interfaces:
-            return random.choice(self.standby_interfaces)
+        from joker.broker.sessions import get_routing_mode
+        if self.standby_names and get_routing_mode() != 'primary':
+            interf = self.router.choose()
+            if interf is not None:
+                return interf
         return self.primary
 
     @property
@@ -218,3 +588,64 @@ class ResourceBroker(object):
         :rtype: joker.broker.interfaces.redis.RedisInterface
         """
         return self._get_interface('store', 'redis')
+
+
+class AsyncResourceBroker(ResourceBroker):
+    """
+    A ResourceBroker for asyncio, reading the same conf files:
+    sql sections give AsyncSQLInterface, redis sections AsyncRedisInterface.
+    Note that rb.router.check() works with sync interfaces only.
+    """
+    interface_types = _async_interface_types
+
+    def get_session(self):
+        """
+        :rtype: sqlalchemy.ext.asyncio.AsyncSession
+        """
+        # no routing session for asyncio; use rb.standby.get_session()
+        # explicitly for reads from standbys
+        tracker = self.session_tracker
+        if tracker is None:
+            return self.primary.get_session()
+        from joker.broker.sessions import TrackedSession
+        klass = type('TrackedSession', (TrackedSession,), {'tracker': tracker})
+        return self.primary.session_klass(sync_session_class=klass)
+
+    @property
+    def scoped_session(self):
+        """
+        A registry of sessions of self.get_session(),
+        one per thread or asyncio task
+        :rtype: joker.broker.sessions.TaskLocalRegistry
+        """
+        if self._scoped_session is None:
+            from joker.broker.sessions import TaskLocalRegistry
+            with self._lock:
+                if self._scoped_session is None:
+                    self._scoped_session = \
+                        TaskLocalRegistry(self.get_session)
+        return self._scoped_session
+
+    def session_scope(self):
+        """
+        async with rb.session_scope() as session:
+            # the AsyncSession of this task, closed at the end of
+            # the outermost scope; commit explicitly
+        """
+        from joker.broker.sessions import async_session_scope
+        return async_session_scope(self.scoped_session)
+
+    @property
+    def primary(self):
+        """:rtype: joker.broker.interfaces.aio.AsyncSQLInterface"""
+        return self._get_interface('primary', 'sql')
+
+    @property
+    def cache(self):
+        """:rtype: joker.broker.interfaces.aio.AsyncRedisInterface"""
+        return self._get_interface('cache', 'redis')
+
+    @property
+    def store(self):
+        """:rtype: joker.broker.interfaces.aio.AsyncRedisInterface"""
+        return self._get_interface('store', 'redis')
@@ -1,16 +1,26 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import contextlib
 import datetime
+import functools
+import hashlib
+import itertools
 import json
+import time
 from abc import ABC
 from decimal import Decimal
 
 import sqlalchemy.exc
 from joker.cast import represent
-from sqlalchemy import Table, select, tuple_, and_
+from sqlalchemy import Table, select, tuple_, and_, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.inspection import inspect
+from sqlalchemy.orm.instrumentation import manager_of_class
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import UnaryExpression
+
+from joker.broker import codecs, columnar, metrics, stampede
 
 
 def flatten(tup):
@@ -33,6 +43,14 @@ def commit_or_rollback(session):
         raise
 
 
+async def async_commit_or_rollback(session):
+    try:
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+
+
 class Toolkit(object):
     @staticmethod
     def _get_resource_broker():
@@ -47,11 +65,33 @@ class Toolkit(object):
             rb = self._get_resource_broker()
         self.rb = rb
 
+    def session_scope(self):
+        """
+        with tk.session_scope() as session:
+            # the session of this thread or task, shared by nested
+            # scopes and closed at the end of the outermost one
+        """
+        return self.rb.session_scope()
+
 
 class StandardToolkit(Toolkit, ABC):
     """
     Base class for Viewmodels
         just remove the need to pass session obj for every func
+
+    A private session is closed at the end of a `with` block:
+
+        with StandardToolkit(rb) as tk:
+            tk.persist(obj)
+
+    or use the scoped session of the current thread or task:
+
+        with StandardToolkit.scoped(rb) as tk:
+            ...
+
+        @StandardToolkit.inject
+        def func(tk, *args):
+            ...
     """
 
     def __init__(self, rb=None, session=None):
@@ -71,6 +111,7 @@ class StandardToolkit(Toolkit, ABC):
             self._using_private_session = False
 
     def __del__(self):
+        # a fallback of close(), at the mercy of garbage collection
         if not self._using_private_session:
             return
         try:
@@ -78,103 +119,569 @@ class StandardToolkit(Toolkit, ABC):
         except Exception:
             pass
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        if self._using_private_session:
+            self.session.close()
+
+    @classmethod
+    @contextlib.contextmanager
+    def scoped(cls, rb=None):
+        """
+        Make a toolkit with the scoped session of the current thread
+        or task, see ResourceBroker.session_scope();
+        usable as a decorator as well
+        """
+        if not rb:
+            rb = cls._get_resource_broker()
+        with rb.session_scope() as session:
+            yield cls(rb, session)
+
+    @classmethod
+    def inject(cls, func):
+        """
+        A decorator passing a scoped toolkit as the first argument;
+        the resource broker is from cls._get_resource_broker()
+        """
+        @functools.wraps(func)
+        def _wrapped(*args, **kwargs):
+            with cls.scoped() as tk:
+                return func(tk, *args, **kwargs)
+        return _wrapped
+
     def commit_or_rollback(self):
         commit_or_rollback(self.session)
 
     def persist(self, *items):
         """
+        Add items to the session and commit; then write them to cache,
+        only if committed successfully
+
         :param items: a series of DeclBase derived instance
         """
-        for o in items:
-            self.session.add(o)
-        self.commit_or_rollback()
-        if self.cache is not None:
-            kvpairs = [(x.cache_key, x.serialize()) for x in items]
-            self.cache.set_many(kvpairs)
+        self.session.add_all(items)
+        writes = _flush_and_commit(self.session, items, self.cache)
+        if writes:
+            _apply_cache_writes(self.cache, *writes)
+
+    def bulk_insert(self, target, records, **kwargs):
+        """
+        Load records into the primary database in chunks,
+        see joker.broker.bulk.bulk_load() for kwargs
 
-    def bulk_insert(self, target, records):
-        if not isinstance(target, Table):
-            target = target.__table__
-        return self.rb.primary.engine.execute(target.insert(), records)
+        :param target: (sqlalchemy.Table or a DeclBase derived class)
+        :param records: an iterable of dicts, e.g. a generator
+        :rtype: joker.broker.bulk.BulkLoadReport
+        """
+        from joker.broker.bulk import bulk_load
+        engine = self.rb.primary.engine
+        report = bulk_load(engine, target, records, **kwargs)
+        if self.cache is not None and _has_query_cache(target):
+            table = getattr(target, '__table__', target)
+            _bump_table_versions(self.cache, [table.name])
+        return report
 
 
 Toolbox = StandardToolkit
 
 
+class AsyncStandardToolkit(Toolkit):
+    """
+    StandardToolkit for asyncio, with joker.broker.AsyncResourceBroker
+
+        async with AsyncStandardToolkit(rb) as tk:
+            await tk.persist(obj)
+    """
+
+    def __init__(self, rb=None, session=None):
+        """
+        :type rb: joker.broker.access.AsyncResourceBroker
+        :param rb:
+        :type session: sqlalchemy.ext.asyncio.AsyncSession
+        :param session:
+        """
+        Toolkit.__init__(self, rb)
+        self.cache = self.rb.cache
+        if session is None:
+            self.session = self.rb.get_session()
+            self._using_private_session = True
+        else:
+            self.session = session
+            self._using_private_session = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def close(self):
+        if self._using_private_session:
+            await self.session.close()
+
+    async def commit_or_rollback(self):
+        await async_commit_or_rollback(self.session)
+
+    async def persist(self, *items):
+        """
+        :param items: a series of DeclBase derived instance
+        """
+        self.session.add_all(items)
+        session = self.session
+        try:
+            await session.flush()
+            writes = None
+            if self.cache is not None:
+                writes = _make_cache_writes(items, self.cache)
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+        if writes:
+            ttl_groups, deletions, tables = writes
+            for ttl, kvpairs in ttl_groups.items():
+                await self.cache.set_many(kvpairs, **_expiry_kwargs(ttl))
+            if deletions:
+                await self.cache.delete(*deletions)
+            for name in tables:
+                await self.cache.incr(_format_table_version_key(name))
+
+
+_metrics = metrics.default_registry
+_flights = stampede.SingleFlight()
+_async_flights = stampede.AsyncSingleFlight()
+
+
+def _expiry_kwargs(ttl):
+    if ttl:
+        return {'ex': ttl}
+    return {}
+
+
+def _make_cache_writes(items, cache=None):
+    """
+    :param items: a series of DeclBase derived instance
+    :param cache: (joker.broker.interfaces.redis.RedisInterface)
+    :return: (ttl_groups, deletions, tables), where ttl_groups is a dict
+        {ttl: [(cache_key, value), ...]}, deletions a list of cache keys
+        and tables a list of table names whose query cache to invalidate
+    """
+    ttl_groups = {}
+    deletions = []
+    tables = set()
+    for o in items:
+        if o.query_cache_ttl is not None:
+            tables.add(o.get_model_info().table.name)
+        if o.cache_write_mode == 'delete':
+            deletions.append(o.cache_key)
+            continue
+        kvpairs = ttl_groups.setdefault(o.cache_ttl, [])
+        kvpairs.append((o.cache_key, o.serialize_for_cache(cache)))
+    return ttl_groups, deletions, sorted(tables)
+
+
+def _apply_cache_writes(cache, ttl_groups, deletions, tables=()):
+    # one pipeline for each distinct TTL, usually just one
+    for ttl, kvpairs in ttl_groups.items():
+        cache.set_many(kvpairs, **_expiry_kwargs(ttl))
+    if deletions:
+        cache.delete(*deletions)
+    _bump_table_versions(cache, tables)
+
+
+def _format_table_version_key(table_name):
+    return 'joker.broker.table_version:' + table_name
+
+
+def _get_query_cache_backend(cache):
+    from joker.broker.interfaces.redis import NearCache
+    if isinstance(cache, NearCache):
+        # versions must not be remembered in process memory
+        return cache.backend
+    return cache
+
+
+def _bump_table_versions(cache, table_names):
+    """Invalidate cached results of find() on these tables"""
+    if not table_names:
+        return
+    cache = _get_query_cache_backend(cache)
+    for name in table_names:
+        cache.incr(_format_table_version_key(name))
+
+
+def _has_query_cache(target):
+    """
+    :param target: (sqlalchemy.Table or a DeclBase derived class)
+    :return: (bool) True if results of find() on the table may be cached
+    """
+    if not isinstance(target, Table):
+        return target.query_cache_ttl is not None
+    return any(
+        m.class_.query_cache_ttl is not None
+        for m in DeclBase.registry.mappers if m.local_table is target
+    )
+
+
+def _flush_and_commit(session, items, cache=None):
+    """
+    Serialize items after flush but before commit,
+    since committed objects are expired and would be reloaded one by one
+
+    :return: (ttl_groups, deletions, tables) of _make_cache_writes(),
+        or None if no cache writes needed
+    """
+    try:
+        session.flush()
+        writes = None
+        # writes are done by the session events if enabled
+        if cache is not None and not session.info.get(_cache_sync_key):
+            writes = _make_cache_writes(items, cache)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return writes
+
+
+_cache_sync_key = 'joker.broker.cache_sync'
+_cache_flushed_key = 'joker.broker.cache_flushed'
+_cache_pending_key = 'joker.broker.cache_pending'
+_cache_tables_key = 'joker.broker.cache_tables'
+
+
+def enable_cache_sync(target, cache):
+    """
+    Keep cache coherent with all changes committed through target,
+    including those made outside StandardToolkit.persist and DeclBase.save.
+    DeclBase derived objects flushed are serialized (or deleted from cache,
+    see DeclBase.cache_write_mode) and written to cache after commit;
+    pending writes are discarded on rollback.
+
+    :param target: a Session, sessionmaker, scoped_session or Session class
+    :param cache: (joker.broker.interfaces.redis.RedisInterface)
+    """
+    def _after_flush(session, _):
+        session.info[_cache_sync_key] = True
+        flushed = session.info.setdefault(_cache_flushed_key, [])
+        for o in itertools.chain(session.new, session.dirty):
+            if isinstance(o, DeclBase):
+                flushed.append((o, False))
+        for o in session.deleted:
+            if isinstance(o, DeclBase):
+                flushed.append((o, True))
+
+    def _after_flush_postexec(session, _):
+        flushed = session.info.pop(_cache_flushed_key, [])
+        # cache key => (ttl, value), value is None for deletion
+        pending = session.info.setdefault(_cache_pending_key, {})
+        tables = session.info.setdefault(_cache_tables_key, set())
+        for o, deleted in flushed:
+            if o.query_cache_ttl is not None:
+                tables.add(o.get_model_info().table.name)
+            if deleted or o.cache_write_mode == 'delete':
+                pending[o.cache_key] = None, None
+            else:
+                pending[o.cache_key] = \
+                    o.cache_ttl, o.serialize_for_cache(cache)
+
+    def _after_commit(session):
+        pending = session.info.pop(_cache_pending_key, None)
+        tables = session.info.pop(_cache_tables_key, None)
+        if not pending:
+            return
+        ttl_groups = {}
+        deletions = []
+        for key, (ttl, value) in pending.items():
+            if value is None:
+                deletions.append(key)
+            else:
+                ttl_groups.setdefault(ttl, []).append((key, value))
+        _apply_cache_writes(
+            cache, ttl_groups, deletions, sorted(tables or ()))
+
+    def _after_rollback(session):
+        session.info.pop(_cache_flushed_key, None)
+        session.info.pop(_cache_pending_key, None)
+        session.info.pop(_cache_tables_key, None)
+
+    event.listen(target, 'after_flush', _after_flush)
+    event.listen(target, 'after_flush_postexec', _after_flush_postexec)
+    event.listen(target, 'after_commit', _after_commit)
+    event.listen(target, 'after_rollback', _after_rollback)
+
+
+class ModelInfo(object):
+    """
+    Table introspection results of a model class, computed only once
+    """
+
+    def __init__(self, klass):
+        table = klass.get_table()
+        self.klass = klass
+        self.table = table
+        self.columns = tuple(table.columns)
+        self.column_names = tuple(c.name for c in self.columns)
+        self.column_name_set = frozenset(self.column_names)
+        self.pk_columns = tuple(table.primary_key)
+        self.pk_names = tuple(c.name for c in self.pk_columns)
+        self.cache_key_prefix = '{}:{}:'.format(klass.__name__, table.name)
+        self.encoders, self.decoders = \
+            codecs.get_column_converters(table)
+        # [(name, encoder or None), ...] in column order
+        self.encoding_plan = tuple(
+            (n, self.encoders.get(n)) for n in self.column_names
+        )
+        self.decoding_plan = tuple(self.decoders.items())
+        # converters of row values, for rows of select(*columns)
+        names = self.column_names
+        self.row_encoders = tuple(self.encoders.get(n) for n in names)
+        self.row_decoders = tuple(self.decoders.get(n) for n in names)
+        self.pk_encoders = tuple(self.encoders.get(n) for n in self.pk_names)
+        self.pk_decoders = tuple(self.decoders.get(n) for n in self.pk_names)
+        self.manager = manager_of_class(klass)
+
+    def get_pk_values(self, obj):
+        return tuple(getattr(obj, n) for n in self.pk_names)
+
+    def make_instance(self, params):
+        """
+        Create a transient object with klass(**params), or bypassing
+        __init__ and its checks if klass.skip_init is True.
+        Keys of params are assumed to be column names.
+        """
+        if not self.klass.skip_init:
+            return self.klass(**dict(params))
+        obj = self.manager.new_instance()
+        obj.__dict__.update(params)
+        return obj
+
+
 class DeclBase(declarative_base()):
     __abstract__ = True
     representation_columns = []
+    # 'json' (legacy, untagged), 'orjson' or 'msgpack'
+    serialization_format = 'json'
+    # seconds to expire in cache; None for no expiration
+    cache_ttl = None
+    # how save(), persist() and enable_cache_sync() update the cache:
+    # 'set' to write the new value, 'delete' to invalidate it
+    cache_write_mode = 'set'
+    # stampede protection of cls.load(), see joker.broker.stampede
+    # seconds of a Redis lease for rebuilding a value; None to disable
+    cache_lease = None
+    # beta of XFetch early recomputation, e.g. 1.0; 0 to disable
+    cache_early_refresh = 0
+    # max number of bound parameters in a single SQL statement
+    max_query_params = 900
+    # compression of cached values, see joker.broker.codecs.Compressor,
+    # e.g. 'zlib' or {'algorithm': 'zstd', 'threshold': 256};
+    # None to follow `compression` of the cache conf section
+    cache_compression = None
+    # seconds to cache results of find(..., cache=cache); None to disable.
+    # cached results of a table are invalidated by save(), persist(),
+    # bulk_insert() and enable_cache_sync(), but not by other writes
+    query_cache_ttl = None
+    # 'rows' to cache rows found, or 'identities' to cache primary keys
+    # only and then get objects with load_many()
+    query_cache_mode = 'rows'
+    # number of rows fetched and transposed at a time, for forms 'c' and 'a'
+    columnar_batch_size = 10000
+    # create objects of find(form='o') and unserialize() without calling
+    # __init__, faster but skipping defaults and attributes it sets
+    skip_init = False
 
     def __repr__(self):
         if self.representation_columns:
             return represent(self, self.representation_columns)
-        fields = [c.name for c in self.get_table().primary_key]
-        return represent(self, fields)
+        return represent(self, self.get_model_info().pk_names)
 
     @classmethod
     def get_table(cls):
         return getattr(cls, '__table__')
 
+    @classmethod
+    def get_model_info(cls):
+        """:rtype: ModelInfo"""
+        # look into __dict__ to avoid getting that of the base class
+        try:
+            return cls.__dict__['_model_info']
+        except KeyError:
+            pass
+        info = ModelInfo(cls)
+        setattr(cls, '_model_info', info)
+        return info
+
     def get_identity(self, flat=True):
         identity = inspect(self).identity
+        if identity is None:
+            # transient, e.g. made by cls.unserialize()
+            identity = self.get_model_info().get_pk_values(self)
         if flat:
             identity = flatten(identity)
         return identity
 
     @classmethod
     def format_cache_key(cls, ident):
-        c = cls.__name__
-        t = cls.get_table().name
         x = '_'.join(str(i) for i in unflatten(ident))
-        return '{}:{}:{}'.format(c, t, x)
+        return cls.get_model_info().cache_key_prefix + x
 
     @property
     def cache_key(self):
         return self.format_cache_key(self.get_identity(flat=False))
 
     def save(self, session, cache=None):
-        if cache is not None:
-            cache.set(self.cache_key, self.serialize())
+        """
+        Add self to session and commit;
+        then write to cache, only if committed successfully
+        """
         session.add(self)
-        commit_or_rollback(session)
+        writes = _flush_and_commit(session, [self], cache)
+        if writes:
+            _apply_cache_writes(cache, *writes)
 
     @classmethod
-    def load(cls, ident, session, cache=None):
-        if cache is not None:
-            string = cache.get(cls.format_cache_key(ident))
-            if string:
-                return cls.unserialize(string)
-        return session.query(cls).get(ident)
+    def load(cls, ident, session, cache=None, ttl=None):
+        """
+        Load an object by identity, from cache if found there,
+        otherwise from database and then written to cache.
+
+        Concurrent misses of the same object in a process make
+        only one database query; see also cls.cache_lease and
+        cls.cache_early_refresh for protection across processes.
+
+        :param ident: identity (primary key value)
+        :param session: (sqlalchemy.orm.Session)
+        :param cache: (joker.broker.interfaces.redis.RedisInterface)
+        :param ttl: (int) seconds to expire, default to cls.cache_ttl
+        """
+        if cache is None:
+            return session.query(cls).get(ident)
+        key = cls.format_cache_key(ident)
+        data = cache.get(key)
+        beta = cls.cache_early_refresh
+        if data and not stampede.should_refresh_early(data, beta):
+            cls._count_cache_lookups(1, 0)
+            return cls.unserialize(data)
+        cls._count_cache_lookups(0, 1)
+        if ttl is None:
+            ttl = cls.cache_ttl
+
+        def _fill():
+            t0 = time.perf_counter()
+            o = session.query(cls).get(ident)
+            if o is None:
+                return None, None
+            fresh = o.serialize_for_cache(cache)
+            delta = time.perf_counter() - t0
+            value = cls._seal_cache_value(fresh, delta, ttl)
+            cache.set(key, value, **_expiry_kwargs(ttl))
+            return o, fresh
+
+        def _rebuild():
+            if not cls.cache_lease:
+                return _fill()
+            return stampede.rebuild_with_lease(
+                cache, key, _fill, cls.cache_lease, stale=data)
+
+        (obj, data), leader = _flights.do(key, _rebuild)
+        # objects bound to the session of another thread are not shared
+        if leader and obj is not None:
+            return obj
+        if data is None:
+            return
+        return cls.unserialize(data)
 
     @classmethod
-    def load_many(cls, idents, session, cache=None):
+    def _count_cache_lookups(cls, hits, misses):
+        if not _metrics.enabled:
+            return
+        if hits:
+            _metrics.inc('broker_cache_hits_total', hits, model=cls.__name__)
+        if misses:
+            _metrics.inc('broker_cache_misses_total', misses,
+                         model=cls.__name__)
+
+    @classmethod
+    def _seal_cache_value(cls, data, delta, ttl):
+        if cls.cache_early_refresh and ttl:
+            return codecs.seal_envelope(data, delta, time.time() + ttl)
+        return data
+
+    @classmethod
+    def load_many(cls, idents, session, cache=None, ttl=None):
+        """
+        Load objects by identities, from cache if found there,
+        and the rest from database with chunked IN (...) queries;
+        objects loaded from database are then written to cache.
+
+        :param idents: a series of identities (primary key values)
+        :param session: (sqlalchemy.orm.Session)
+        :param cache: (joker.broker.interfaces.redis.RedisInterface)
+        :param ttl: (int) seconds to expire, default to cls.cache_ttl
+        :return: (list) objects or None, in the order of idents
+        """
         idents = [unflatten(it) for it in idents]
+        results = dict()
 
         if cache is not None:
             names = [cls.format_cache_key(it) for it in idents]
-            values = cache.get_many(names)
-            pairs = zip(idents, values)
-            results = {it: v for (it, v) in pairs if it is not None}
-            remainders = [it for it in idents if it not in results]
-        else:
-            results = dict()
-            remainders = idents
-
-        if remainders:
-            tbl = cls.get_table()
-            cond = tuple_(*tbl.primary_key).in_(remainders)
-            query = session.query(cls).filter(cond)
-            for o in query.all():
-                results[o.get_identity(flat=False)] = o
+            # NullRedisInterface gives None
+            values = cache.get_many(names) or []
+            for it, val in zip(idents, values):
+                if val is not None:
+                    results[it] = cls.unserialize(val)
+
+        # dict.fromkeys: remove duplicates but keep order
+        remainders = [it for it in dict.fromkeys(idents) if it not in results]
+        if cache is not None:
+            cls._count_cache_lookups(len(results), len(remainders))
+        if not remainders:
+            return [results.get(it) for it in idents]
+
+        fetched = cls._query_by_identities(remainders, session)
+        for o in fetched:
+            results[o.get_identity(flat=False)] = o
+
+        if cache is not None and fetched:
+            if ttl is None:
+                ttl = cls.cache_ttl
+            kvpairs = [(o.cache_key, o.serialize_for_cache(cache))
+                       for o in fetched]
+            cache.set_many(kvpairs, **_expiry_kwargs(ttl))
         return [results.get(it) for it in idents]
 
+    @classmethod
+    def _iter_identity_conditions(cls, idents):
+        pk_columns = cls.get_model_info().pk_columns
+        if len(pk_columns) == 1:
+            key = pk_columns[0]
+            idents = [it[0] for it in idents]
+        else:
+            key = tuple_(*pk_columns)
+        chunksize = max(1, cls.max_query_params // len(pk_columns))
+        for i in range(0, len(idents), chunksize):
+            yield key.in_(idents[i:i + chunksize])
+
+    @classmethod
+    def _query_by_identities(cls, idents, session):
+        results = []
+        for cond in cls._iter_identity_conditions(idents):
+            results.extend(session.query(cls).filter(cond))
+        return results
+
     def as_json_serializable(self, fields=None):
         result = {}
-        names = {c.name for c in self.get_table().columns}
+        info = self.get_model_info()
         if fields is None:
-            fields = names
+            fields = info.column_names
         else:
-            fields = set(fields).intersection(names)
+            fields = info.column_name_set.intersection(fields)
 
         for key in fields:
             val = getattr(self, key)
@@ -197,29 +704,206 @@ class DeclBase(declarative_base()):
                 result[key] = val
         return result
 
-    def serialize(self):
-        dikt = self.as_json_serializable()
-        return json.dumps(dikt)
+    def _encode_columns(self):
+        result = {}
+        for key, encode in self.get_model_info().encoding_plan:
+            val = getattr(self, key)
+            if val is not None and encode is not None:
+                val = encode(val)
+            result[key] = val
+        return result
 
     @classmethod
-    def unserialize(cls, string, asdict=False):
+    def _decode_columns(cls, dikt):
+        for key, decode in cls.get_model_info().decoding_plan:
+            val = dikt.get(key)
+            if val is not None:
+                dikt[key] = decode(val)
+        return dikt
+
+    def serialize(self, fmt=None):
+        """
+        :param fmt: (str) serialization format, default to
+            cls.serialization_format
+        :return: (str) for 'json' (legacy), or (bytes) with a format tag
+        """
+        fmt = fmt or self.serialization_format
+        t0 = time.perf_counter() if _metrics.enabled else None
+        if fmt == 'json':
+            dikt = self.as_json_serializable()
+            data = json.dumps(dikt)
+        else:
+            codec = codecs.get_codec(fmt)
+            data = codec.encode(self._encode_columns())
+        if t0 is not None:
+            _metrics.observe('broker_serialize_seconds',
+                             time.perf_counter() - t0,
+                             model=self.__class__.__name__)
+        return data
+
+    @classmethod
+    def get_cache_compressor(cls, cache=None):
+        """
+        :param cache: (joker.broker.interfaces.redis.RedisInterface)
+        :return: a joker.broker.codecs.Compressor instance, or None
+        """
+        spec = cls.cache_compression
+        if spec is None and cache is not None:
+            spec = getattr(cache, 'compression', None)
+        return codecs.get_compressor(spec)
+
+    def serialize_for_cache(self, cache=None):
+        """
+        Serialize and then compress if self.get_cache_compressor(cache)
+        """
+        data = self.serialize()
+        compressor = self.get_cache_compressor(cache)
+        if compressor is None:
+            return data
+        return compressor.compress(data)
+
+    @staticmethod
+    def _unserialize_json(string):
         dikt = json.loads(string)
         params = {}
         for key, val in dikt.items():
             if isinstance(val, dict) and '__type__' in val:
                 if val["__type__"] == "datetime":
-                    a = val['value'], "%Y-%m-%d %H:%M:%S"
-                    params[key] = datetime.datetime.strptime(*a)
+                    params[key] = \
+                        datetime.datetime.fromisoformat(val['value'])
                 elif val["__type__"] == "date":
-                    a = val['value'], "%Y-%m-%d"
-                    params[key] = datetime.datetime.strptime(*a).date()
+                    params[key] = datetime.date.fromisoformat(val['value'])
                 elif val["__type__"] == "Decimal":
                     params[key] = Decimal(val["value"])
             else:
                 params[key] = val
+        return params
+
+    @classmethod
+    def unserialize(cls, string, asdict=False):
+        """
+        :param string: (str or bytes) in any format of cls.serialize(),
+            compressed or not
+        :param asdict: (bool) return a dict instead of a model object
+        """
+        t0 = time.perf_counter() if _metrics.enabled else None
+        string = codecs.open_envelope(string)[0]
+        string = codecs.decompress(string)
+        codec = codecs.detect_codec(string)
+        if codec is None:
+            params = cls._unserialize_json(string)
+        else:
+            params = cls._decode_columns(codec.decode(string))
+        if t0 is not None:
+            _metrics.observe('broker_unserialize_seconds',
+                             time.perf_counter() - t0, model=cls.__name__)
         if asdict:
             return params
-        return cls(**params)
+        return cls.get_model_info().make_instance(params)
+
+    # asyncio counterparts of load, load_many, save and find,
+    # with AsyncSession and AsyncRedisInterface (see joker.broker.interfaces.aio)
+    # Note: cls.cache_lease is not supported in these methods
+
+    @classmethod
+    async def aload(cls, ident, session, cache=None, ttl=None):
+        """See cls.load()"""
+        if cache is None:
+            return await session.get(cls, ident)
+        key = cls.format_cache_key(ident)
+        data = await cache.get(key)
+        beta = cls.cache_early_refresh
+        if data and not stampede.should_refresh_early(data, beta):
+            cls._count_cache_lookups(1, 0)
+            return cls.unserialize(data)
+        cls._count_cache_lookups(0, 1)
+        if ttl is None:
+            ttl = cls.cache_ttl
+
+        async def _fill():
+            t0 = time.perf_counter()
+            o = await session.get(cls, ident)
+            if o is None:
+                return None, None
+            fresh = o.serialize_for_cache(cache)
+            delta = time.perf_counter() - t0
+            value = cls._seal_cache_value(fresh, delta, ttl)
+            await cache.set(key, value, **_expiry_kwargs(ttl))
+            return o, fresh
+
+        (obj, data), leader = await _async_flights.do(key, _fill)
+        if leader and obj is not None:
+            return obj
+        if data is None:
+            return
+        return cls.unserialize(data)
+
+    @classmethod
+    async def aload_many(cls, idents, session, cache=None, ttl=None):
+        """See cls.load_many()"""
+        idents = [unflatten(it) for it in idents]
+        results = dict()
+
+        if cache is not None:
+            names = [cls.format_cache_key(it) for it in idents]
+            values = await cache.get_many(names) or []
+            for it, val in zip(idents, values):
+                if val is not None:
+                    results[it] = cls.unserialize(val)
+
+        remainders = [it for it in dict.fromkeys(idents) if it not in results]
+        if cache is not None:
+            cls._count_cache_lookups(len(results), len(remainders))
+        if not remainders:
+            return [results.get(it) for it in idents]
+
+        fetched = []
+        for cond in cls._iter_identity_conditions(remainders):
+            result = await session.execute(select(cls).where(cond))
+            fetched.extend(result.scalars())
+        for o in fetched:
+            results[o.get_identity(flat=False)] = o
+
+        if cache is not None and fetched:
+            if ttl is None:
+                ttl = cls.cache_ttl
+            kvpairs = [(o.cache_key, o.serialize_for_cache(cache))
+                       for o in fetched]
+            await cache.set_many(kvpairs, **_expiry_kwargs(ttl))
+        return [results.get(it) for it in idents]
+
+    async def asave(self, session, cache=None):
+        """See self.save()"""
+        session.add(self)
+        try:
+            await session.flush()
+            value = None if cache is None else self.serialize_for_cache(cache)
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+        if cache is None:
+            return
+        if self.cache_write_mode == 'delete':
+            await cache.delete(self.cache_key)
+        else:
+            kwargs = _expiry_kwargs(self.cache_ttl)
+            await cache.set(self.cache_key, value, **kwargs)
+        if self.query_cache_ttl is not None:
+            table_name = self.get_model_info().table.name
+            await cache.incr(_format_table_version_key(table_name))
+
+    @classmethod
+    async def afind(cls, cond, session, form='o', start=0, limit=1000,
+                    order=None):
+        """See cls.find()"""
+        stmt = cls._make_find_statement(cond, form, start, limit, order)
+        try:
+            result = await session.execute(stmt)
+        except sqlalchemy.exc.SQLAlchemyError:
+            await session.rollback()
+            raise
+        return cls._convert_rows(result.all(), form)
 
     @classmethod
     def create_all_tables(cls, engine):
@@ -232,7 +916,8 @@ class DeclBase(declarative_base()):
         meta.create_all(bind=engine)
 
     @classmethod
-    def find(cls, cond, session, form='o', start=0, limit=1000, order=None):
+    def find(cls, cond, session, form='o', start=0, limit=1000, order=None,
+             cache=None, ttl=None):
         """
         :type cond: whereclause / dict
         :param cond: e.g. {'name': 'alice', 'gender': 'female'}
@@ -247,57 +932,271 @@ class DeclBase(declarative_base()):
         'r' for sqlalchemy.engine.result.RowProxy,
         'i' for identity (primary key value)
         'p' for sqlalchemy.engine.result.RowProxy, deprecated
+        or form of all records found
+        'c' for columns, {name: array.array or list},
+            see joker.broker.columnar.build_columns()
+        'a' for a pyarrow.Table (pyarrow required)
 
         :type start: int
         :param start: pagination offset, int, default 0
         :type limit: int
         :param limit: pagination limit, int, default 1000
         :param order: sqlalchemy clauses
+
+        :param cache: (joker.broker.interfaces.redis.RedisInterface)
+            to cache results if cls.query_cache_ttl is not None,
+            for forms 'o', 'd' and 'i'
+        :param ttl: (int) seconds to expire, default to cls.query_cache_ttl
         """
-        allowed_forms = {'o', 'r', 'd', 'i', 'p'}
-        if form not in allowed_forms:
-            msg = 'form must be chosen from {}'.format(allowed_forms)
-            raise ValueError(msg)
+        if cache is not None and cls.query_cache_ttl is not None \
+                and form in ('o', 'd', 'i'):
+            return cls._find_with_cache(
+                cond, session, form, start, limit, order, cache, ttl)
+        stmt = cls._make_find_statement(cond, form, start, limit, order)
+        if form in ('c', 'a'):
+            return cls._find_columnar(stmt, session, form)
+        return cls._convert_rows(cls._execute(stmt, session), form)
 
-        tbl = getattr(cls, '__table__')
-        if not order:
-            order = tuple(tbl.primary_key)
-        elif not isinstance(order, (tuple, list)):
-            order = order,
+    @classmethod
+    def _find_columnar(cls, stmt, session, form):
+        # use server-side cursors where the driver supports
+        stmt = stmt.execution_options(stream_results=True)
+        try:
+            result = session.execute(stmt)
+            return cls._convert_rows(result, form)
+        except sqlalchemy.exc.SQLAlchemyError:
+            session.rollback()
+            raise
+
+    @staticmethod
+    def _execute(stmt, session):
+        try:
+            return list(session.execute(stmt))
+        except sqlalchemy.exc.SQLAlchemyError:
+            session.rollback()
+            raise
+
+    @classmethod
+    def _format_query_cache_key(cls, stmt, version):
+        compiled = stmt.compile()
+        params = sorted(compiled.params.items())
+        text = '{}\0{!r}'.format(compiled, params)
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        return '{}q:{}:{}'.format(
+            cls.get_model_info().cache_key_prefix, version, digest)
+
+    @classmethod
+    def _find_with_cache(cls, cond, session, form, start, limit, order,
+                         cache, ttl):
+        info = cls.get_model_info()
+        by_identity = form == 'i' or cls.query_cache_mode == 'identities'
+        if by_identity:
+            encoders, decoders = info.pk_encoders, info.pk_decoders
+        else:
+            encoders, decoders = info.row_encoders, info.row_decoders
+        stmt = cls._make_find_statement(
+            cond, 'i' if by_identity else 'd', start, limit, order)
+        backend = _get_query_cache_backend(cache)
+        version_key = _format_table_version_key(info.table.name)
+        version = backend.get(version_key)
+        if isinstance(version, bytes):
+            version = version.decode()
+        key = cls._format_query_cache_key(stmt, version or 0)
+        data = cache.get(key)
+        codec = codecs.get_codec('orjson')
+        if data:
+            rows = [_convert_row(r, decoders) for r in codec.decode(data)]
+        else:
+            rows = [tuple(r) for r in cls._execute(stmt, session)]
+            # tuples are encoded as lists
+            records = [_convert_row(r, encoders) for r in rows]
+            if ttl is None:
+                ttl = cls.query_cache_ttl
+            cache.set(key, codec.encode(records), **_expiry_kwargs(ttl))
+        if form == 'i':
+            return [flatten(r) for r in rows]
+        if by_identity:
+            objs = [o for o in cls.load_many(rows, session, cache) if o]
+            if form == 'o':
+                return objs
+            return [{n: getattr(o, n) for n in info.column_names}
+                    for o in objs]
+        names = info.column_names
+        if form == 'o':
+            return [info.make_instance(zip(names, r)) for r in rows]
+        return [dict(zip(names, r)) for r in rows]
+
+    @classmethod
+    def _make_find_statement(cls, cond, form, start, limit, order):
+        cls._check_form(form)
+        info = cls.get_model_info()
+        order = cls._normalize_order(order)
 
         # reduce db bandwidth cost if only pk is required
         if form == 'i':
-            stmt = select(tbl.primary_key)
+            stmt = select(*info.pk_columns)
         else:
-            stmt = tbl.select()
-
-        if isinstance(cond, dict):
-            expressions = list()
-            for k, v in cond.items():
-                expressions.append(getattr(tbl.c, k) == v)
-            cond = and_(*expressions)
+            stmt = info.table.select()
 
-        stmt = stmt.where(cond)
+        stmt = stmt.where(cls._make_where_clause(cond))
         stmt = stmt.order_by(*order)
 
         if start:
             stmt = stmt.offset(start)
         if limit:
             stmt = stmt.limit(limit)
+        return stmt
 
-        try:
-            rows = list(session.execute(stmt))
-        except sqlalchemy.exc.SQLAlchemyError:
-            session.rollback()
-            raise
+    @classmethod
+    def iter_find(cls, cond, session, form='o', order=None,
+                  batch_size=1000, after=None):
+        """
+        Iterate over all records found with keyset (seek) pagination, i.e.
+        WHERE (k1, k2) > (:last_k1, :last_k2) ORDER BY k1, k2 LIMIT :n,
+        so that a deep batch costs as little as the first one.
+
+        :param order: columns, default to the primary key;
+            must be non-null and unique all together, all ASC or all DESC
+        :type batch_size: int
+        :param batch_size: number of records fetched per query
+        :param after: keyset value to start after (exclusive)
+
+        See cls.find() for cond, session and form.
+        """
+        cls._check_form(form)
+        if form in ('c', 'a'):
+            raise ValueError('form must not be columnar for iter_find()')
+        info = cls.get_model_info()
+        order = cls._normalize_order(order)
+        columns, desc = _parse_keyset_order(info.table, order)
+
+        if form == 'i':
+            selected = list(info.pk_columns)
+            for c in columns:
+                if _index_by_identity(selected, c) is None:
+                    selected.append(c)
+            stmt = select(*selected)
+        else:
+            selected = list(info.columns)
+            stmt = info.table.select()
+        positions = [_index_by_identity(selected, c) for c in columns]
+        if None in positions:
+            raise ValueError('order must consist of columns of the table')
+
+        stmt = stmt.where(cls._make_where_clause(cond))
+        if desc:
+            stmt = stmt.order_by(*[c.desc() for c in columns])
+        else:
+            stmt = stmt.order_by(*columns)
+        # use server-side cursors where the driver supports
+        stmt = stmt.limit(batch_size).execution_options(stream_results=True)
+        keyset = tuple_(*columns) if len(columns) > 1 else columns[0]
+        pk_count = len(info.pk_columns)
+
+        while True:
+            if after is None:
+                page = stmt
+            else:
+                after = unflatten(after)
+                bound = tuple_(*after) if len(after) > 1 else after[0]
+                page = stmt.where(keyset < bound if desc else keyset > bound)
+            try:
+                rows = session.execute(page).fetchall()
+            except sqlalchemy.exc.SQLAlchemyError:
+                session.rollback()
+                raise
+            if not rows:
+                return
+            after = tuple(rows[-1][i] for i in positions)
+            if len(selected) > pk_count and form == 'i':
+                rows = [r[:pk_count] for r in rows]
+            for record in cls._convert_rows(rows, form):
+                yield record
+            if len(rows) < batch_size:
+                return
+
+    @classmethod
+    def _normalize_order(cls, order):
+        # a single clause has no boolean value; do not test it with `not`
+        if order is None:
+            return cls.get_model_info().pk_columns
+        if not isinstance(order, (tuple, list)):
+            return order,
+        return order or cls.get_model_info().pk_columns
 
+    @staticmethod
+    def _check_form(form):
+        allowed_forms = {'o', 'r', 'd', 'i', 'p', 'c', 'a'}
+        if form not in allowed_forms:
+            msg = 'form must be chosen from {}'.format(allowed_forms)
+            raise ValueError(msg)
+
+    @classmethod
+    def _make_where_clause(cls, cond):
+        if not isinstance(cond, dict):
+            return cond
+        tbl = cls.get_table()
+        expressions = list()
+        for k, v in cond.items():
+            expressions.append(getattr(tbl.c, k) == v)
+        return and_(*expressions)
+
+    @classmethod
+    def _convert_rows(cls, rows, form):
         if form == 'i':
             return [flatten(tuple(r)) for r in rows]
         if form == 'o':
-            return [cls(**dict(r)) for r in rows]
+            info = cls.get_model_info()
+            names = info.column_names
+            return [info.make_instance(zip(names, r)) for r in rows]
         if form == 'd':
-            return [dict(r) for r in rows]
+            return [dict(r._mapping) for r in rows]
+        if form == 'c':
+            info = cls.get_model_info()
+            return columnar.build_columns(
+                rows, info.columns, cls.columnar_batch_size)
+        if form == 'a':
+            info = cls.get_model_info()
+            return columnar.build_arrow_table(
+                rows, info.columns, cls.columnar_batch_size)
         if form == 'p':
             import warnings
             warnings.warn("form='p' is deprecated, use 'r' instead")
         return rows
+
+
+def _convert_row(row, converters):
+    return tuple(
+        v if v is None or c is None else c(v)
+        for v, c in zip(row, converters)
+    )
+
+
+def _index_by_identity(columns, column):
+    # list.index() does not work since Column.__eq__ is overloaded
+    for i, c in enumerate(columns):
+        if c is column:
+            return i
+
+
+def _parse_keyset_order(table, order):
+    columns = []
+    directions = set()
+    for o in order:
+        desc = False
+        if isinstance(o, UnaryExpression) and \
+                o.modifier in (operators.desc_op, operators.asc_op):
+            desc = o.modifier is operators.desc_op
+            o = o.element
+        if isinstance(o, str):
+            o = table.c[o]
+        columns.append(o)
+        directions.add(desc)
+    if len(directions) > 1:
+        raise ValueError('mixed ASC and DESC are not supported')
+    return columns, directions.pop()
+
+
+@event.listens_for(DeclBase, 'mapper_configured', propagate=True)
+def _compile_model_info(_mapper, klass):
+    klass.get_model_info()
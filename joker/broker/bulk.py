@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Bulk loading of records (dicts) into a table, in chunks.
+
+Methods:
+- 'insert' (default): INSERT with executemany, which is fast with psycopg2
+  if executemany_mode is 'values_only' or 'values_plus_batch' in conf
+- 'copy': PostgreSQL COPY FROM STDIN, with psycopg2 only; opt-in, since
+  Python-side `default` and `onupdate` of columns are not applied,
+  and all records must have the same keys
+"""
+
+import io
+import itertools
+import json
+import logging
+import time
+
+from sqlalchemy import Table
+
+_logger = logging.getLogger(__name__)
+
+
+class BulkLoadReport(object):
+    def __init__(self):
+        self.rows = 0
+        self.chunks = 0
+        self.seconds = 0.
+
+    def __repr__(self):
+        c = self.__class__.__name__
+        return '<{} rows={} chunks={} seconds={:.3f} rows/sec={:.1f}>'.format(
+            c, self.rows, self.chunks, self.seconds, self.rows_per_second)
+
+    @property
+    def rows_per_second(self):
+        if not self.seconds:
+            return 0.
+        return self.rows / self.seconds
+
+
+def iter_chunks(iterable, chunksize):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _copy_escape(val):
+    # text format of PostgreSQL COPY
+    if val is None:
+        return '\\N'
+    if isinstance(val, bool):
+        return 't' if val else 'f'
+    if isinstance(val, (dict, list)):
+        val = json.dumps(val)
+    elif isinstance(val, (bytes, bytearray, memoryview)):
+        return '\\\\x' + bytes(val).hex()
+    else:
+        val = str(val)
+    return val.replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _copy_chunk(conn, table, columns, chunk):
+    buf = io.StringIO()
+    keys = set(columns)
+    for record in chunk:
+        if record.keys() != keys:
+            msg = 'keys of all records must be the same with COPY: {}'
+            raise ValueError(msg.format(sorted(record)))
+        line = '\t'.join(_copy_escape(record.get(c)) for c in columns)
+        buf.write(line)
+        buf.write('\n')
+    buf.seek(0)
+    preparer = conn.dialect.identifier_preparer
+    sql = 'COPY {} ({}) FROM STDIN'.format(
+        preparer.format_table(table),
+        ', '.join(preparer.quote(c) for c in columns),
+    )
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(sql, buf)
+    finally:
+        cursor.close()
+
+
+def _make_insert(engine, table, columns, on_conflict, conflict_columns):
+    if not on_conflict:
+        return table.insert()
+    backend = engine.url.get_backend_name()
+    if backend == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif backend == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        msg = 'on_conflict is not supported for {}'.format(backend)
+        raise ValueError(msg)
+    stmt = insert(table)
+    if conflict_columns is None:
+        conflict_columns = [c.name for c in table.primary_key]
+    if on_conflict == 'nothing':
+        return stmt.on_conflict_do_nothing(index_elements=conflict_columns)
+    if on_conflict == 'update':
+        updates = {
+            c: getattr(stmt.excluded, c)
+            for c in columns if c not in conflict_columns
+        }
+        return stmt.on_conflict_do_update(
+            index_elements=conflict_columns, set_=updates)
+    raise ValueError('on_conflict must be None, "nothing" or "update"')
+
+
+def _check_copy(engine, on_conflict):
+    if on_conflict:
+        raise ValueError('on_conflict is not supported with COPY')
+    if engine.url.get_backend_name() != 'postgresql' \
+            or engine.dialect.driver != 'psycopg2':
+        raise ValueError('COPY is for postgresql+psycopg2 only')
+
+
+def bulk_load(engine, table, records, chunksize=10000, on_conflict=None,
+              conflict_columns=None, method='insert', atomic=True):
+    """
+    :param engine: (sqlalchemy.engine.Engine)
+    :param table: (sqlalchemy.Table or a DeclBase derived class)
+    :param records: an iterable of dicts, e.g. a generator
+    :param chunksize: (int) number of records sent in a batch
+    :param on_conflict: None, 'nothing' or 'update' (upsert)
+    :param conflict_columns: column names for ON CONFLICT;
+        default to primary key
+    :param method: 'insert', or 'copy' for PostgreSQL with psycopg2,
+        which skips Python-side column defaults
+    :param atomic: (bool) all chunks in one transaction if True;
+        if False, each chunk is committed on its own, so chunks loaded
+        before a failure are left in the table
+    :rtype: BulkLoadReport
+    """
+    if not isinstance(table, Table):
+        table = table.__table__
+    if method == 'copy':
+        _check_copy(engine, on_conflict)
+    elif method != 'insert':
+        raise ValueError('method must be "insert" or "copy"')
+
+    report = BulkLoadReport()
+    t0 = time.perf_counter()
+    chunks = iter_chunks(records, chunksize)
+    if atomic:
+        with engine.begin() as conn:
+            for chunk in chunks:
+                _load_chunk(conn, table, chunk, method,
+                            on_conflict, conflict_columns)
+                report.chunks += 1
+                report.rows += len(chunk)
+    else:
+        for chunk in chunks:
+            with engine.begin() as conn:
+                _load_chunk(conn, table, chunk, method,
+                            on_conflict, conflict_columns)
+            report.chunks += 1
+            report.rows += len(chunk)
+    report.seconds = time.perf_counter() - t0
+    _logger.info('bulk loaded into %s: %r', table.name, report)
+    return report
+
+
+def _load_chunk(conn, table, chunk, method, on_conflict, conflict_columns):
+    # columns of the first record are taken, as executemany does
+    columns = list(chunk[0])
+    if method == 'copy':
+        _copy_chunk(conn, table, columns, chunk)
+    else:
+        stmt = _make_insert(
+            conn.engine, table, columns, on_conflict, conflict_columns)
+        conn.execute(stmt, chunk)
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Binary formats of cached model objects.
+
+A tagged value is a 1-byte format tag followed by the payload,
+while values of the legacy JSON format start with b'{' (untagged).
+So values in both formats can be read side by side during a migration.
+
+Layers of a cached value, outermost first, each optional:
+envelope (0x10), compression (0x2X), format tag (0x0X) and payload.
+"""
+
+import base64
+import datetime
+import struct
+import threading
+import uuid
+import zlib
+from decimal import Decimal
+
+
+class Codec(object):
+    name = ''
+    tag = b''
+
+    def dumps(self, obj):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+    def encode(self, obj):
+        return self.tag + self.dumps(obj)
+
+    def decode(self, data):
+        return self.loads(memoryview(data)[len(self.tag):])
+
+
+class ORJSONCodec(Codec):
+    name = 'orjson'
+    tag = b'\x01'
+
+    def __init__(self):
+        import orjson
+        self.dumps = orjson.dumps
+        self.loads = orjson.loads
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+    tag = b'\x02'
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            msg = 'msgpack is required for serialization_format "msgpack"'
+            raise ImportError(msg)
+        self._msgpack = msgpack
+
+    def dumps(self, obj):
+        return self._msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return self._msgpack.unpackb(data, raw=False)
+
+
+_codec_classes = [ORJSONCodec, MsgpackCodec]
+_codecs_by_name = {}
+_codecs_by_tag = {}
+
+
+def get_codec(name):
+    """
+    :param name: (str) e.g. 'orjson', 'msgpack'
+    :rtype: Codec
+    """
+    try:
+        return _codecs_by_name[name]
+    except KeyError:
+        pass
+    for klass in _codec_classes:
+        if klass.name == name:
+            codec = klass()
+            _codecs_by_name[name] = codec
+            _codecs_by_tag[codec.tag] = codec
+            return codec
+    raise ValueError('unknown serialization format: {!r}'.format(name))
+
+
+def detect_codec(data):
+    """
+    :param data: (bytes or str) a serialized value
+    :return: a Codec instance, or None for the legacy JSON format
+    """
+    if isinstance(data, str):
+        return None
+    tag = bytes(data[:1])
+    if tag == b'{':
+        return None
+    try:
+        return _codecs_by_tag[tag]
+    except KeyError:
+        pass
+    for klass in _codec_classes:
+        if klass.tag == tag:
+            return get_codec(klass.name)
+    raise ValueError('unknown format tag: {!r}'.format(tag))
+
+
+# an envelope carries a value with its compute time and expiration time
+# envelope = tag + delta (float64) + expire_at (float64) + payload
+_envelope_tag = b'\x10'
+_envelope_header = struct.Struct('<dd')
+
+
+def seal_envelope(data, delta, expire_at):
+    """
+    :param data: (bytes or str) a serialized value
+    :param delta: (float) seconds taken to compute the value
+    :param expire_at: (float) unix timestamp
+    :rtype: bytes
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return _envelope_tag + _envelope_header.pack(delta, expire_at) + data
+
+
+def open_envelope(data):
+    """
+    :param data: (bytes or str) a serialized value, enveloped or not
+    :return: (payload, delta, expire_at), or (data, None, None)
+    """
+    if isinstance(data, str) or data[:1] != _envelope_tag:
+        return data, None, None
+    delta, expire_at = _envelope_header.unpack_from(data, 1)
+    return data[1 + _envelope_header.size:], delta, expire_at
+
+
+# compression header = tag (+ dictionary id, uint32, if tag & 0x08)
+_dict_flag = 0x08
+_dict_id_struct = struct.Struct('>I')
+
+
+class _Algorithm(object):
+    name = ''
+    tag = 0
+    supports_dictionary = False
+
+    def compress(self, data, level, dictionary):
+        raise NotImplementedError
+
+    def decompress(self, data, dictionary):
+        raise NotImplementedError
+
+
+class _ZlibAlgorithm(_Algorithm):
+    name = 'zlib'
+    tag = 0x21
+    supports_dictionary = True
+
+    def compress(self, data, level, dictionary):
+        if level is None:
+            level = -1
+        if dictionary is None:
+            return zlib.compress(data, level)
+        c = zlib.compressobj(level, zdict=dictionary)
+        return c.compress(data) + c.flush()
+
+    def decompress(self, data, dictionary):
+        if dictionary is None:
+            return zlib.decompress(data)
+        d = zlib.decompressobj(zdict=dictionary)
+        return d.decompress(data) + d.flush()
+
+
+class _LzmaAlgorithm(_Algorithm):
+    name = 'lzma'
+    tag = 0x22
+
+    def __init__(self):
+        import lzma
+        self._lzma = lzma
+
+    def compress(self, data, level, dictionary):
+        return self._lzma.compress(data, preset=level)
+
+    def decompress(self, data, dictionary):
+        return self._lzma.decompress(data)
+
+
+class _ZstdAlgorithm(_Algorithm):
+    name = 'zstd'
+    tag = 0x23
+    supports_dictionary = True
+
+    def __init__(self):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstandard is required for compression "zstd"')
+        self._zstd = zstandard
+        # compressors are not thread-safe
+        self._local = threading.local()
+
+    def _get(self, kind, level, dictionary):
+        key = kind, level, dictionary
+        cache = self._local.__dict__.setdefault('cache', {})
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        kwargs = {}
+        if dictionary is not None:
+            kwargs['dict_data'] = self._zstd.ZstdCompressionDict(dictionary)
+        if kind == 'c':
+            obj = self._zstd.ZstdCompressor(
+                level=3 if level is None else level, **kwargs)
+        else:
+            obj = self._zstd.ZstdDecompressor(**kwargs)
+        return cache.setdefault(key, obj)
+
+    def compress(self, data, level, dictionary):
+        return self._get('c', level, dictionary).compress(data)
+
+    def decompress(self, data, dictionary):
+        return self._get('d', None, dictionary).decompress(data)
+
+
+class _LZ4Algorithm(_Algorithm):
+    name = 'lz4'
+    tag = 0x24
+
+    def __init__(self):
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError('lz4 is required for compression "lz4"')
+        self._lz4 = lz4.frame
+
+    def compress(self, data, level, dictionary):
+        return self._lz4.compress(data, compression_level=level or 0)
+
+    def decompress(self, data, dictionary):
+        return self._lz4.decompress(data)
+
+
+_algorithm_classes = [
+    _ZlibAlgorithm, _LzmaAlgorithm, _ZstdAlgorithm, _LZ4Algorithm,
+]
+_algorithms = {}
+# dictionary id => bytes
+_dictionaries = {}
+
+
+def _get_algorithm(name=None, tag=None):
+    for klass in _algorithm_classes:
+        if klass.name == name or klass.tag == tag:
+            break
+    else:
+        if name is not None:
+            raise ValueError('unknown compression: {!r}'.format(name))
+        raise ValueError('unknown compression tag: {!r}'.format(tag))
+    try:
+        return _algorithms[klass.name]
+    except KeyError:
+        return _algorithms.setdefault(klass.name, klass())
+
+
+def register_dictionary(dictionary):
+    """
+    Register a dictionary for compression and decompression,
+    e.g. made by train_dictionary() and saved to a file
+
+    :param dictionary: (bytes)
+    :return: (int) dictionary id, written in headers of compressed values
+    """
+    dict_id = zlib.crc32(dictionary)
+    _dictionaries[dict_id] = dictionary
+    return dict_id
+
+
+def train_dictionary(samples, size=16384):
+    """
+    Train a zstd dictionary with samples, e.g. serialized model objects
+
+    :param samples: (list) of bytes
+    :param size: (int) max size of the dictionary in bytes
+    :rtype: bytes
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstandard is required to train dictionaries')
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+class Compressor(object):
+    """
+    Compress values no smaller than `threshold` bytes, with a header,
+    so that compressed and uncompressed values can be read side by side
+    """
+
+    def __init__(self, algorithm='zlib', level=None, threshold=1024,
+                 dictionary=None):
+        """
+        :param algorithm: (str) 'zlib', 'lzma', 'zstd' or 'lz4';
+            package zstandard or lz4 required for the last two
+        :param level: (int) compression level, algorithm-specific
+        :param threshold: (int) min size in bytes to compress
+        :param dictionary: (bytes or str) a dictionary for zlib or zstd,
+            or path to a file containing it
+        """
+        self.algorithm = _get_algorithm(algorithm)
+        self.level = level
+        self.threshold = threshold
+        if isinstance(dictionary, str):
+            with open(dictionary, 'rb') as fin:
+                dictionary = fin.read()
+        if dictionary is None:
+            self.dictionary = None
+            self.header = bytes([self.algorithm.tag])
+            return
+        if not self.algorithm.supports_dictionary:
+            msg = 'dictionary is not supported by {}'.format(algorithm)
+            raise ValueError(msg)
+        self.dictionary = dictionary
+        dict_id = register_dictionary(dictionary)
+        self.header = bytes([self.algorithm.tag | _dict_flag]) \
+            + _dict_id_struct.pack(dict_id)
+
+    def compress(self, data):
+        """
+        :param data: (bytes or str) a serialized value
+        :return: (bytes or str) data itself if small or incompressible
+        """
+        if len(data) < self.threshold:
+            return data
+        raw = data.encode('utf-8') if isinstance(data, str) else data
+        compressed = self.algorithm.compress(raw, self.level, self.dictionary)
+        if len(compressed) + len(self.header) >= len(raw):
+            return data
+        return self.header + compressed
+
+
+_compressors = {}
+
+
+def get_compressor(spec):
+    """
+    :param spec: (str) an algorithm name, or (dict) kwargs of Compressor,
+        or a Compressor instance
+    :return: a Compressor instance, or None if spec is None
+    """
+    if spec is None or isinstance(spec, Compressor):
+        return spec
+    if isinstance(spec, str):
+        spec = {'algorithm': spec}
+    if not isinstance(spec, dict):
+        # e.g. noop of NullRedisInterface
+        return
+    key = tuple(sorted(spec.items()))
+    try:
+        return _compressors[key]
+    except KeyError:
+        return _compressors.setdefault(key, Compressor(**spec))
+
+
+def decompress(data):
+    """
+    :param data: (bytes or str) a serialized value, compressed or not
+    :return: (bytes or str) the serialized value
+    """
+    if isinstance(data, str) or not data:
+        return data
+    tag = data[0]
+    if tag & 0xf0 != 0x20:
+        return data
+    algorithm = _get_algorithm(tag=tag & ~_dict_flag)
+    if not tag & _dict_flag:
+        return algorithm.decompress(bytes(data[1:]), None)
+    dict_id = _dict_id_struct.unpack_from(data, 1)[0]
+    try:
+        dictionary = _dictionaries[dict_id]
+    except KeyError:
+        msg = 'compression dictionary not registered: {}'.format(dict_id)
+        raise ValueError(msg)
+    offset = 1 + _dict_id_struct.size
+    return algorithm.decompress(bytes(data[offset:]), dictionary)
+
+
+# (python_type, encoder, decoder)
+# datetime.datetime must come before its base class datetime.date
+_converters = [
+    (datetime.datetime,
+     datetime.datetime.isoformat, datetime.datetime.fromisoformat),
+    (datetime.date, datetime.date.isoformat, datetime.date.fromisoformat),
+    (datetime.time, datetime.time.isoformat, datetime.time.fromisoformat),
+    (datetime.timedelta,
+     datetime.timedelta.total_seconds,
+     lambda s: datetime.timedelta(seconds=s)),
+    (Decimal, str, Decimal),
+    (uuid.UUID, str, uuid.UUID),
+    # orjson has no bytes type
+    (bytes, lambda b: base64.b64encode(b).decode('ascii'), base64.b64decode),
+]
+
+
+def get_column_converters(table):
+    """
+    Find converters for columns whose values are not natively serializable
+
+    :param table: (sqlalchemy.Table)
+    :return: (encoders, decoders), dicts mapping column names to functions
+    """
+    encoders = {}
+    decoders = {}
+    for column in table.columns:
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            continue
+        for typ, encoder, decoder in _converters:
+            if issubclass(python_type, typ):
+                encoders[column.name] = encoder
+                decoders[column.name] = decoder
+                break
+    return encoders, decoders
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Columnar results of queries, for analytics consumers.
+
+Rows are transposed batch by batch as they are fetched from the cursor,
+without model objects or dicts per row:
+
+- build_columns(): {name: array.array or list}; integers and floats
+  in array.array, so that numpy.frombuffer() can take them without copy
+- build_arrow_table(): a pyarrow.Table of record batches (pyarrow required)
+"""
+
+import array
+import datetime
+import itertools
+from decimal import Decimal
+
+# python_type => typecode of array.array
+# bool is left in lists; bool is a subclass of int
+_typecodes = {
+    int: 'q',
+    float: 'd',
+}
+
+
+def _get_python_type(column):
+    try:
+        return column.type.python_type
+    except NotImplementedError:
+        return
+
+
+def _make_column(column):
+    typecode = _typecodes.get(_get_python_type(column))
+    if typecode is None:
+        return []
+    return array.array(typecode)
+
+
+def _extend_column(values, batch):
+    if not isinstance(values, array.array):
+        values.extend(batch)
+        return values
+    size = len(values)
+    try:
+        values.extend(batch)
+        return values
+    except (TypeError, OverflowError):
+        # NULL or out of range, e.g. a big integer;
+        # array.extend() may have appended part of the batch
+        values = values[:size].tolist()
+    values.extend(batch)
+    return values
+
+
+def iter_batches(rows, batch_size):
+    """
+    :param rows: a sqlalchemy Result, or an iterable of rows
+    :return: an iterator of lists of rows
+    """
+    partitions = getattr(rows, 'partitions', None)
+    if partitions is not None:
+        return partitions(batch_size)
+    iterator = iter(rows)
+    return iter(lambda: list(itertools.islice(iterator, batch_size)), [])
+
+
+def build_columns(rows, columns, batch_size=10000):
+    """
+    :param rows: a sqlalchemy Result, or an iterable of rows
+    :param columns: (list) sqlalchemy columns selected
+    :param batch_size: (int) number of rows fetched and transposed at a time
+    :return: (dict) {name: array.array or list}
+    """
+    results = [_make_column(c) for c in columns]
+    for batch in iter_batches(rows, batch_size):
+        for i, values in enumerate(zip(*batch)):
+            results[i] = _extend_column(results[i], values)
+    return {c.name: v for c, v in zip(columns, results)}
+
+
+def to_numpy(columns):
+    """
+    Convert columns of build_columns() to NumPy arrays;
+    array.array columns are wrapped without copy
+
+    :param columns: (dict) {name: array.array or list}
+    :return: (dict) {name: numpy.ndarray}
+    """
+    import numpy
+    results = {}
+    for name, values in columns.items():
+        if isinstance(values, array.array):
+            results[name] = numpy.frombuffer(values, dtype=values.typecode)
+        else:
+            results[name] = numpy.asarray(values, dtype=object)
+    return results
+
+
+def _get_arrow_type(pa, column):
+    python_type = _get_python_type(column)
+    if python_type is bool:
+        return pa.bool_()
+    if python_type is int:
+        return pa.int64()
+    if python_type is float:
+        return pa.float64()
+    if python_type is str:
+        return pa.string()
+    if python_type is bytes:
+        return pa.binary()
+    # datetime.datetime must come before its base class datetime.date
+    if python_type is datetime.datetime:
+        return pa.timestamp('us')
+    if python_type is datetime.date:
+        return pa.date32()
+    if python_type is Decimal:
+        precision = getattr(column.type, 'precision', None)
+        scale = getattr(column.type, 'scale', None)
+        if precision:
+            return pa.decimal128(precision, scale or 0)
+    # inferred by pyarrow
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('pyarrow is required for arrow output')
+    return pyarrow
+
+
+def iter_record_batches(rows, columns, batch_size=10000):
+    """
+    :param rows: a sqlalchemy Result, or an iterable of rows
+    :param columns: (list) sqlalchemy columns selected
+    :return: an iterator of pyarrow.RecordBatch
+    """
+    pa = _import_pyarrow()
+    names = [c.name for c in columns]
+    types = [_get_arrow_type(pa, c) for c in columns]
+    for batch in iter_batches(rows, batch_size):
+        arrays = [
+            pa.array(values, type=typ)
+            for values, typ in zip(zip(*batch), types)
+        ]
+        yield pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+def build_arrow_table(rows, columns, batch_size=10000):
+    """
+    :return: (pyarrow.Table) of record batches of `batch_size` rows
+    """
+    pa = _import_pyarrow()
+    batches = list(iter_record_batches(rows, columns, batch_size))
+    if batches:
+        return pa.Table.from_batches(batches)
+    return pa.table({
+        c.name: pa.array([], type=_get_arrow_type(pa, c) or pa.null())
+        for c in columns
+    })
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Run a callable against several interfaces concurrently, on a bounded
+thread pool, so that the total latency is the max instead of the sum.
+
+    # {name: result}, or FanOutError if any call failed
+    rb.fan_out(lambda interf: interf.ping(), 'standby*')
+
+Modes:
+- 'all': results of all calls; FanOutError if any call failed
+- 'partial': a FanOutResult with results and errors, never raises
+- 'first': (name, result) of the first successful call;
+  FanOutError if all calls failed
+
+Calls not done `timeout` seconds after submission, including those
+still queued behind busy workers, count as failed with FanOutTimeout.
+Queued calls are cancelled, but Python threads cannot be killed:
+a running call keeps its worker until it returns.
+"""
+
+import concurrent.futures
+import time
+
+_modes = {'all', 'partial', 'first'}
+
+
+class FanOutTimeout(Exception):
+    pass
+
+
+class FanOutError(Exception):
+    def __init__(self, errors, results=None):
+        """
+        :param errors: (dict) {name: exception}
+        :param results: (dict) {name: result} of successful calls
+        """
+        self.errors = errors
+        self.results = results or {}
+        total = len(self.errors) + len(self.results)
+        details = '; '.join(
+            '{}: {!r}'.format(n, e) for n, e in sorted(errors.items()))
+        msg = '{} of {} calls failed: {}'.format(len(errors), total, details)
+        super(FanOutError, self).__init__(msg)
+
+
+class FanOutResult(object):
+    def __init__(self, results, errors):
+        """
+        :param results: (dict) {name: result} of successful calls
+        :param errors: (dict) {name: exception}
+        """
+        self.results = results
+        self.errors = errors
+
+    def __repr__(self):
+        c = self.__class__.__name__
+        return '<{} results={} errors={}>'.format(
+            c, sorted(self.results), sorted(self.errors))
+
+    def raise_for_errors(self):
+        if self.errors:
+            raise FanOutError(self.errors, self.results)
+
+
+def fan_out(executor, func, interfaces, mode='all', timeout=None):
+    """
+    :type executor: concurrent.futures.Executor
+    :param func: called with each interface
+    :param interfaces: (dict) {name: interface};
+        an exception as the value is taken as the error of the name
+    :param mode: 'all', 'partial' or 'first'
+    :param timeout: (float) seconds for all calls, since submitted
+    :return: {name: result}, a FanOutResult or (name, result), by mode
+    """
+    if mode not in _modes:
+        raise ValueError('mode must be chosen from {}'.format(_modes))
+    deadline = None
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+    results = {}
+    errors = {}
+    # future => name
+    pending = {}
+    for name, interface in interfaces.items():
+        if isinstance(interface, Exception):
+            errors[name] = interface
+            continue
+        pending[executor.submit(func, interface)] = name
+
+    while pending:
+        remaining = None
+        if deadline is not None:
+            remaining = max(0., deadline - time.monotonic())
+        done, _ = concurrent.futures.wait(
+            list(pending), remaining, concurrent.futures.FIRST_COMPLETED)
+        if not done:
+            # calls not started yet are cancelled;
+            # calls running are left to finish in their threads
+            msg = 'not done in {} seconds'.format(timeout)
+            for future, name in pending.items():
+                future.cancel()
+                errors[name] = FanOutTimeout(msg)
+            break
+        for future in done:
+            name = pending.pop(future)
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                errors[name] = e
+                continue
+            if mode == 'first':
+                for f in pending:
+                    f.cancel()
+                return name, results[name]
+
+    if mode == 'partial':
+        return FanOutResult(results, errors)
+    if mode == 'first' or errors:
+        raise FanOutError(errors, results)
+    return results
+
+
+def make_executor(max_workers):
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers, thread_name_prefix='broker-fan-out')
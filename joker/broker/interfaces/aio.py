@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Interfaces for asyncio, built from the same conf sections as
+SQLInterface and RedisInterface.
+
+Extra packages are required: an async DBAPI driver (e.g. asyncpg,
+aiosqlite) for AsyncSQLInterface and redis>=4.2 for AsyncRedisInterface.
+"""
+
+import os
+
+from joker.cast import represent
+
+from joker.broker.interfaces.sequel import _check_engine_options
+
+# backend name => default async driver
+_async_drivers = {
+    'postgresql': 'asyncpg',
+    'mysql': 'aiomysql',
+    'sqlite': 'aiosqlite',
+}
+
+
+def to_async_url(url):
+    """
+    Give a URL with an async driver if no driver is specified, e.g.
+    postgresql://127.0.0.1:5432/postgres =>
+    postgresql+asyncpg://127.0.0.1:5432/postgres
+    """
+    from sqlalchemy.engine.url import make_url
+    url = make_url(url)
+    if '+' in url.drivername:
+        return url
+    driver = _async_drivers.get(url.drivername)
+    if driver is None:
+        return url
+    return url.set(drivername='{}+{}'.format(url.drivername, driver))
+
+
+class AsyncSQLInterface(object):
+    def __init__(self, sqlalchemy_options):
+        from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+        from sqlalchemy.orm import sessionmaker
+        self.pid = os.getpid()
+        options = dict(sqlalchemy_options)
+        url = options.pop('url')
+        self.engine = create_async_engine(url, **options)
+        self.session_klass = sessionmaker(
+            bind=self.engine, class_=AsyncSession, expire_on_commit=False)
+
+    def __repr__(self):
+        return represent(self, {'url': self.engine.url})
+
+    def just_after_fork(self):
+        if self.pid == os.getpid():
+            return
+        try:
+            self.engine.sync_engine.dispose(close=False)
+        except TypeError:
+            # SQLAlchemy < 1.4.33
+            self.engine.sync_engine.dispose()
+        self.pid = os.getpid()
+
+    @classmethod
+    def from_default(cls):
+        sqlalchemy_options = {
+            'url': 'sqlite+aiosqlite:///',
+            'echo': False,
+        }
+        return cls(sqlalchemy_options)
+
+    @classmethod
+    def from_conf(cls, conf_section):
+        """
+        :param conf_section: (dict) the same as for SQLInterface;
+            an `async_url` item, if any, takes the place of `url`
+        """
+        url = conf_section.get('async_url') or conf_section.get('url')
+        sqlalchemy_options = {
+            'url': to_async_url(url),
+            'echo': bool(conf_section.get('echo', False)),
+        }
+        options = _check_engine_options(conf_section)
+        # not applicable to async engines
+        options.pop('executemany_mode', None)
+        sqlalchemy_options.update(options)
+        return cls(sqlalchemy_options)
+
+    def get_session(self):
+        """:rtype: sqlalchemy.ext.asyncio.AsyncSession"""
+        return self.session_klass()
+
+    async def execute(self, *args, **kwargs):
+        async with self.engine.connect() as conn:
+            result = await conn.execute(*args, **kwargs)
+            await conn.commit()
+            return result
+
+    async def dispose(self):
+        await self.engine.dispose()
+
+
+class AsyncRedisInterface(object):
+    """
+    A redis.asyncio client with get_many() and set_many() like those of
+    RedisInterface; other methods are of the client.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __repr__(self):
+        return represent(self, {'client': self.client})
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    @classmethod
+    def from_conf(cls, conf_section):
+        redis_options = dict(conf_section)
+        redis_options.pop('type', '')
+        redis_options.pop('near_cache', None)
+        compression = redis_options.pop('compression', None)
+        mode = redis_options.pop('mode', None)
+        if mode is not None:
+            msg = 'redis mode {!r} is not supported for asyncio'.format(mode)
+            raise ValueError(msg)
+        try:
+            from redis import asyncio
+        except ImportError:
+            msg = 'redis>=4.2 is required for asyncio; ' \
+                  'pip install joker-broker[async]'
+            raise ImportError(msg)
+        url = redis_options.pop('url', None)
+        if url is None:
+            interf = cls(asyncio.Redis(**redis_options))
+        else:
+            interf = cls(asyncio.Redis.from_url(url, **redis_options))
+        if compression is not None:
+            from joker.broker.codecs import get_compressor
+            interf.compression = get_compressor(compression)
+        return interf
+
+    def just_after_fork(self):
+        self.client.connection_pool.reset()
+
+    async def get_many(self, names):
+        pipe = self.client.pipeline(transaction=False)
+        for name in names:
+            pipe.get(name)
+        values = await pipe.execute()
+        if not values:
+            return [None for _ in names]
+        return values
+
+    async def set_many(self, kvpairs, **kwargs):
+        pipe = self.client.pipeline(transaction=False)
+        for name, value in kvpairs:
+            pipe.set(name, value, **kwargs)
+        await pipe.execute()
+
+
+async def _anoop(*_args, **_kwargs):
+    pass
+
+
+class AsyncNullRedisInterface(object):
+    """Set-n-forget cache for asyncio"""
+
+    def __repr__(self):
+        return represent(self, {})
+
+    def __getattr__(self, _):
+        return _anoop
+
+    def just_after_fork(self):
+        pass
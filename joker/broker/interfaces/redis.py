@@ -1,6 +1,13 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import bisect
+import hashlib
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
 from joker.cast import represent
 from joker.cast.syntax import noop
 from joker.interfaces.redis import RedisExtended
@@ -9,13 +16,56 @@ from joker.interfaces.redis import RedisExtended
 class RedisInterface(RedisExtended):
     @classmethod
     def from_conf(cls, conf_section):
+        """
+        :param conf_section: (dict) with `url` or kwargs of redis.Redis
+            for a single server, or with `mode` of
+
+            - 'sentinel': `sentinels`, `service_name`, `read_from_replicas`
+            - 'cluster': `url` or `startup_nodes`; redis>=4.1 required
+            - 'sharded': `urls`, sharded by consistent hashing
+
+            and optionally `compression` of cached model objects,
+            see joker.broker.codecs.get_compressor()
+        """
+        from joker.broker.codecs import get_compressor
         redis_options = dict(conf_section)
         redis_options.pop('type', '')
+        near_cache_options = redis_options.pop('near_cache', None)
+        compression = redis_options.pop('compression', None)
+        mode = redis_options.pop('mode', None)
+        if mode is None:
+            interf = cls._from_options(redis_options)
+        elif mode == 'sentinel':
+            interf = SentinelRedisInterface.from_options(redis_options, cls)
+        elif mode == 'cluster':
+            interf = ClusterRedisInterface.from_options(redis_options)
+        elif mode == 'sharded':
+            interf = ShardedRedisInterface.from_options(redis_options, cls)
+        else:
+            raise ValueError('unknown redis mode: {!r}'.format(mode))
+        if compression is not None:
+            # read by DeclBase.get_cache_compressor()
+            interf.compression = get_compressor(compression)
+        if near_cache_options:
+            return NearCache(interf, **near_cache_options)
+        return interf
+
+    @classmethod
+    def _from_options(cls, redis_options):
+        redis_options = dict(redis_options)
         url = redis_options.pop('url', None)
         if url is None:
             return cls(**redis_options)
         return cls.from_url(url, **redis_options)
 
+    def just_after_fork(self):
+        # drop (not close) sockets inherited from the parent process
+        self.connection_pool.reset()
+
+    def disconnect(self):
+        """Close all connections in the pool"""
+        self.connection_pool.disconnect()
+
 
 class NullRedisInterface:
     get = noop
@@ -41,3 +91,514 @@ class NullRedisInterface:
 
     def rekom_getsetnx(self, *_args, **kwargs):
         pass
+
+
+def _parse_address(address):
+    # 'host:port' or [host, port]
+    if isinstance(address, str):
+        host, _, port = address.rpartition(':')
+        return host, int(port)
+    host, port = address
+    return host, int(port)
+
+
+class SentinelRedisInterface(object):
+    """
+    A Redis master discovered by Sentinel; reads (get, get_many, ...)
+    go to a replica if read_from_replicas, other commands to the master.
+
+        cache:
+            type: redis
+            mode: sentinel
+            sentinels: ['10.0.0.1:26379', '10.0.0.2:26379']
+            service_name: mymaster
+            read_from_replicas: true
+            db: 0
+    """
+    read_commands = ['get', 'get_many', 'mget', 'exists', 'ttl', 'pttl']
+
+    def __init__(self, master, replica=None):
+        """
+        :param master: (RedisInterface)
+        :param replica: (RedisInterface) or None to read from master
+        """
+        self.master = master
+        self.replica = master if replica is None else replica
+
+    def __repr__(self):
+        return represent(self, {'master': self.master})
+
+    def __getattr__(self, name):
+        if name in self.read_commands:
+            return getattr(self.replica, name)
+        return getattr(self.master, name)
+
+    def get(self, name):
+        return self.replica.get(name)
+
+    def get_many(self, names):
+        return self.replica.get_many(names)
+
+    def set(self, name, value, *args, **kwargs):
+        return self.master.set(name, value, *args, **kwargs)
+
+    def set_many(self, kvpairs, **kwargs):
+        return self.master.set_many(kvpairs, **kwargs)
+
+    def delete(self, *names):
+        return self.master.delete(*names)
+
+    def disconnect(self):
+        self.master.connection_pool.disconnect()
+        self.replica.connection_pool.disconnect()
+
+    close = disconnect
+
+    @classmethod
+    def from_options(cls, redis_options, redis_class=RedisInterface):
+        from redis.sentinel import Sentinel
+        redis_options = dict(redis_options)
+        sentinels = [_parse_address(a) for a in redis_options.pop('sentinels')]
+        service_name = redis_options.pop('service_name')
+        read_from_replicas = redis_options.pop('read_from_replicas', False)
+        sentinel_kwargs = redis_options.pop('sentinel_kwargs', None)
+        sentinel = Sentinel(sentinels, sentinel_kwargs=sentinel_kwargs)
+        master = sentinel.master_for(
+            service_name, redis_class=redis_class, **redis_options)
+        if not read_from_replicas:
+            return cls(master)
+        replica = sentinel.slave_for(
+            service_name, redis_class=redis_class, **redis_options)
+        return cls(master, replica)
+
+    def just_after_fork(self):
+        self.master.just_after_fork()
+        if self.replica is not self.master:
+            self.replica.just_after_fork()
+
+
+class ClusterRedisInterface(object):
+    """
+    A redis.cluster.RedisCluster client (redis>=4.1) with get_many() and
+    set_many() like those of RedisInterface; other methods are of the client.
+
+        cache:
+            type: redis
+            mode: cluster
+            url: redis://10.0.0.1:7000/0
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __repr__(self):
+        return represent(self, {'client': self.client})
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    @classmethod
+    def from_options(cls, redis_options):
+        try:
+            from redis.cluster import RedisCluster, ClusterNode
+        except ImportError:
+            msg = 'redis>=4.1 is required for Redis Cluster; ' \
+                  'pip install joker-broker[cluster]'
+            raise ImportError(msg)
+        redis_options = dict(redis_options)
+        url = redis_options.pop('url', None)
+        if url is not None:
+            return cls(RedisCluster.from_url(url, **redis_options))
+        nodes = redis_options.pop('startup_nodes')
+        nodes = [ClusterNode(*_parse_address(a)) for a in nodes]
+        return cls(RedisCluster(startup_nodes=nodes, **redis_options))
+
+    def get(self, name):
+        return self.client.get(name)
+
+    def set(self, name, value, *args, **kwargs):
+        return self.client.set(name, value, *args, **kwargs)
+
+    def delete(self, *names):
+        return self.client.delete(*names)
+
+    def get_many(self, names):
+        # grouped by nodes and pipelined by the client
+        pipe = self.client.pipeline()
+        for name in names:
+            pipe.get(name)
+        return pipe.execute()
+
+    def set_many(self, kvpairs, **kwargs):
+        pipe = self.client.pipeline()
+        for name, value in kvpairs:
+            pipe.set(name, value, **kwargs)
+        pipe.execute()
+
+    def disconnect(self):
+        self.client.close()
+
+    close = disconnect
+
+    def just_after_fork(self):
+        # connection pools of cluster nodes reset themselves
+        # when used in a new process, see ConnectionPool._checkpid()
+        pass
+
+
+class ShardedRedisInterface(object):
+    """
+    Keys sharded across several Redis servers by consistent hashing.
+    get_many, set_many and delete are split by shard and sent
+    in parallel, a pipeline for each shard.
+
+        cache:
+            type: redis
+            mode: sharded
+            urls:
+              - redis://10.0.0.1:6379/0
+              - redis://10.0.0.2:6379/0
+
+    Commands of a single key, e.g. get and set, go to the shard of the key;
+    pubsub and publish go to the first shard.
+    """
+    # virtual nodes of each shard on the hash ring
+    virtual_nodes = 160
+    keyed_commands = [
+        'setex', 'psetex', 'setnx', 'getset',
+        'expire', 'pexpire', 'expireat', 'ttl', 'pttl', 'persist',
+        'incr', 'incrby', 'decr', 'decrby', 'type',
+        'hget', 'hset', 'hdel', 'hgetall', 'hmget', 'hincrby',
+        'lpush', 'rpush', 'lpop', 'rpop', 'lrange', 'llen',
+        'sadd', 'srem', 'smembers', 'sismember',
+        'zadd', 'zrem', 'zrange', 'zscore',
+    ]
+
+    def __init__(self, shards, names=None):
+        """
+        :param shards: (list) RedisInterface instances
+        :param names: (list) names of shards on the hash ring, e.g. URLs;
+            keep them unchanged to keep the mapping of keys
+        """
+        if not shards:
+            raise ValueError('no shards')
+        self.shards = list(shards)
+        if names is None:
+            names = [str(i) for i in range(len(shards))]
+        ring = []
+        for i, name in enumerate(names):
+            for j in range(self.virtual_nodes):
+                ring.append((self._hash('{}#{}'.format(name, j)), i))
+        ring.sort()
+        self._ring_hashes = [h for h, _ in ring]
+        self._ring_shards = [i for _, i in ring]
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return represent(self, {'shards': len(self.shards)})
+
+    @staticmethod
+    def _hash(key):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        return int.from_bytes(hashlib.md5(key).digest()[:8], 'big')
+
+    @classmethod
+    def from_options(cls, redis_options, redis_class=RedisInterface):
+        redis_options = dict(redis_options)
+        urls = redis_options.pop('urls')
+        shards = [redis_class.from_url(u, **redis_options) for u in urls]
+        return cls(shards, urls)
+
+    def get_shard_index(self, name):
+        i = bisect.bisect(self._ring_hashes, self._hash(name))
+        return self._ring_shards[i % len(self._ring_shards)]
+
+    def get_shard(self, name):
+        return self.shards[self.get_shard_index(name)]
+
+    def __getattr__(self, name):
+        if name in self.keyed_commands:
+            def _command(key, *args, **kwargs):
+                return getattr(self.get_shard(key), name)(key, *args, **kwargs)
+            return _command
+        if name in ('pubsub', 'publish'):
+            return getattr(self.shards[0], name)
+        if name == 'eval':
+            return self._eval
+        raise AttributeError(
+            '{!r} is not supported in sharded mode'.format(name))
+
+    def _eval(self, script, numkeys, *keys_and_args):
+        # on the shard of the first key; all keys should be of the shard
+        if not numkeys:
+            raise ValueError('eval without keys in sharded mode')
+        shard = self.get_shard(keys_and_args[0])
+        return shard.eval(script, numkeys, *keys_and_args)
+
+    def _group(self, items, key=lambda x: x):
+        # shard index => [(position, item), ...]
+        groups = {}
+        for pos, item in enumerate(items):
+            i = self.get_shard_index(key(item))
+            groups.setdefault(i, []).append((pos, item))
+        return groups
+
+    def _run(self, groups, func):
+        """
+        :param func: called with (shard, [item, ...]) for each group
+        :return: {shard index: result}
+        """
+        if len(groups) == 1:
+            (i, group), = groups.items()
+            return {i: func(self.shards[i], [x for _, x in group])}
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(len(self.shards))
+        futures = {
+            i: self._executor.submit(
+                func, self.shards[i], [x for _, x in group])
+            for i, group in groups.items()
+        }
+        return {i: f.result() for i, f in futures.items()}
+
+    def get(self, name):
+        return self.get_shard(name).get(name)
+
+    def set(self, name, value, *args, **kwargs):
+        return self.get_shard(name).set(name, value, *args, **kwargs)
+
+    def get_many(self, names):
+        names = list(names)
+        groups = self._group(names)
+        results = self._run(groups, lambda shard, g: shard.get_many(g))
+        values = [None] * len(names)
+        for i, group in groups.items():
+            for (pos, _), val in zip(group, results[i] or []):
+                values[pos] = val
+        return values
+
+    def set_many(self, kvpairs, **kwargs):
+        groups = self._group(kvpairs, key=lambda kv: kv[0])
+        self._run(groups, lambda shard, g: shard.set_many(g, **kwargs))
+
+    def delete(self, *names):
+        groups = self._group(names)
+        results = self._run(groups, lambda shard, g: shard.delete(*g))
+        return sum(r or 0 for r in results.values())
+
+    def disconnect(self):
+        for shard in self.shards:
+            shard.disconnect()
+
+    close = disconnect
+
+    def just_after_fork(self):
+        # threads do not survive a fork
+        self._executor = None
+        for shard in self.shards:
+            shard.just_after_fork()
+
+
+_missing = object()
+
+
+class NearCache(object):
+    """
+    A bounded LRU + TTL store in process memory, in front of a Redis.
+
+    Reads (get, get_many) are served from memory if possible, and misses
+    are remembered for negative_ttl seconds. Writes (set, set_many, delete)
+    go to Redis and invalidate memory entries, and if a channel is given,
+    those of other processes via Redis pub/sub as well.
+    Other methods, e.g. pipeline(), go to Redis directly.
+
+    In a conf file:
+
+        cache:
+            type: redis
+            url: redis://127.0.0.1:6379/0
+            near_cache:
+                maxsize: 10000
+                ttl: 5
+                negative_ttl: 1
+                channel: joker.broker.invalidation
+    """
+
+    def __init__(self, backend, maxsize=10000, ttl=5.,
+                 negative_ttl=None, channel=None):
+        """
+        :param backend: (RedisInterface)
+        :param maxsize: (int) max number of entries in memory
+        :param ttl: (float) seconds to keep an entry in memory
+        :param negative_ttl: (float) seconds to keep a miss; default to ttl
+        :param channel: (str) pub/sub channel for invalidation messages
+        """
+        self.backend = backend
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.channel = channel
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # fills (reads from Redis) in flight: token => names invalidated
+        # since the fill started, or None if all; see _store()
+        self._fills = {}
+        self._fill_tokens = itertools.count()
+        self._subscriber = None
+        if channel:
+            self._subscribe()
+
+    def __repr__(self):
+        return represent(self, {'backend': self.backend})
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _subscribe(self):
+        def _handler(message):
+            data = message.get('data')
+            if isinstance(data, bytes):
+                data = data.decode('utf-8')
+            self._invalidate(data.split('\0'))
+
+        pubsub = self.backend.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: _handler})
+        self._subscriber = pubsub.run_in_thread(sleep_time=1., daemon=True)
+
+    def _lookup(self, name, now):
+        entry = self._entries.get(name)
+        if entry is None:
+            return _missing
+        value, expire_at = entry
+        if expire_at < now:
+            del self._entries[name]
+            return _missing
+        self._entries.move_to_end(name)
+        return value
+
+    def _start_fill(self):
+        # with self._lock held
+        token = next(self._fill_tokens)
+        self._fills[token] = set()
+        return token
+
+    def _store(self, pairs, token):
+        now = time.monotonic()
+        with self._lock:
+            # names invalidated during the round trip may be stale
+            invalidated = self._fills.pop(token)
+            if invalidated is None:
+                return
+            for name, value in pairs:
+                if name in invalidated:
+                    continue
+                if value is None:
+                    if self.negative_ttl <= 0:
+                        continue
+                    expire_at = now + self.negative_ttl
+                else:
+                    expire_at = now + self.ttl
+                self._entries[name] = value, expire_at
+                self._entries.move_to_end(name)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _invalidate(self, names):
+        with self._lock:
+            for invalidated in self._fills.values():
+                if invalidated is not None:
+                    invalidated.update(names)
+            for name in names:
+                self._entries.pop(name, None)
+
+    def invalidate(self, *names):
+        self._invalidate(names)
+        if self.channel and names:
+            self.backend.publish(self.channel, '\0'.join(names))
+
+    def clear(self):
+        with self._lock:
+            for token in self._fills:
+                self._fills[token] = None
+            self._entries.clear()
+
+    def get(self, name):
+        with self._lock:
+            value = self._lookup(name, time.monotonic())
+            if value is not _missing:
+                return value
+            token = self._start_fill()
+        pairs = []
+        try:
+            value = self.backend.get(name)
+            pairs.append((name, value))
+        finally:
+            self._store(pairs, token)
+        return value
+
+    def get_many(self, names):
+        values = []
+        remainders = []
+        with self._lock:
+            now = time.monotonic()
+            for name in names:
+                value = self._lookup(name, now)
+                if value is _missing:
+                    remainders.append(name)
+                    value = None
+                values.append(value)
+            if not remainders:
+                return values
+            token = self._start_fill()
+        pairs = []
+        try:
+            fetched = self.backend.get_many(remainders) or []
+            pairs.extend(zip(remainders, fetched))
+        finally:
+            self._store(pairs, token)
+        fetched = dict(pairs)
+        return [fetched.get(n) if v is None else v
+                for n, v in zip(names, values)]
+
+    def set(self, name, value, *args, **kwargs):
+        try:
+            return self.backend.set(name, value, *args, **kwargs)
+        finally:
+            self.invalidate(name)
+
+    def set_many(self, kvpairs, **kwargs):
+        kvpairs = list(kvpairs)
+        try:
+            return self.backend.set_many(kvpairs, **kwargs)
+        finally:
+            self.invalidate(*[k for k, _ in kvpairs])
+
+    def delete(self, *names):
+        try:
+            return self.backend.delete(*names)
+        finally:
+            self.invalidate(*names)
+
+    def close(self):
+        """Stop the pub/sub thread and disconnect from Redis"""
+        if self._subscriber is not None:
+            self._subscriber.stop()
+            self._subscriber = None
+        self.clear()
+        # RedisInterface and those of other modes
+        disconnect = getattr(type(self.backend), 'disconnect', None)
+        if callable(disconnect):
+            self.backend.disconnect()
+
+    def just_after_fork(self):
+        self.clear()
+        func = getattr(self.backend, 'just_after_fork', None)
+        if callable(func):
+            func()
+        # threads do not survive a fork
+        if self.channel:
+            self._subscribe()
@@ -3,18 +3,131 @@
 
 import logging
 import os
+import threading
+import time
 import warnings
 
+import sqlalchemy.exc
+import sqlalchemy.pool
 from sqlalchemy import Table, MetaData, engine_from_config
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.exc import SAWarning
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 _logger = logging.getLogger(__name__)
 
+# engine and pool options allowed in a conf section, with their types
+_engine_option_types = {
+    'pool_size': int,
+    'max_overflow': int,
+    'pool_recycle': int,
+    'pool_timeout': (int, float),
+    'pool_pre_ping': (bool, int),
+    'pool_use_lifo': (bool, int),
+    'pool_reset_on_return': (str, type(None)),
+    'pool_logging_name': str,
+    'echo_pool': (bool, int, str),
+    'logging_name': str,
+    'hide_parameters': (bool, int),
+    'isolation_level': str,
+    'executemany_mode': str,
+    'executemany_values_page_size': int,
+    'executemany_batch_page_size': int,
+    'connect_args': dict,
+    'execution_options': dict,
+    # name of a class in sqlalchemy.pool, e.g. 'NullPool'
+    'poolclass': str,
+}
+
+
+def _check_engine_options(conf_section):
+    options = {}
+    for key, typ in _engine_option_types.items():
+        if key not in conf_section:
+            continue
+        val = conf_section[key]
+        if not isinstance(val, typ):
+            msg = 'invalid value for {}: {!r}'.format(key, val)
+            raise ValueError(msg)
+        options[key] = val
+    if 'poolclass' in options:
+        name = options['poolclass']
+        klass = getattr(sqlalchemy.pool, name, None)
+        if not (isinstance(klass, type)
+                and issubclass(klass, sqlalchemy.pool.Pool)):
+            raise ValueError('invalid poolclass: {!r}'.format(name))
+        options['poolclass'] = klass
+    return options
+
+
+class PoolStats(object):
+    """Counters of checkouts from a connection pool"""
+    # joker.broker.metrics.Histogram, set by instrument_sql_interface()
+    histogram = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        # seconds
+        self.wait_total = 0.
+        self.wait_max = 0.
+
+    def record(self, wait, timeout=False):
+        with self._lock:
+            if timeout:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        if self.histogram is not None:
+            self.histogram.observe(wait)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_total': self.wait_total,
+                'wait_max': self.wait_max,
+            }
+
+
+class _TimedPoolMixin(object):
+    # shared by pools recreated by engine.dispose()
+    stats = None
+    base_poolclass = None
+
+    def _do_get(self):
+        # time taken to get a connection, including waiting in the queue
+        t0 = time.perf_counter()
+        try:
+            conn = super(_TimedPoolMixin, self)._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            self.stats.record(time.perf_counter() - t0, timeout=True)
+            raise
+        self.stats.record(time.perf_counter() - t0)
+        return conn
+
+
+def _make_timed_poolclass(poolclass, stats):
+    name = 'Timed' + poolclass.__name__
+    attrs = {'stats': stats, 'base_poolclass': poolclass}
+    return type(name, (_TimedPoolMixin, poolclass), attrs)
+
 
 class SQLInterface(object):
     def __init__(self, sqlalchemy_options):
         self.pid = os.getpid()
+        sqlalchemy_options = dict(sqlalchemy_options)
+        poolclass = sqlalchemy_options.get('poolclass')
+        if poolclass is None:
+            url = make_url(sqlalchemy_options['url'])
+            poolclass = url.get_dialect().get_pool_class(url)
+        self.pool_stats = PoolStats()
+        sqlalchemy_options['poolclass'] = \
+            _make_timed_poolclass(poolclass, self.pool_stats)
         self.engine = engine_from_config(sqlalchemy_options, prefix='')
         if self.engine.url.get_backend_name() == 'postgresql':
             self.metadata = MetaData(bind=self.engine, schema='public')
@@ -27,9 +140,17 @@ class SQLInterface(object):
         http://docs.sqlalchemy.org/en/latest/core/pooling.html#using-\
         connection-pools-with-multiprocessing
         """
-        if self.pid != os.getpid():
+        if self.pid == os.getpid():
+            return
+        # sessions of the parent process must not be reused here
+        self.session_klass.registry.clear()
+        try:
+            # leave connections of the parent process untouched
+            self.engine.dispose(close=False)
+        except TypeError:
+            # SQLAlchemy < 1.4.33
             self.engine.dispose()
-            self.pid = os.getpid()
+        self.pid = os.getpid()
 
     @classmethod
     def from_default(cls):
@@ -43,6 +164,10 @@ class SQLInterface(object):
     def from_conf(cls, conf_section):
         """
         :param conf_section: (dict or None)
+            besides url, echo and client_encoding, engine and pool options
+            e.g. pool_size, max_overflow, pool_recycle, pool_pre_ping,
+            pool_timeout, executemany_mode, connect_args and poolclass
+            (name of a class in sqlalchemy.pool, e.g. 'NullPool')
         :return:
         """
         url = conf_section.get('url')
@@ -53,8 +178,23 @@ class SQLInterface(object):
         if not url.startswith('sqlite:'):
             sqlalchemy_options['client_encoding'] = \
                 conf_section.get('client_encoding', 'utf-8')
+        sqlalchemy_options.update(_check_engine_options(conf_section))
         return cls(sqlalchemy_options)
 
+    def get_pool_status(self):
+        """
+        :return: (dict) size, checkedin, checkedout and overflow
+            if supported by the pool class, and counters of checkouts
+        """
+        pool = self.engine.pool
+        status = {'poolclass': pool.base_poolclass.__name__}
+        for name in ['size', 'checkedin', 'checkedout', 'overflow']:
+            func = getattr(pool, name, None)
+            if callable(func):
+                status[name] = func()
+        status.update(self.pool_stats.as_dict())
+        return status
+
     @staticmethod
     def dataset_connect():
         pass
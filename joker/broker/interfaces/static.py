@@ -1,26 +1,172 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import hashlib
+import logging
+import marshal
 import os
-from collections import OrderedDict
+import pickle
+import stat
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from types import MappingProxyType
 
 import yaml
 from volkanic.utils import load_json5_file
 
+_logger = logging.getLogger(__name__)
+
+# libyaml is much faster, if available
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 
 def deserialize_conf(path):
     ext = os.path.splitext(path)[1]
     if ext.lower() in {'.yml', '.yaml'}:
-        return yaml.safe_load(open(path))
+        with open(path) as fin:
+            return yaml.load(fin, Loader=_YamlLoader)
     elif ext.lower() in ['.json', '.json5']:
         return load_json5_file(path)
     raise ValueError('unrecognizable extension: {}'.format(ext))
 
 
+# path => (stat_key, sha1, pickled data)
+_parsed_entries = {}
+_parsed_lock = threading.Lock()
+# a file modified within this many seconds may change again with
+# the same mtime and size, so its stat is not trusted
+_stat_grace = 2.
+
+# directory of parsed cache files, private to the current user;
+# None for $XDG_CACHE_HOME/joker/broker or ~/.cache/joker/broker
+parsed_cache_dir = None
+
+
+def _get_stat_key(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+def _get_cache_dir():
+    if parsed_cache_dir:
+        return parsed_cache_dir
+    root = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'joker', 'broker')
+
+
+def _get_cache_path(path):
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    return os.path.join(_get_cache_dir(), '{}.marshal'.format(digest))
+
+
+def _is_private(st, mode):
+    if st.st_uid != os.getuid():
+        return False
+    return stat.S_IMODE(st.st_mode) == mode
+
+
+def _read_cache_file(cache_path):
+    """
+    :return: (stat_key, sha1, data), or None if missing or untrusted
+    """
+    flags = os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0)
+    try:
+        if not _is_private(os.stat(os.path.dirname(cache_path)), 0o700):
+            return
+        fd = os.open(cache_path, flags)
+    except OSError:
+        return
+    with os.fdopen(fd, 'rb') as fin:
+        st = os.fstat(fin.fileno())
+        if not stat.S_ISREG(st.st_mode) or not _is_private(st, 0o600):
+            _logger.warning('ignored %s: not private to the user', cache_path)
+            return
+        try:
+            entry = marshal.load(fin)
+            return tuple(entry['stat']), entry['hash'], entry['data']
+        except Exception:
+            return
+
+
+def _write_cache_file(cache_path, stat_key, sha1, data):
+    try:
+        # data of types beyond marshal, e.g. dates of YAML, are not cached
+        content = marshal.dumps({'stat': stat_key, 'hash': sha1, 'data': data})
+    except ValueError:
+        return
+    dirpath = os.path.dirname(cache_path)
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    try:
+        os.makedirs(dirpath, 0o700, exist_ok=True)
+        # may contain secrets
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as fout:
+            fout.write(content)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        # e.g. a read-only directory
+        _logger.debug('cannot write %s: %r', cache_path, e)
+
+
+def _load_parsed_entry(path, use_disk_cache=False):
+    """
+    :return: (stat_key, sha1, pickled data)
+    """
+    from joker.broker.access import compute_hash
+    path = os.path.abspath(path)
+    stat_key = _get_stat_key(path)
+    trusted = time.time() - stat_key[0] / 1e9 > _stat_grace
+    entry = _parsed_entries.get(path)
+    if trusted and entry and entry[0] == stat_key:
+        return entry
+
+    cache_path = _get_cache_path(path)
+    cached = None
+    if use_disk_cache:
+        cached = _read_cache_file(cache_path)
+    if cached is not None and trusted and cached[0] == stat_key:
+        data = cached[2]
+        sha1 = cached[1]
+    else:
+        sha1 = compute_hash(path, 'sha1')
+        if cached is not None and cached[1] == sha1:
+            data = cached[2]
+        else:
+            data = deserialize_conf(path)
+        if use_disk_cache and trusted:
+            _write_cache_file(cache_path, stat_key, sha1, data)
+    entry = stat_key, sha1, pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    with _parsed_lock:
+        _parsed_entries[path] = entry
+    return entry
+
+
+def load_conf_file(path, use_disk_cache=False):
+    """
+    Like deserialize_conf(), but parse only once, unless modified.
+
+    Parsed data is kept in process memory and, if use_disk_cache,
+    in a marshal file under a directory private to the current user
+    (see parsed_cache_dir), which is checked with stat (mtime, size, inode)
+    and then the SHA-1 of the source. Cache files not owned by the user
+    or not of mode 0600 are ignored.
+
+    :param path: (str) path to a YAML or JSON file
+    :param use_disk_cache: (bool) read and write the cache file
+    :return: data, a fresh copy on every call
+    """
+    blob = _load_parsed_entry(path, use_disk_cache)[2]
+    return pickle.loads(blob)
+
+
 class StaticInterface(object):
     """
     A strict and immutable dict-like object
     """
+    # cache parsed extension files on disk, see load_conf_file()
+    use_parsed_cache = False
 
     def __init__(self, data=None):
         self._data = dict(data or {})
@@ -40,7 +186,7 @@ class StaticInterface(object):
 
     @classmethod
     def _load_extension_from_file(cls, path):
-        return cls._standardize(deserialize_conf(path))
+        return cls._standardize(load_conf_file(path, cls.use_parsed_cache))
 
     @classmethod
     def from_conf(cls, conf_section):
@@ -64,29 +210,144 @@ class GeneralInterface(StaticInterface):
         return self._data.get(name, *args, **kwargs)
 
 
+def _to_bytes(val):
+    if isinstance(val, bytes):
+        return val
+    return str(val).encode('utf-8')
+
+
+# computed once for each secret name
+SecretEntry = namedtuple(
+    'SecretEntry',
+    ['versions', 'active', 'active_binary', 'keys', 'binary_keys'],
+)
+
+
 class SecretInterface(StaticInterface):
+    """
+    Secret keys of each name in rotation order, i.e. the active one first.
+    The data is frozen; str and bytes forms are computed at load.
+    """
+    # never copy secrets to disk
+    use_parsed_cache = False
+    # max number of signers cached, least recently used dropped first;
+    # a salt per user or request would fill an unbounded cache
+    max_signers = 128
+
+    def __init__(self, data=None):
+        super(SecretInterface, self).__init__(data)
+        entries = {}
+        for name, versions_dict in self._data.items():
+            if not versions_dict:
+                continue
+            keys = tuple(versions_dict.values())
+            binary_keys = tuple(_to_bytes(k) for k in keys)
+            entries[name] = SecretEntry(
+                MappingProxyType(versions_dict),
+                keys[0], binary_keys[0] if keys[0] else None,
+                keys, binary_keys,
+            )
+        self._data = MappingProxyType(
+            {k: e.versions for k, e in entries.items()})
+        self._entries = entries
+        # (name, index, salt, timed, kwargs) => itsdangerous signer
+        self._signers = OrderedDict()
+        self._signers_lock = threading.Lock()
+
     def get(self, name, version=None, *args, **kwargs):
-        versions_dict = self._data.get(name)
-        if not versions_dict:
+        entry = self._entries.get(name)
+        if entry is None:
             return
         if version:
-            return versions_dict.get(version)
-        return next(iter(versions_dict.values()))
+            return entry.versions.get(version)
+        return entry.active
 
     def get_binary(self, name):
-        val = self.get(name)
-        if val:
-            return val.encode('utf-8')
+        entry = self._entries.get(name)
+        if entry is not None:
+            return entry.active_binary
 
     get_secret_key = get
 
     def get_secret_keys(self, name, binary=False):
-        versions_dict = self._data.get(name)
-        if not versions_dict:
+        """
+        :return: (tuple) keys in rotation order, the active one first
+        """
+        entry = self._entries.get(name)
+        if entry is None:
             return
         if not binary:
-            return list(versions_dict.values())
-        return [x.encode('utf-8') for x in versions_dict.values()]
+            return entry.keys
+        return entry.binary_keys
+
+    def get_entry(self, name):
+        """:rtype: SecretEntry"""
+        return self._entries.get(name)
+
+    def _get_entry_strictly(self, name):
+        try:
+            return self._entries[name]
+        except KeyError:
+            raise KeyError('secret not found: {!r}'.format(name))
+
+    def get_signer(self, name, index=0, salt=None, timed=False, **kwargs):
+        """
+        Get a cached itsdangerous signer
+
+        :param name: (str) name of the secret
+        :param index: (int) 0 for the active key, 1 for the previous one...
+        :param salt: (str or bytes) salt of the signer
+        :param timed: (bool) TimestampSigner if True, otherwise Signer
+        :param kwargs: other arguments to the signer class
+        """
+        key = name, index, salt, timed, tuple(sorted(kwargs.items()))
+        with self._signers_lock:
+            signer = self._signers.get(key)
+            if signer is not None:
+                self._signers.move_to_end(key)
+                return signer
+        import itsdangerous
+        entry = self._get_entry_strictly(name)
+        klass = itsdangerous.TimestampSigner if timed else itsdangerous.Signer
+        if salt is not None:
+            kwargs['salt'] = salt
+        signer = klass(entry.binary_keys[index], **kwargs)
+        with self._signers_lock:
+            signer = self._signers.setdefault(key, signer)
+            while len(self._signers) > self.max_signers:
+                self._signers.popitem(last=False)
+        return signer
+
+    def sign(self, name, value, salt=None, timed=False, **kwargs):
+        """Sign with the active key of the secret"""
+        signer = self.get_signer(name, 0, salt, timed, **kwargs)
+        return signer.sign(value)
+
+    def unsign(self, name, signed_value, salt=None, max_age=None, **kwargs):
+        """
+        Verify with keys of the secret in rotation order
+
+        :param max_age: (int) seconds; if given, signed_value must be
+            made by sign(..., timed=True)
+        :return: (bytes) the value
+        :raise: itsdangerous.BadSignature
+        """
+        import itsdangerous
+        timed = max_age is not None
+        error = None
+        entry = self._get_entry_strictly(name)
+        for i in range(len(entry.binary_keys)):
+            signer = self.get_signer(name, i, salt, timed, **kwargs)
+            try:
+                if timed:
+                    return signer.unsign(signed_value, max_age=max_age)
+                return signer.unsign(signed_value)
+            except itsdangerous.SignatureExpired:
+                # signed with this key, but too old
+                raise
+            except itsdangerous.BadSignature as e:
+                error = e
+        raise error
 
     @staticmethod
     def _sort_versions(versions_dict):
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+In-process metrics of the broker: counters and latency histograms,
+exportable in Prometheus text format or through callbacks.
+
+Disabled by default; enable with
+
+    from joker.broker.metrics import default_registry
+    default_registry.enabled = True
+    rb.instrument()
+"""
+
+import asyncio
+import threading
+import time
+
+# HDR-style log-linear buckets: each power of 2 is divided into
+# 2 ** (_SUB_BITS - 1) linear sub-buckets, i.e. a relative error < 1/16
+_SUB_BITS = 5
+_SUB_MASK = (1 << _SUB_BITS) - 1
+
+# upper bounds (seconds) of buckets in Prometheus exposition
+_export_bounds = (
+    .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05,
+    .1, .25, .5, 1., 2.5, 5., 10.,
+)
+
+
+def _bucket_index(v):
+    if v <= _SUB_MASK:
+        return v
+    shift = v.bit_length() - _SUB_BITS
+    return (shift << _SUB_BITS) + (v >> shift)
+
+
+def _bucket_upper_bound(index):
+    shift = index >> _SUB_BITS
+    if not shift:
+        return index
+    m = index & _SUB_MASK
+    return ((m + 1) << shift) - 1
+
+
+class Histogram(object):
+    """Latency histogram in microsecond resolution"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, seconds):
+        index = _bucket_index(max(0, int(seconds * 1e6)))
+        with self._lock:
+            self._counts[index] = self._counts.get(index, 0) + 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def _sorted_counts(self):
+        with self._lock:
+            return sorted(self._counts.items())
+
+    def percentile(self, q):
+        """
+        :param q: (float) e.g. 99 for p99
+        :return: (float) seconds, the upper bound of the bucket
+        """
+        counts = self._sorted_counts()
+        total = sum(c for _, c in counts)
+        if not total:
+            return 0.
+        rank = total * q / 100.
+        cumulated = 0
+        for index, c in counts:
+            cumulated += c
+            if cumulated >= rank:
+                return _bucket_upper_bound(index) / 1e6
+        return self.max
+
+    def get_cumulative_counts(self, bounds=_export_bounds):
+        """
+        :return: [(bound, count), ...] count of observations <= bound
+        """
+        counts = self._sorted_counts()
+        results = []
+        cumulated = 0
+        i = 0
+        for bound in bounds:
+            while i < len(counts) and \
+                    _bucket_upper_bound(counts[i][0]) / 1e6 <= bound:
+                cumulated += counts[i][1]
+                i += 1
+            results.append((bound, cumulated))
+        return results
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class Counter(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    items = []
+    for k, v in labels:
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"')
+        items.append('{}="{}"'.format(k, v))
+    return '{' + ','.join(items) + '}'
+
+
+class MetricsRegistry(object):
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        # (name, labels) => Counter or Histogram
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._callbacks = []
+
+    def _get(self, metrics, klass, name, labels):
+        key = name, tuple(sorted(labels.items()))
+        try:
+            return metrics[key]
+        except KeyError:
+            with self._lock:
+                return metrics.setdefault(key, klass())
+
+    def counter(self, name, **labels):
+        """:rtype: Counter"""
+        return self._get(self._counters, Counter, name, labels)
+
+    def histogram(self, name, **labels):
+        """:rtype: Histogram"""
+        return self._get(self._histograms, Histogram, name, labels)
+
+    def inc(self, name, amount=1, **labels):
+        if self.enabled:
+            self.counter(name, **labels).inc(amount)
+
+    def observe(self, name, seconds, **labels):
+        if self.enabled:
+            self.histogram(name, **labels).observe(seconds)
+
+    def timer(self, name, **labels):
+        """
+        with registry.timer('xxx_seconds', model='User'):
+            ...
+        """
+        return _Timer(self, name, labels)
+
+    def add_collector(self, func, key=None):
+        """
+        :param func: returns a series of (name, labels_dict, value)
+            gauges, called on export
+        :param key: a collector added with the same key is replaced
+        """
+        with self._lock:
+            collectors = self._collectors
+            if key is not None:
+                collectors = [(k, f) for k, f in collectors if k != key]
+            self._collectors = collectors + [(key, func)]
+
+    def remove_collector(self, func):
+        with self._lock:
+            self._collectors = [
+                (k, f) for k, f in self._collectors if f is not func]
+
+    def add_callback(self, func):
+        """
+        :param func: called with self.snapshot() by self.report()
+        """
+        self._callbacks.append(func)
+
+    def _collect_gauges(self):
+        gauges = []
+        for _, func in self._collectors:
+            for name, labels, value in func():
+                gauges.append((name, tuple(sorted(labels.items())), value))
+        return gauges
+
+    def snapshot(self):
+        return {
+            'counters': [
+                (n, dict(ls), c.value)
+                for (n, ls), c in list(self._counters.items())
+            ],
+            'histograms': [
+                (n, dict(ls), h.as_dict())
+                for (n, ls), h in list(self._histograms.items())
+            ],
+            'gauges': [
+                (n, dict(ls), v) for n, ls, v in self._collect_gauges()
+            ],
+        }
+
+    def report(self):
+        snapshot = self.snapshot()
+        for func in list(self._callbacks):
+            func(snapshot)
+
+    def export_prometheus(self):
+        """:return: (str) in Prometheus text exposition format"""
+        lines = []
+        # a '# TYPE' line before samples of each metric family
+        family = None
+
+        def _add_type(name, kind):
+            nonlocal family
+            if name != family:
+                family = name
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels), c in sorted(self._counters.items()):
+            _add_type(name, 'counter')
+            lines.append('{}{} {}'.format(name, _format_labels(labels), c.value))
+        for name, labels, value in sorted(self._collect_gauges()):
+            _add_type(name, 'gauge')
+            lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+        for (name, labels), h in sorted(self._histograms.items()):
+            _add_type(name, 'histogram')
+            for bound, count in h.get_cumulative_counts():
+                ls = labels + (('le', bound),)
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(ls), count))
+            ls = labels + (('le', '+Inf'),)
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(ls), h.count))
+            lines.append('{}_sum{} {}'.format(
+                name, _format_labels(labels), h.sum))
+            lines.append('{}_count{} {}'.format(
+                name, _format_labels(labels), h.count))
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer(object):
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.t0 = None
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        seconds = time.perf_counter() - self.t0
+        self.registry.observe(self.name, seconds, **self.labels)
+
+
+default_registry = MetricsRegistry()
+
+
+def instrument_sql_interface(interface, name, registry=default_registry):
+    """
+    Observe query latency and count errors with SQLAlchemy event hooks;
+    export pool status as gauges
+
+    :type interface: joker.broker.interfaces.sequel.SQLInterface
+    :param name: (str) name of the interface (conf section)
+    """
+    from sqlalchemy import event
+    engine = interface.engine
+    # AsyncEngine of AsyncSQLInterface
+    engine = getattr(engine, 'sync_engine', engine)
+    histogram = registry.histogram('broker_sql_query_seconds', interface=name)
+
+    def _before(conn, *_):
+        conn.info.setdefault('_broker_metrics_t0', []).append(
+            time.perf_counter())
+
+    def _after(conn, *_):
+        stack = conn.info.get('_broker_metrics_t0')
+        if stack and registry.enabled:
+            histogram.observe(time.perf_counter() - stack.pop())
+        elif stack:
+            stack.pop()
+
+    def _on_error(context):
+        conn = context.connection
+        stack = conn.info.get('_broker_metrics_t0') if conn else None
+        if stack:
+            stack.pop()
+        registry.inc('broker_sql_errors_total', interface=name)
+
+    hooks = [
+        (engine, 'before_cursor_execute', _before),
+        (engine, 'after_cursor_execute', _after),
+        (engine, 'handle_error', _on_error),
+    ]
+    for target, identifier, fn in hooks:
+        event.listen(target, identifier, fn)
+    # for uninstrument_interface()
+    interface._metrics_hooks = hooks
+
+    get_pool_status = getattr(interface, 'get_pool_status', None)
+    if get_pool_status is None:
+        # AsyncSQLInterface
+        return
+    interface.pool_stats.histogram = registry.histogram(
+        'broker_sql_pool_wait_seconds', interface=name)
+
+    def _collect():
+        status = get_pool_status()
+        labels = {'interface': name}
+        for key, val in status.items():
+            if isinstance(val, (int, float)):
+                yield 'broker_sql_pool_' + key, labels, val
+
+    interface._metrics_collector = _collect
+    # replacing the collector of a former interface of the same name
+    registry.add_collector(_collect, key=('broker_sql_pool', name))
+
+
+_redis_methods = ['get', 'set', 'get_many', 'set_many', 'delete']
+
+
+def instrument_redis_interface(interface, name, registry=default_registry):
+    """
+    Observe latency of get, set, get_many, set_many and delete
+    by wrapping these methods of the instance
+
+    :type interface: joker.broker.interfaces.redis.RedisInterface
+    :param name: (str) name of the interface (conf section)
+    """
+    for method in _redis_methods:
+        func = getattr(type(interface), method, None)
+        if func is None:
+            continue
+        histogram = registry.histogram(
+            'broker_redis_command_seconds', interface=name, command=method)
+        setattr(interface, method,
+                _wrap_redis_method(interface, func, histogram, registry))
+    interface._metrics_hooks = []
+
+
+def _wrap_redis_method(interface, func, histogram, registry):
+    if asyncio.iscoroutinefunction(func):
+        # AsyncRedisInterface
+        async def _awrapped(*args, **kwargs):
+            if not registry.enabled:
+                return await func(interface, *args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return await func(interface, *args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - t0)
+
+        return _awrapped
+
+    def _wrapped(*args, **kwargs):
+        if not registry.enabled:
+            return func(interface, *args, **kwargs)
+        t0 = time.perf_counter()
+        try:
+            return func(interface, *args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - t0)
+
+    return _wrapped
+
+
+def instrument_interface(interface, name, registry=default_registry):
+    """
+    Instrument a SQL or Redis interface; other interfaces are left as is
+    """
+    if '_metrics_hooks' in vars(interface):
+        return
+    if hasattr(interface, 'engine'):
+        return instrument_sql_interface(interface, name, registry)
+    if any(getattr(type(interface), m, None) for m in _redis_methods):
+        # Note: StaticInterface has get() as well
+        from joker.broker.interfaces.static import StaticInterface
+        if not isinstance(interface, StaticInterface):
+            instrument_redis_interface(interface, name, registry)
+
+
+def uninstrument_interface(interface, registry=default_registry):
+    """
+    Undo instrument_interface(), e.g. for an interface replaced by reload
+    """
+    attrs = vars(interface)
+    hooks = attrs.pop('_metrics_hooks', None)
+    if hooks is None:
+        return
+    if hooks:
+        from sqlalchemy import event
+        for target, identifier, fn in hooks:
+            event.remove(target, identifier, fn)
+    collector = attrs.pop('_metrics_collector', None)
+    if collector is not None:
+        registry.remove_collector(collector)
+    # wrappers set by instrument_redis_interface()
+    for method in _redis_methods:
+        attrs.pop(method, None)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Hot reload of a ResourceBroker: watch the conf file and extension files
+by polling their stat, and rebuild changed sections only.
+
+    rb = ResourceBroker.create(path)
+    rb.watch(interval=5.)
+"""
+
+import asyncio
+import logging
+import os
+import threading
+
+_logger = logging.getLogger(__name__)
+
+
+def get_stat_key(path):
+    """:return: (mtime_ns, size, inode), or None if not found"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+def get_section_files(section):
+    """:return: (list) paths of extension files of a conf section"""
+    try:
+        extensions = section.get('extensions')
+    except AttributeError:
+        return []
+    if not isinstance(extensions, (list, tuple)):
+        return []
+    return [os.path.abspath(p) for p in extensions]
+
+
+def stat_files(paths):
+    return {p: get_stat_key(p) for p in paths}
+
+
+def drain_interface(interface):
+    """
+    Release connections of a replaced interface. Connections checked out
+    at the moment are closed when returned, with SQLAlchemy engines.
+    """
+    engine = getattr(interface, 'engine', None)
+    if engine is not None:
+        if hasattr(engine, 'sync_engine'):
+            # AsyncEngine: pools of async drivers must be disposed
+            # in an event loop; left to garbage collection
+            return
+        engine.dispose()
+        return
+    close = getattr(type(interface), 'close', None)
+    if callable(close):
+        # e.g. NearCache, stopping its pub/sub thread
+        interface.close()
+    pool = getattr(interface, 'connection_pool', None)
+    disconnect = getattr(pool, 'disconnect', None)
+    # not for NullRedisInterface, nor AsyncRedisInterface
+    if callable(disconnect) and not asyncio.iscoroutinefunction(disconnect):
+        disconnect()
+
+
+def drain_later(interface, delay):
+    """
+    Call drain_interface() after `delay` seconds, giving requests
+    in progress time to finish with the old interface
+    """
+    if delay <= 0:
+        return drain_interface(interface)
+
+    def _drain():
+        try:
+            drain_interface(interface)
+        except Exception:
+            _logger.exception('failed to drain %r', interface)
+
+    timer = threading.Timer(delay, _drain)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+class ConfWatcher(object):
+    """Poll stat of conf and extension files; call rb.reload() on change"""
+
+    def __init__(self, rb, interval=5.):
+        """
+        :type rb: joker.broker.access.ResourceBroker
+        :param interval: (float) seconds between polls
+        """
+        self.rb = rb
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = self._stat_all()
+
+    def _get_paths(self):
+        paths = [self.rb.conf_path]
+        for section in self.rb.conf.values():
+            paths.extend(get_section_files(section))
+        return paths
+
+    def _stat_all(self):
+        return stat_files(self._get_paths())
+
+    def poll(self):
+        """:return: (bool) True if reloaded"""
+        stats = self._stat_all()
+        if stats == self._stats:
+            return False
+        try:
+            self.rb.reload()
+        finally:
+            # files of the reloaded conf, which may list new extensions;
+            # a broken file is not retried until modified again
+            self._stats = self._stat_all()
+        return True
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                _logger.exception('failed to reload %s', self.rb.conf_path)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
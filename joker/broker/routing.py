@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import functools
+import logging
+import random
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class StandbyState(object):
+    """Health of a standby (replica) SQL interface"""
+
+    def __init__(self, name, interface=None, probe_query=None, max_lag=None,
+                 factory=None):
+        """
+        :param interface: a SQLInterface, or None to be built by `factory`
+            when the standby is first chosen or probed
+        :param factory: a callable returning the SQLInterface
+        """
+        self.name = name
+        self.interface = interface
+        self.factory = factory
+        self.probe_query = probe_query
+        self.max_lag = max_lag
+        # exponentially weighted moving average, in seconds
+        self.latency = None
+        self.lag = None
+        self.failures = 0
+        self.ejected_until = 0.
+
+    def __repr__(self):
+        c = self.__class__.__name__
+        return '<{}({!r}) latency={} lag={} failures={}>'.format(
+            c, self.name, self.latency, self.lag, self.failures)
+
+    def is_healthy(self, now):
+        return self.ejected_until <= now
+
+    @property
+    def score(self):
+        # unmeasured standbys are tried first
+        return self.latency or 0.
+
+
+class StandbyRouter(object):
+    """
+    Choose a standby by health and latency.
+
+    Latency of every query is measured with SQLAlchemy event hooks, while
+    replication lag is measured by check() with the probe_query of each
+    standby conf section, which should select the lag in seconds, e.g.
+
+        SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+
+    A standby is ejected for `cooldown` seconds after `max_failures`
+    consecutive failures, or if its lag exceeds max_lag of its section.
+    """
+    # 'p2c' for power of two choices,
+    # or 'weighted' for random choice weighted by 1 / latency
+    strategy = 'p2c'
+    max_failures = 3
+    cooldown = 30.
+    # weight of the latest sample in latency EWMA
+    smoothing = .2
+
+    def __init__(self, states):
+        """
+        :param states: (list) StandbyState instances
+        """
+        self.states = list(states)
+        self._lock = threading.Lock()
+        self._probing = None
+        self._stop_probing = threading.Event()
+        self.probing_interval = None
+        # [(engine, event name, listener), ...] for close()
+        self._hooks = []
+        for state in self.states:
+            if state.interface is not None:
+                self._listen(state)
+
+    @classmethod
+    def from_broker(cls, rb):
+        """
+        :type rb: joker.broker.access.ResourceBroker
+        """
+        states = []
+        for name in rb.standby_names:
+            section = rb.conf[name]
+            # built on first pick, not all standbys at once
+            state = StandbyState(
+                name,
+                probe_query=section.get('probe_query'),
+                max_lag=section.get('max_lag'),
+                factory=functools.partial(rb.__getitem__, name),
+            )
+            states.append(state)
+        return cls(states)
+
+    def get_interface(self, state):
+        """
+        :type state: StandbyState
+        :return: the interface of `state`, built if not yet;
+            None if failed to build, and the standby is ejected
+        """
+        if state.interface is not None:
+            return state.interface
+        with self._lock:
+            if state.interface is not None:
+                return state.interface
+            try:
+                interface = state.factory()
+            except Exception as e:
+                self._eject(state, 'failed to set up: {!r}'.format(e))
+                return
+            state.interface = interface
+            self._listen(state)
+        return interface
+
+    def _listen(self, state):
+        from sqlalchemy import event
+        engine = state.interface.engine
+        # AsyncEngine of AsyncSQLInterface
+        engine = getattr(engine, 'sync_engine', engine)
+
+        def _before(conn, *_):
+            conn.info.setdefault('_standby_router_t0', []).append(
+                time.perf_counter())
+
+        def _after(conn, *_):
+            stack = conn.info.get('_standby_router_t0')
+            if stack:
+                self.report(state, time.perf_counter() - stack.pop())
+
+        def _on_error(context):
+            conn = context.connection
+            stack = conn.info.get('_standby_router_t0') if conn else None
+            if stack:
+                stack.pop()
+            if context.is_disconnect:
+                self.report(state, error=True)
+
+        hooks = [
+            (engine, 'before_cursor_execute', _before),
+            (engine, 'after_cursor_execute', _after),
+            (engine, 'handle_error', _on_error),
+        ]
+        for target, identifier, fn in hooks:
+            event.listen(target, identifier, fn)
+        self._hooks.extend(hooks)
+
+    def report(self, state, latency=None, error=False):
+        """
+        :type state: StandbyState
+        :param latency: (float) seconds
+        :param error: (bool) True for a failure
+        """
+        with self._lock:
+            if error:
+                state.failures += 1
+                if state.failures >= self.max_failures:
+                    self._eject(state, 'failures')
+                return
+            state.failures = 0
+            if latency is None:
+                return
+            if state.latency is None:
+                state.latency = latency
+            else:
+                a = self.smoothing
+                state.latency = a * latency + (1 - a) * state.latency
+
+    def _eject(self, state, reason):
+        state.ejected_until = time.monotonic() + self.cooldown
+        _logger.warning('standby %r ejected for %s seconds: %s',
+                        state.name, self.cooldown, reason)
+
+    def get_healthy_states(self):
+        now = time.monotonic()
+        return [s for s in self.states if s.is_healthy(now)]
+
+    def choose(self):
+        """
+        :return: a SQLInterface, or None if no standby is healthy
+        """
+        states = self.get_healthy_states()
+        if not states:
+            return
+        if len(states) == 1:
+            state = states[0]
+        elif self.strategy == 'weighted':
+            weights = [1. / max(s.score, 1e-4) for s in states]
+            state = random.choices(states, weights)[0]
+        else:
+            a, b = random.sample(states, 2)
+            state = a if a.score <= b.score else b
+        interface = self.get_interface(state)
+        if interface is None:
+            # ejected; try the others
+            return self.choose()
+        return interface
+
+    def probe(self, state):
+        from sqlalchemy import text
+        interface = self.get_interface(state)
+        if interface is None:
+            return
+        query = text(state.probe_query or 'SELECT 1')
+        t0 = time.perf_counter()
+        try:
+            with interface.engine.connect() as conn:
+                value = conn.execute(query).scalar()
+        except Exception as e:
+            _logger.warning('standby %r probe failed: %r', state.name, e)
+            self.report(state, error=True)
+            return
+        self.report(state, time.perf_counter() - t0)
+        if not state.probe_query:
+            return
+        state.lag = value
+        if state.max_lag is not None and value is not None \
+                and value > state.max_lag:
+            with self._lock:
+                self._eject(state, 'lag {}'.format(value))
+
+    def check(self):
+        """Probe all standbys, including ejected ones"""
+        for state in self.states:
+            self.probe(state)
+
+    def start_probing(self, interval=10.):
+        """Call check() every `interval` seconds in a daemon thread"""
+        if self._probing is not None:
+            return
+        self.probing_interval = interval
+
+        def _loop():
+            while not self._stop_probing.wait(interval):
+                try:
+                    self.check()
+                except Exception:
+                    _logger.exception('standby probing failed')
+
+        self._probing = threading.Thread(target=_loop, daemon=True)
+        self._probing.start()
+
+    def stop_probing(self):
+        self._stop_probing.set()
+
+    def close(self):
+        """Stop probing and remove event listeners from standby engines"""
+        from sqlalchemy import event
+        self.stop_probing()
+        hooks, self._hooks = self._hooks, []
+        for target, identifier, fn in hooks:
+            event.remove(target, identifier, fn)
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Sessions routing reads to standbys and writes to primary,
+with read-your-writes consistency:
+
+- after a flush, the session reads from primary until the transaction ends
+- after a commit, sessions in the same context (thread or asyncio task)
+  keep reading from primary for `sticky_window` seconds
+- `with rb.read_from_primary():` sends all reads to primary
+- `with rb.read_only():` sends all reads to standbys and forbids flushes
+- reads of a transaction go to the same standby, chosen on the first read
+
+Scoped sessions, closed deterministically instead of by garbage collection:
+
+- `with rb.session_scope() as session:` borrows the session of the current
+  thread or asyncio task; nested scopes share it, and the outermost scope
+  closes it, returning its connection to the pool
+- `rb.track_sessions(threshold)` logs sessions holding a connection
+  for longer than `threshold` seconds
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+import traceback
+import weakref
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+
+_logger = logging.getLogger(__name__)
+
+# None, 'primary' or 'readonly'
+_routing_mode = contextvars.ContextVar(
+    'joker.broker.routing_mode', default=None)
+# time.monotonic() of the latest commit with writes in this context
+_last_write = contextvars.ContextVar('joker.broker.last_write', default=0.)
+
+
+class ReadOnlyError(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def _routing_scope(mode):
+    token = _routing_mode.set(mode)
+    try:
+        yield
+    finally:
+        _routing_mode.reset(token)
+
+
+def read_from_primary():
+    """A context manager, in which all reads go to primary"""
+    return _routing_scope('primary')
+
+
+def read_only():
+    """
+    A context manager, in which all reads go to standbys, even right
+    after a write, and flushes raise ReadOnlyError
+    """
+    return _routing_scope('readonly')
+
+
+def get_routing_mode():
+    return _routing_mode.get()
+
+
+def _is_plain_select(clause):
+    if not getattr(clause, 'is_select', False):
+        return False
+    # SELECT ... FOR UPDATE
+    return getattr(clause, '_for_update_arg', None) is None
+
+
+_standby_key = 'joker.broker.standby'
+
+
+class TrackedSession(Session):
+    """A Session reporting connections it holds to a SessionTracker"""
+    tracker = None
+
+
+@event.listens_for(TrackedSession, 'after_begin')
+def _track_connection(session, *_):
+    if session.tracker is not None:
+        session.tracker.acquire(session)
+
+
+@event.listens_for(TrackedSession, 'after_transaction_end')
+def _untrack_connection(session, transaction):
+    # connections are released at the end of the root transaction
+    if session.tracker is not None and transaction.parent is None:
+        session.tracker.release(session)
+
+
+class RoutingSession(TrackedSession):
+    # set by make_session_klass()
+    broker = None
+    sticky_window = 0.
+
+    def __init__(self, *args, **kwargs):
+        super(RoutingSession, self).__init__(*args, **kwargs)
+        # flushed in the current transaction
+        self._has_writes = False
+
+    def _should_read_from_primary(self):
+        if self._has_writes:
+            return True
+        elapsed = time.monotonic() - _last_write.get()
+        return elapsed < self.sticky_window
+
+    def _get_standby_engine(self):
+        # pinned until the end of the transaction
+        engine = self.info.get(_standby_key)
+        if engine is None:
+            engine = self.info[_standby_key] = self.broker.standby.engine
+        return engine
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        rb = self.broker
+        mode = _routing_mode.get()
+        if self._flushing or not _is_plain_select(clause):
+            return rb.primary.engine
+        if mode == 'readonly':
+            return self._get_standby_engine()
+        if mode == 'primary' or self._should_read_from_primary():
+            return rb.primary.engine
+        return self._get_standby_engine()
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def _check_read_only(session, *_):
+    if _routing_mode.get() != 'readonly':
+        return
+    if session.new or session.dirty or session.deleted:
+        raise ReadOnlyError('flush in a read-only scope')
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_writes(session, _):
+    session._has_writes = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _mark_committed(session):
+    if session._has_writes:
+        _last_write.set(time.monotonic())
+    session._has_writes = False
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _mark_rolled_back(session):
+    session._has_writes = False
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def _unpin_standby(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(_standby_key, None)
+
+
+def make_session_klass(rb, sticky_window=2., tracker=None, **kwargs):
+    """
+    :type rb: joker.broker.access.ResourceBroker
+    :param sticky_window: (float) seconds to read from primary after
+        a commit with writes
+    :type tracker: SessionTracker
+    :param tracker: to find sessions holding connections for too long
+    :param kwargs: other arguments to sessionmaker()
+    :return: a sessionmaker of RoutingSession bound to rb
+    """
+    attrs = {
+        'broker': rb,
+        'sticky_window': sticky_window,
+        'tracker': tracker,
+    }
+    klass = type('RoutingSession', (RoutingSession,), attrs)
+    return sessionmaker(class_=klass, **kwargs)
+
+
+def _get_current_task():
+    try:
+        return asyncio.current_task()
+    except RuntimeError:
+        # no running event loop
+        return
+
+
+class TaskLocalRegistry(object):
+    """
+    Like ThreadLocalRegistry of SQLAlchemy, with a value per asyncio task
+    in tasks, and per thread elsewhere. Values of tasks are dropped
+    when their tasks are garbage collected.
+    """
+
+    def __init__(self, createfunc):
+        self.createfunc = createfunc
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._tasks = weakref.WeakKeyDictionary()
+
+    def __call__(self):
+        task = _get_current_task()
+        if task is None:
+            try:
+                return self._local.value
+            except AttributeError:
+                value = self._local.value = self.createfunc()
+                return value
+        with self._lock:
+            try:
+                return self._tasks[task]
+            except KeyError:
+                pass
+        value = self.createfunc()
+        with self._lock:
+            return self._tasks.setdefault(task, value)
+
+    def has(self):
+        task = _get_current_task()
+        if task is None:
+            return hasattr(self._local, 'value')
+        with self._lock:
+            return task in self._tasks
+
+    def set(self, obj):
+        task = _get_current_task()
+        if task is None:
+            self._local.value = obj
+            return
+        with self._lock:
+            self._tasks[task] = obj
+
+    def clear(self):
+        task = _get_current_task()
+        if task is None:
+            self._local.__dict__.pop('value', None)
+            return
+        with self._lock:
+            self._tasks.pop(task, None)
+
+
+class TaskScopedSession(scoped_session):
+    """A scoped_session with a session per asyncio task or thread"""
+
+    def __init__(self, session_factory):
+        super(TaskScopedSession, self).__init__(session_factory)
+        self.registry = TaskLocalRegistry(session_factory)
+
+
+_depth_key = 'joker.broker.scope_depth'
+
+
+def _enter_scope(session):
+    # AsyncSession keeps info in its sync_session
+    info = getattr(session, 'sync_session', session).info
+    depth = info.get(_depth_key, 0)
+    info[_depth_key] = depth + 1
+    return info, depth
+
+
+def _exit_scope(info, depth):
+    if depth:
+        info[_depth_key] = depth
+    else:
+        info.pop(_depth_key, None)
+
+
+@contextlib.contextmanager
+def session_scope(registry):
+    """
+    Borrow the session of the current thread or task from `registry`;
+    the outermost scope closes it and removes it from `registry`.
+    Transactions are left to the caller; uncommitted changes
+    are rolled back on closing.
+
+    :type registry: TaskScopedSession
+    """
+    session = registry()
+    info, depth = _enter_scope(session)
+    try:
+        yield session
+    finally:
+        _exit_scope(info, depth)
+        if not depth:
+            registry.remove()
+
+
+@contextlib.asynccontextmanager
+async def async_session_scope(registry):
+    """
+    session_scope() for AsyncSession
+
+    :type registry: TaskLocalRegistry
+    """
+    session = registry()
+    info, depth = _enter_scope(session)
+    try:
+        yield session
+    finally:
+        _exit_scope(info, depth)
+        if not depth:
+            registry.clear()
+            await session.close()
+
+
+class SessionTracker(object):
+    """Find sessions holding a connection for longer than a threshold"""
+
+    def __init__(self, threshold=30., capture_stack=False):
+        """
+        :param threshold: (float) seconds
+        :param capture_stack: (bool) record where connections are acquired,
+            at some cost to each transaction
+        """
+        self.threshold = threshold
+        self.capture_stack = capture_stack
+        self._lock = threading.Lock()
+        # id(session) => [weakref of session, t0, stack, reported]
+        self._held = {}
+        self._stop = None
+
+    def __len__(self):
+        return len(self._held)
+
+    def acquire(self, session):
+        key = id(session)
+        if key in self._held:
+            return
+        stack = None
+        if self.capture_stack:
+            stack = traceback.format_stack()
+        # entries of garbage collected sessions are removed
+        ref = weakref.ref(session, lambda _: self._discard(key))
+        with self._lock:
+            self._held[key] = [ref, time.monotonic(), stack, False]
+
+    def _discard(self, key):
+        with self._lock:
+            self._held.pop(key, None)
+
+    def release(self, session):
+        self._discard(id(session))
+
+    def find_leaks(self):
+        """
+        :return: [(session, seconds held, stack or None), ...]
+        """
+        now = time.monotonic()
+        leaks = []
+        with self._lock:
+            entries = list(self._held.values())
+        for ref, t0, stack, _ in entries:
+            session = ref()
+            seconds = now - t0
+            if session is not None and seconds > self.threshold:
+                leaks.append((session, seconds, stack))
+        return leaks
+
+    def check(self):
+        """
+        Log a warning for each session found by find_leaks(), once
+        :return: (int) number of sessions found
+        """
+        leaks = self.find_leaks()
+        for session, seconds, stack in leaks:
+            with self._lock:
+                entry = self._held.get(id(session))
+                if entry is None or entry[3]:
+                    continue
+                entry[3] = True
+            msg = 'session %r has held a connection for %.1f seconds'
+            if stack:
+                msg += ', acquired at\n' + ''.join(stack)
+            _logger.warning(msg, session, seconds)
+        return len(leaks)
+
+    def start(self, interval=10.):
+        """Call self.check() every `interval` seconds in a daemon thread"""
+        if self._stop is not None:
+            return
+        stop = self._stop = threading.Event()
+
+        def _loop():
+            while not stop.wait(interval):
+                try:
+                    self.check()
+                except Exception:
+                    _logger.exception('failed to check sessions')
+
+        threading.Thread(target=_loop, daemon=True).start()
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Cache stampede protection for cache-aside loads:
+
+- SingleFlight: concurrent calls with the same key in a process
+  share the result of one call
+- rebuild_with_lease(): a Redis lease so that only one worker
+  across processes rebuilds a missing value
+- should_refresh_early(): XFetch probabilistic early recomputation, see
+  Vattani et al., Optimal Probabilistic Cache Stampede Prevention, 2015
+"""
+
+import asyncio
+import math
+import os
+import random
+import threading
+import time
+
+from joker.broker import codecs
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """
+        Call func(), or wait for a running call with the same key
+
+        :return: (result, leader), where leader is False if the result
+            is shared from a call made by another thread
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, False
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result, True
+
+
+# result of a call whose leader was cancelled
+_retry = object()
+
+
+class AsyncSingleFlight(object):
+    """SingleFlight for coroutines"""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, func):
+        """
+        Await func(), or the running call with the same key
+
+        :param func: a coroutine function
+        :return: (result, leader)
+        """
+        # futures are bound to event loops
+        loop = asyncio.get_running_loop()
+        key = id(loop), key
+        while True:
+            future = self._calls.get(key)
+            if future is None:
+                break
+            # cancelling a waiter leaves the shared future alone
+            result = await asyncio.shield(future)
+            if result is not _retry:
+                return result, False
+            # the leader was cancelled; one of the waiters takes over
+        future = loop.create_future()
+        self._calls[key] = future
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            # only the leader's own await is cancelled
+            future.set_result(_retry)
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # mark retrieved, in case nobody is waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self._calls[key]
+        return result, True
+
+
+def should_refresh_early(data, beta):
+    """
+    :param data: (bytes) a cached value, made by codecs.seal_envelope()
+    :param beta: (float) > 1 favors earlier, < 1 later recomputation
+    """
+    if beta <= 0:
+        return False
+    _, delta, expire_at = codecs.open_envelope(data)
+    if delta is None:
+        return False
+    # 1 - random() is in (0, 1]
+    gap = -delta * beta * math.log(1. - random.random())
+    return time.time() + gap >= expire_at
+
+
+# delete the lease only if still held by the token
+_release_script = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def _release_lease(cache, lease_key, token):
+    evaluate = getattr(cache, 'eval', None)
+    if evaluate is None:
+        # without scripting, the lease is left to expire;
+        # a check-then-delete may delete the lease of another worker
+        return
+    evaluate(_release_script, 1, lease_key, token)
+
+
+def rebuild_with_lease(cache, key, rebuild, lease, stale=None, interval=.05):
+    """
+    :param cache: (joker.broker.interfaces.redis.RedisInterface)
+    :param key: (str) cache key of the value
+    :param rebuild: a callable returning (obj, data)
+    :param lease: (float) seconds, max time the holder may take
+    :param stale: (bytes) a stale value, returned if another worker holds
+        the lease, instead of waiting for it
+    :param interval: (float) seconds between polls while waiting
+    :return: (obj, data), obj is None if data is made by another worker
+    """
+    from joker.broker.interfaces.redis import NearCache
+    if isinstance(cache, NearCache):
+        # do not poll values remembered in process memory
+        cache = cache.backend
+    lease_key = key + ':lease'
+    token = os.urandom(8).hex()
+    if cache.set(lease_key, token, nx=True, px=int(lease * 1000)):
+        try:
+            return rebuild()
+        finally:
+            _release_lease(cache, lease_key, token)
+    if stale:
+        return None, stale
+    deadline = time.monotonic() + lease
+    while time.monotonic() < deadline:
+        # NullRedisInterface gives None
+        data, holder = cache.get_many([key, lease_key]) or (None, None)
+        if data:
+            return None, data
+        # released without a value, or not supported by the cache
+        if holder is None:
+            break
+        time.sleep(interval)
+    return rebuild()
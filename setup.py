@@ -49,6 +49,12 @@ config = {
     'namespace_packages': ["joker"],
     'zip_safe': False,
     'install_requires': readfile("requirements.txt"),
+    'extras_require': {
+        # redis.asyncio, and AsyncEngine of SQLAlchemy
+        'async': ['redis>=4.2', 'sqlalchemy[asyncio]~=1.4.21'],
+        # redis.cluster, for mode 'cluster' of redis sections
+        'cluster': ['redis>=4.1'],
+    },
     'classifiers': [
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
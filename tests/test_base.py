@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import datetime
+from decimal import Decimal
+
+from sqlalchemy import Column, Integer, String, DateTime, Date, Numeric
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from joker.broker.base import DeclBase
+
+
+class Item(DeclBase):
+    __tablename__ = 'items'
+    # this module is imported twice by test_imports.py
+    __table_args__ = {'extend_existing': True}
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50))
+    created = Column(DateTime)
+    day = Column(Date)
+    price = Column(Numeric(10, 2))
+
+
+class DictCache(dict):
+    """a dict-based stand-in of RedisInterface"""
+
+    def set(self, name, value, ex=None, **_):
+        self[name] = value
+
+    def set_many(self, kvpairs, **kwargs):
+        for name, value in kvpairs:
+            self.set(name, value, **kwargs)
+
+    def get_many(self, names):
+        return [self.get(n) for n in names]
+
+    def delete(self, *names):
+        for name in names:
+            self.pop(name, None)
+
+    def incr(self, name):
+        self[name] = int(self.get(name) or 0) + 1
+        return self[name]
+
+
+def _make_item(i=1):
+    return Item(
+        id=i,
+        name='item-{}'.format(i),
+        created=datetime.datetime(2021, 3, 4, 5, 6, 7, 89),
+        day=datetime.date(2021, 3, 4),
+        price=Decimal('12.50'),
+    )
+
+
+def test_serialize():
+    item = _make_item()
+    for fmt in ['json', 'orjson']:
+        dikt = Item.unserialize(item.serialize(fmt), asdict=True)
+        assert dikt['name'] == item.name
+        assert dikt['day'] == item.day
+        assert dikt['price'] == item.price
+        assert dikt['created'].replace(microsecond=0) \
+               == item.created.replace(microsecond=0)
+    dikt = Item.unserialize(item.serialize('orjson'), asdict=True)
+    assert dikt['created'] == item.created
+
+
+def _make_session(count):
+    engine = create_engine('sqlite:///')
+    DeclBase.metadata.create_all(bind=engine)
+    session = Session(bind=engine)
+    session.add_all([_make_item(i) for i in range(1, count + 1)])
+    session.commit()
+    return session
+
+
+def test_find():
+    session = _make_session(20)
+    assert Item.find({}, session, form='i', start=5, limit=3) == [6, 7, 8]
+    items = Item.find(Item.id > 15, session)
+    assert [o.id for o in items] == [16, 17, 18, 19, 20]
+    assert items[0].price == Decimal('12.50')
+    assert items[0].cache_key == 'Item:items:16'
+    assert '<Item(id=16)' in repr(items[0])
+
+
+def test_iter_find():
+    session = _make_session(20)
+    items = Item.iter_find(Item.id > 2, session, batch_size=4)
+    assert [o.id for o in items] == list(range(3, 21))
+    order = Item.id.desc()
+    idents = Item.iter_find({}, session, 'i', order=order, batch_size=3)
+    assert list(idents) == list(range(20, 0, -1))
+    order = Item.name, Item.id
+    after = 'item-5', 5
+    idents = Item.iter_find({}, session, 'i', order, batch_size=3, after=after)
+    assert list(idents) == [6, 7, 8, 9]
+
+
+def test_find_columnar():
+    import array
+    session = _make_session(20)
+    session.add(Item(id=21))
+    session.commit()
+    try:
+        Item.columnar_batch_size = 3
+        columns = Item.find(Item.id > 15, session, 'c')
+    finally:
+        Item.columnar_batch_size = 10000
+    assert isinstance(columns['id'], array.array)
+    assert list(columns['id']) == [16, 17, 18, 19, 20, 21]
+    assert columns['name'] == ['item-{}'.format(i) for i in range(16, 21)] \
+        + [None]
+    assert columns['price'][0] == Decimal('12.50')
+    columns = Item.find(Item.id > 30, session, 'c')
+    assert len(columns['id']) == 0 and columns['day'] == []
+
+
+def test_load_many():
+    session = _make_session(10)
+    cache = DictCache()
+    cache[Item.format_cache_key(2)] = _make_item(2).serialize()
+    items = Item.load_many([2, 3, 42, 3], session, cache)
+    assert [o and o.id for o in items] == [2, 3, None, 3]
+    assert Item.format_cache_key(3) in cache
+    assert Item.format_cache_key(42) not in cache
+    assert len(Item.load_many(range(1, 11), session)) == 10
+
+
+def test_load():
+    session = _make_session(3)
+    cache = DictCache()
+    item = Item.load(2, session, cache)
+    assert item in session
+    assert Item.format_cache_key(2) in cache
+    item = Item.load(2, session, cache)
+    assert item not in session
+    assert item.name == 'item-2'
+    assert Item.load(42, session, cache) is None
+
+
+def test_single_flight():
+    import threading
+    import time
+    from joker.broker.stampede import SingleFlight
+    flights = SingleFlight()
+    calls = []
+    results = []
+
+    def _func():
+        calls.append(1)
+        time.sleep(.1)
+        return 'x'
+
+    def _target():
+        results.append(flights.do('k', _func))
+
+    threads = [threading.Thread(target=_target) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert sorted(r[1] for r in results) == [False, False, False, True]
+
+
+def test_async_single_flight_cancelled():
+    import asyncio
+    from joker.broker.stampede import AsyncSingleFlight
+    flights = AsyncSingleFlight()
+    calls = []
+
+    async def _func():
+        calls.append(1)
+        await asyncio.sleep(.05)
+        return 'x'
+
+    async def _main():
+        leader = asyncio.ensure_future(flights.do('k', _func))
+        await asyncio.sleep(0)
+        waiters = [asyncio.ensure_future(flights.do('k', _func))
+                   for _ in range(3)]
+        await asyncio.sleep(0)
+        leader.cancel()
+        # a waiter takes over, instead of getting CancelledError
+        results = await asyncio.gather(*waiters)
+        assert sorted(r[1] for r in results) == [False, False, True]
+        assert all(r[0] == 'x' for r in results)
+        assert leader.cancelled()
+
+    asyncio.run(_main())
+    assert len(calls) == 2
+
+
+def test_rebuild_with_lease():
+    from joker.broker.stampede import rebuild_with_lease
+
+    class ScriptingCache(DictCache):
+        def set(self, name, value, nx=False, **_):
+            if nx and name in self:
+                return False
+            self[name] = value
+            return True
+
+        def eval(self, _script, _numkeys, key, token):
+            # compare-and-delete, as the Lua script does
+            if self.get(key) == token:
+                del self[key]
+                return 1
+            return 0
+
+    cache = ScriptingCache()
+
+    def _rebuild():
+        # the lease expired and was taken by another worker
+        cache['k:lease'] = 'other'
+        return 'obj', b'data'
+
+    assert rebuild_with_lease(cache, 'k', _rebuild, 1.) == ('obj', b'data')
+    assert cache['k:lease'] == 'other'
+    del cache['k:lease']
+    assert rebuild_with_lease(cache, 'k', lambda: (1, b'1'), 1.) == (1, b'1')
+    assert 'k:lease' not in cache
+
+
+def test_async_methods():
+    import asyncio
+    import pytest
+    pytest.importorskip('aiosqlite')
+    from joker.broker.interfaces.aio import AsyncSQLInterface
+
+    async def _main():
+        interf = AsyncSQLInterface.from_conf({'url': 'sqlite:///'})
+        async with interf.engine.begin() as conn:
+            await conn.run_sync(DeclBase.metadata.create_all)
+        session = interf.get_session()
+        cache = DictCache()
+        for i in range(1, 6):
+            await _make_item(i).asave(session)
+        items = await Item.afind(Item.id > 3, session)
+        assert [o.id for o in items] == [4, 5]
+        item = await Item.aload(2, session, _AsyncCache(cache))
+        assert item.name == 'item-2'
+        assert Item.format_cache_key(2) in cache
+        items = await Item.aload_many([2, 3, 9], session, _AsyncCache(cache))
+        assert [o and o.id for o in items] == [2, 3, None]
+        await session.close()
+        await interf.dispose()
+
+    asyncio.run(_main())
+
+
+class _AsyncCache(object):
+    def __init__(self, cache):
+        self.cache = cache
+
+    async def get(self, name):
+        return self.cache.get(name)
+
+    async def set(self, name, value, **kwargs):
+        self.cache.set(name, value, **kwargs)
+
+    async def get_many(self, names):
+        return self.cache.get_many(names)
+
+    async def set_many(self, kvpairs, **kwargs):
+        self.cache.set_many(kvpairs, **kwargs)
+
+
+def test_make_instance():
+    class Label(DeclBase):
+        __tablename__ = 'labels'
+        __table_args__ = {'extend_existing': True}
+        id = Column(Integer, primary_key=True)
+        name = Column(String(50))
+
+        def __init__(self, **kwargs):
+            super(Label, self).__init__(**kwargs)
+            self.title = (self.name or '').title()
+
+    data = Label(id=1, name='alice').serialize()
+    assert Label.unserialize(data).title == 'Alice'
+    try:
+        Label.skip_init = True
+        label = Label.unserialize(data)
+        assert label.name == 'alice'
+        assert not hasattr(label, 'title')
+    finally:
+        del Label.skip_init
+
+
+def test_bulk_load():
+    import pytest
+    from joker.broker.bulk import bulk_load
+    session = _make_session(0)
+    engine = session.get_bind()
+    records = ({'id': i, 'name': str(i)} for i in range(1, 26))
+    report = bulk_load(engine, Item, records, chunksize=10)
+    assert (report.rows, report.chunks) == (25, 3)
+    records = [{'id': 1, 'name': 'x'}, {'id': 30, 'name': 'y'}]
+    bulk_load(engine, Item, records, on_conflict='nothing')
+    assert Item.find(Item.id == 1, session)[0].name == '1'
+    bulk_load(engine, Item, records, on_conflict='update')
+    assert Item.find(Item.id == 1, session)[0].name == 'x'
+    assert len(Item.find({}, session, 'i')) == 26
+    # COPY is opt-in, for postgresql+psycopg2 only
+    with pytest.raises(ValueError):
+        bulk_load(engine, Item, records, method='copy')
+    from joker.broker.bulk import _copy_chunk
+    records = [{'id': 40, 'name': 'x'}, {'id': 41}]
+    with pytest.raises(ValueError):
+        _copy_chunk(None, Item.__table__, ['id', 'name'], records)
+    # all or nothing by default; the second chunk has a duplicate
+    records = [{'id': i, 'name': str(i)} for i in [50, 51, 52, 1]]
+    with pytest.raises(Exception):
+        bulk_load(engine, Item, records, chunksize=2)
+    assert Item.find(Item.id >= 50, session, 'i') == []
+    with pytest.raises(Exception):
+        bulk_load(engine, Item, records, chunksize=2, atomic=False)
+    assert Item.find(Item.id >= 50, session, 'i') == [50, 51]
+    # table versions bumped by bulk_insert only with a query cache
+    from joker.broker.base import _has_query_cache
+    assert not _has_query_cache(Item)
+    assert not _has_query_cache(Item.__table__)
+    try:
+        Item.query_cache_ttl = 60
+        assert _has_query_cache(Item)
+        assert _has_query_cache(Item.__table__)
+    finally:
+        Item.query_cache_ttl = None
+
+
+def test_save_and_cache_sync():
+    import pytest
+    from joker.broker.base import enable_cache_sync
+    session = _make_session(2)
+    cache = DictCache()
+    with pytest.raises(Exception):
+        # duplicate primary key
+        _make_item(2).save(session, cache)
+    assert not cache
+    _make_item(3).save(session, cache)
+    assert Item.format_cache_key(3) in cache
+
+    enable_cache_sync(session, cache)
+    item = Item.load(1, session)
+    item.name = 'changed'
+    session.add(_make_item(4))
+    session.flush()
+    assert Item.format_cache_key(4) not in cache
+    session.commit()
+    assert Item.unserialize(cache[Item.format_cache_key(1)]).name == 'changed'
+    assert Item.format_cache_key(4) in cache
+    session.delete(item)
+    session.add(_make_item(5))
+    session.flush()
+    session.rollback()
+    assert Item.format_cache_key(1) in cache
+    assert Item.format_cache_key(5) not in cache
+    session.delete(Item.load(1, session))
+    session.commit()
+    assert Item.format_cache_key(1) not in cache
+
+
+def test_cache_compression():
+    from joker.broker import codecs
+    item = _make_item()
+    item.name = 'x' * 2000
+    for spec in ['zlib', 'lzma', {'algorithm': 'zlib', 'threshold': 10}]:
+        data = codecs.get_compressor(spec).compress(item.serialize())
+        assert len(data) < 1000
+        assert Item.unserialize(data).name == item.name
+    # small values are not compressed
+    compressor = codecs.Compressor('zlib', threshold=1024)
+    assert compressor.compress(b'\x01{}') == b'\x01{}'
+    # with a dictionary
+    samples = [_make_item(i).serialize('orjson') for i in range(20)]
+    compressor = codecs.Compressor(
+        'zlib', threshold=0, dictionary=b''.join(samples))
+    data = compressor.compress(samples[3])
+    assert len(data) < len(samples[3]) / 2
+    assert Item.unserialize(data).name == 'item-3'
+
+    # configured by the cache interface
+    cache = DictCache()
+    cache.compression = codecs.get_compressor({'threshold': 100})
+    session = _make_session(3)
+    item = Item.load(1, session, cache)
+    item.name = 'y' * 2000
+    item.save(session, cache)
+    data = cache[Item.format_cache_key(1)]
+    assert data[:1] == b'\x21'
+    assert Item.load_many([1, 2], session, cache)[0].name == item.name
+
+
+def test_find_with_cache():
+    session = _make_session(20)
+    cache = DictCache()
+    assert Item.find({}, session, 'i', cache=cache) == list(range(1, 21))
+    assert not cache
+    try:
+        Item.query_cache_ttl = 60
+        for mode in ['rows', 'identities']:
+            Item.query_cache_mode = mode
+            session = _make_session(20)
+            cache.clear()
+            found = Item.find({}, session, 'd', start=5, limit=5, cache=cache)
+            assert [d['id'] for d in found] == [6, 7, 8, 9, 10]
+            assert found[0]['price'] == Decimal('12.50')
+            # served from cache
+            session.execute(Item.__table__.delete().where(Item.id == 6))
+            again = Item.find({}, session, 'd', start=5, limit=5, cache=cache)
+            if mode == 'rows':
+                assert again == found
+            else:
+                # objects of load_many(), cached in the legacy json
+                # format of Item, which drops microseconds
+                assert [d['id'] for d in again] == [6, 7, 8, 9, 10]
+                assert again[0]['created'] == \
+                    found[0]['created'].replace(microsecond=0)
+            objs = Item.find({}, session, start=5, limit=5, cache=cache)
+            assert objs[0].id == 6
+            assert Item.find({}, session, 'i', limit=3, cache=cache) \
+                == [1, 2, 3]
+            # invalidated by save()
+            _make_item(100).save(session, cache)
+            ids = Item.find({}, session, 'i', start=5, limit=5, cache=cache)
+            assert ids == [7, 8, 9, 10, 11]
+    finally:
+        Item.query_cache_ttl = None
+        Item.query_cache_mode = 'rows'
+
+
+def test_find_binary_with_cache():
+    from sqlalchemy import LargeBinary
+
+    class Blob(DeclBase):
+        __tablename__ = 'blobs'
+        __table_args__ = {'extend_existing': True}
+        id = Column(Integer, primary_key=True)
+        data = Column(LargeBinary)
+        query_cache_ttl = 60
+        serialization_format = 'orjson'
+
+    engine = create_engine('sqlite://')
+    DeclBase.metadata.create_all(engine, [Blob.__table__])
+    session = Session(bind=engine)
+    session.add_all([Blob(id=1, data=b'\x00\xff'), Blob(id=2)])
+    session.commit()
+    cache = DictCache()
+    expected = [{'id': 1, 'data': b'\x00\xff'}, {'id': 2, 'data': None}]
+    assert Blob.find({}, session, 'd', cache=cache) == expected
+    assert Blob.find({}, session, 'd', cache=cache) == expected
+    assert len(cache) == 1
+    blob = Blob.unserialize(Blob.load(1, session).serialize())
+    assert blob.data == b'\x00\xff'
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import json
 import os
+
+import pytest
+
 from joker.broker import ResourceBroker
+from joker.broker.access import Conf
 
 
 def get_test_dir():
@@ -16,5 +21,431 @@ def test_resource_broker():
     print(rb)
 
 
+def _dump_conf(dirpath, conf):
+    path = os.path.join(str(dirpath), 'conf.json')
+    with open(path, 'w') as fout:
+        json.dump(conf, fout)
+    return path
+
+
+def test_lazy_resource_broker(tmp_path):
+    conf = {
+        'primary': {'type': 'sql', 'url': 'sqlite:///'},
+        'standby_01': {'type': 'sql', 'url': 'sqlite:///'},
+        'general': {'alice': 1},
+    }
+    rb = ResourceBroker.create(_dump_conf(tmp_path, conf), lazy=True)
+    assert rb.interfaces == {}
+    assert rb.general.alice == 1
+    assert list(rb.interfaces) == ['general']
+    assert rb['primary'] is rb.primary
+    assert rb.standby is rb['standby_01']
+    assert len(rb.interfaces) == 3
+
+
+def test_resource_broker_registry(tmp_path):
+    conf = {'primary': {'type': 'sql', 'url': 'sqlite:///'}}
+    path = _dump_conf(tmp_path, conf)
+    rb = ResourceBroker.create(path)
+    assert ResourceBroker.create(path) is rb
+    lazy_rb = ResourceBroker.create(path, lazy=True)
+    assert lazy_rb is not rb and lazy_rb.lazy
+    assert ResourceBroker.create(path, lazy=True) is lazy_rb
+    pool = rb.primary.engine.pool
+    # pretend we are in a forked child
+    rb.primary.pid = -1
+    ResourceBroker.just_after_fork()
+    assert rb.primary.engine.pool is not pool
+    assert rb.primary.pid == os.getpid()
+
+
+def test_standby_router(tmp_path):
+    conf = {
+        'primary': {'type': 'sql', 'url': 'sqlite:///'},
+        'standby_01': {'type': 'sql', 'url': 'sqlite:///'},
+        'standby_02': {'type': 'sql', 'url': 'sqlite:///', 'max_lag': 1,
+                       'probe_query': 'SELECT 2'},
+    }
+    rb = ResourceBroker(Conf(conf))
+    router = rb.router
+    rb.standby.execute('SELECT 1')
+    router.check()
+    assert router.states[1].lag == 2
+    assert rb.standby is rb['standby_01']
+    for _ in range(router.max_failures):
+        router.report(router.states[0], error=True)
+    assert rb.standby is rb.primary
+
+
+def test_standby_router_lazy():
+    from sqlalchemy import select, literal
+    conf = {
+        'primary': {'type': 'sql', 'url': 'sqlite:///'},
+        'standby_01': {'type': 'sql', 'url': 'sqlite:///'},
+        'standby_02': {'type': 'sql', 'url': 'sqlite:///'},
+    }
+    rb = ResourceBroker(Conf(conf), lazy=True)
+    router = rb.router
+    assert rb.interfaces == {}
+    picks = []
+    choose = router.choose
+    router.choose = lambda: picks.append(choose()) or picks[-1]
+    session = rb.get_session()
+    for _ in range(3):
+        session.execute(select(literal(1)))
+    # one standby built, pinned for the transaction
+    assert len(picks) == 1
+    assert list(rb.interfaces.values()) == picks
+    session.commit()
+    session.execute(select(literal(1)))
+    assert len(picks) == 2
+    session.close()
+
+
+def test_sql_interface_pool_options():
+    from joker.broker.interfaces.sequel import SQLInterface
+    section = {'url': 'sqlite:///', 'poolclass': 'StaticPool', 'echo': 0}
+    interf = SQLInterface.from_conf(section)
+    interf.execute('SELECT 1')
+    status = interf.get_pool_status()
+    assert status['poolclass'] == 'StaticPool'
+    assert status['checkouts'] == 1
+    section['pool_pre_ping'] = 'yes'
+    with pytest.raises(ValueError):
+        SQLInterface.from_conf(section)
+
+
+def test_load_conf_file(tmp_path, monkeypatch):
+    from joker.broker.interfaces import static
+    cache_dir = str(tmp_path / 'cache')
+    monkeypatch.setattr(static, 'parsed_cache_dir', cache_dir)
+    path = str(tmp_path / 'general.yml')
+    with open(path, 'w') as fout:
+        fout.write('alice: 1\nbob: [2, 3]\n')
+    # pretend to be modified long ago, so that stat is trusted
+    os.utime(path, (1e9, 1e9))
+    data = static.load_conf_file(path)
+    assert data == {'alice': 1, 'bob': [2, 3]}
+    # opt-in
+    assert not os.path.exists(cache_dir)
+    # a fresh copy every time
+    data['bob'].append(4)
+    assert static.load_conf_file(path, True)['bob'] == [2, 3]
+    static._parsed_entries.clear()
+    assert static.load_conf_file(path, True)['bob'] == [2, 3]
+    cache_path = static._get_cache_path(path)
+    assert os.stat(cache_path).st_mode & 0o777 == 0o600
+    assert os.stat(cache_dir).st_mode & 0o777 == 0o700
+    # nothing next to the source
+    assert sorted(os.listdir(str(tmp_path))) == ['cache', 'general.yml']
+
+    # a cache file readable by others is not trusted
+    os.chmod(cache_path, 0o644)
+    assert static._read_cache_file(cache_path) is None
+    os.chmod(cache_path, 0o600)
+    assert static._read_cache_file(cache_path)[2]['alice'] == 1
+
+    # modified: the cache file is invalidated by hash
+    static._parsed_entries.clear()
+    with open(path, 'w') as fout:
+        fout.write('alice: 5\nbob: [2, 3]\n')
+    os.utime(path, (2e9, 2e9))
+    assert static.load_conf_file(path, True)['alice'] == 5
+    conf = Conf.load(path)
+    assert conf['alice'] == 5
+
+
+def test_reload(tmp_path):
+    ext_path = str(tmp_path / 'ext.json')
+    with open(ext_path, 'w') as fout:
+        json.dump({'bob': 2}, fout)
+    conf = {
+        'general': {'alice': 1, 'extensions': [ext_path]},
+        'primary': {'type': 'sql', 'url': 'sqlite://'},
+        'standby_01': {'type': 'sql', 'url': 'sqlite://'},
+    }
+    path = _dump_conf(tmp_path, conf)
+    rb = ResourceBroker.create(path)
+    rb.drain_delay = 0
+    primary = rb.primary
+    general = rb.general
+    router = rb.router
+    assert rb.reload() == set()
+    assert rb.general is general
+
+    with open(ext_path, 'w') as fout:
+        json.dump({'bob': 3}, fout)
+    conf['standby_02'] = {'type': 'sql', 'url': 'sqlite://'}
+    _dump_conf(tmp_path, conf)
+    assert rb.reload() == {'general', 'standby_02'}
+    assert rb.general.bob == 3
+    assert rb.primary is primary
+    assert rb.router is not router
+    assert len(rb.router.states) == 2
+    assert ResourceBroker.create(path) is rb
+
+    watcher = rb.watch(interval=3600)
+    assert not watcher.poll()
+    conf['general']['alice'] = 10
+    _dump_conf(tmp_path, conf)
+    assert watcher.poll()
+    assert rb.general.alice == 10
+    watcher.stop()
+
+
+def test_reload_while_probing(tmp_path):
+    # confs of the same content are shared by Conf.load
+    conf = {
+        'general': {'test': 'reload_while_probing'},
+        'primary': {'type': 'sql', 'url': 'sqlite://'},
+        'standby_01': {'type': 'sql', 'url': 'sqlite://'},
+    }
+    path = _dump_conf(tmp_path, conf)
+    rb = ResourceBroker.create(path)
+    rb.drain_delay = 0
+    rb.router.start_probing(3600)
+    del conf['standby_01']
+    conf['standby_02'] = {'type': 'sql', 'url': 'sqlite://'}
+    _dump_conf(tmp_path, conf)
+    assert rb.reload() == {'standby_01', 'standby_02'}
+    router = rb.router
+    assert router.probing_interval == 3600
+    assert [s.name for s in router.states] == ['standby_02']
+    router.check()
+    assert rb.standby is rb['standby_02']
+    router.close()
+
+
+def test_reload_without_leaking_hooks(tmp_path):
+    from joker.broker.metrics import MetricsRegistry
+    conf = {
+        'primary': {'type': 'sql', 'url': 'sqlite://'},
+        'standby_01': {'type': 'sql', 'url': 'sqlite://'},
+    }
+    path = _dump_conf(tmp_path, conf)
+    rb = ResourceBroker.create(path)
+    rb.drain_delay = 0
+    registry = MetricsRegistry(enabled=True)
+    rb.instrument(registry)
+    assert rb.standby is rb['standby_01']
+    engine = rb['standby_01'].engine
+
+    def _count():
+        listeners = list(engine.dispatch.before_cursor_execute)
+        lines = registry.export_prometheus().splitlines()
+        return len(listeners), len(lines), len(set(lines))
+
+    counts = _count()
+    for i in range(5):
+        conf['primary']['url'] = 'sqlite:///{}/p{}.db'.format(tmp_path, i)
+        _dump_conf(tmp_path, conf)
+        assert rb.reload() == {'primary'}
+        assert rb.standby is rb['standby_01']
+        assert _count() == counts
+
+
+def test_secret_interface():
+    import itsdangerous
+    from joker.broker.interfaces.static import SecretInterface
+    section = {
+        'session': 'GoY/iz5hZXxWX0yNVjTrB0!F9AK4N~',
+        'chatroom': {
+            '~active': '8wp_weVO1Ygd8qt2zr',
+            'v20170330': '18udioVzsnLT9Fu89s',
+            'v20170328': 'my-old-key',
+        },
+    }
+    si = SecretInterface.from_conf(section)
+    assert si.chatroom == '8wp_weVO1Ygd8qt2zr'
+    assert si.get('chatroom', 'v20170328') == 'my-old-key'
+    assert si.get_binary('session') == b'GoY/iz5hZXxWX0yNVjTrB0!F9AK4N~'
+    assert si.get_secret_keys('chatroom', binary=True)[-1] == b'my-old-key'
+    assert si.get_signer('chatroom') is si.get_signer('chatroom')
+    signed = si.sign('chatroom', b'alice')
+    assert si.unsign('chatroom', signed) == b'alice'
+    # signed with a previous key
+    signed = itsdangerous.Signer(b'my-old-key').sign(b'bob')
+    assert si.unsign('chatroom', signed) == b'bob'
+    with pytest.raises(itsdangerous.BadSignature):
+        si.unsign('session', signed)
+    with pytest.raises(TypeError):
+        si._data['chatroom']['x'] = 'y'
+    # bounded, e.g. with a salt per user
+    si.max_signers = 4
+    for i in range(10):
+        si.sign('session', b'alice', salt='user-{}'.format(i))
+    assert len(si._signers) == 4
+
+
+def test_routing_session(tmp_path):
+    from sqlalchemy import Column, Integer, select
+    from joker.broker.base import DeclBase
+    from joker.broker.sessions import ReadOnlyError
+
+    class Note(DeclBase):
+        __tablename__ = 'notes'
+        __table_args__ = {'extend_existing': True}
+        id = Column(Integer, primary_key=True)
+
+    conf = {
+        'primary': {'type': 'sql', 'url': 'sqlite:///{}/p.db'},
+        'standby_01': {'type': 'sql', 'url': 'sqlite:///{}/s.db'},
+    }
+    for section in conf.values():
+        section['url'] = section['url'].format(tmp_path)
+    rb = ResourceBroker(Conf(conf))
+    for interf in [rb.primary, rb['standby_01']]:
+        Note.metadata.create_all(interf.engine, [Note.__table__])
+    query = select(Note.id)
+
+    def _count():
+        return len(rb.get_session().execute(query).all())
+
+    # standby is empty, without replication
+    session = rb.get_session()
+    session.add(Note(id=1))
+    session.flush()
+    # read your own writes in a transaction
+    assert len(session.execute(query).all()) == 1
+    session.commit()
+    assert _count() == 1
+    rb.sticky_window = 0.
+    rb.session_klass = None
+    assert _count() == 0
+    with rb.read_from_primary():
+        assert _count() == 1
+        assert rb.standby is rb.primary
+    with rb.read_only():
+        session = rb.get_session()
+        assert len(session.execute(query).all()) == 0
+        session.add(Note(id=2))
+        with pytest.raises(ReadOnlyError):
+            session.flush()
+        session.rollback()
+
+
+def test_session_scope(tmp_path):
+    import threading
+    from sqlalchemy import text
+    from joker.broker.base import StandardToolkit
+
+    url = 'sqlite:///{}/p.db'.format(tmp_path)
+    rb = ResourceBroker(Conf({'primary': {'type': 'sql', 'url': url}}))
+    tracker = rb.track_sessions(threshold=0., interval=None)
+    with rb.session_scope() as session:
+        with StandardToolkit.scoped(rb) as tk:
+            assert tk.session is session
+        session.execute(text('SELECT 1'))
+        assert len(tracker) == 1
+        assert tracker.check() == 1
+        # not the session of another thread
+        others = []
+        thread = threading.Thread(
+            target=lambda: others.append(rb.scoped_session()))
+        thread.start()
+        thread.join()
+        assert others[0] is not session
+    # closed at the end of the outermost scope
+    assert len(tracker) == 0
+    assert rb.scoped_session() is not session
+    rb.scoped_session.remove()
+    with StandardToolkit(rb) as tk:
+        tk.session.execute(text('SELECT 1'))
+        assert len(tracker) == 1
+    assert len(tracker) == 0
+
+
+def test_async_session_scope(tmp_path):
+    import asyncio
+    import gc
+    pytest.importorskip('aiosqlite')
+    from sqlalchemy import text
+    from joker.broker.access import AsyncResourceBroker
+
+    url = 'sqlite:///{}/p.db'.format(tmp_path)
+    rb = AsyncResourceBroker(Conf({'primary': {'type': 'sql', 'url': url}}))
+    tracker = rb.track_sessions(threshold=0., interval=None)
+
+    async def _get_session():
+        return rb.scoped_session()
+
+    async def _main():
+        async with rb.session_scope() as session:
+            async with rb.session_scope() as inner:
+                assert inner is session
+            await session.execute(text('SELECT 1'))
+            assert len(tracker) == 1
+            # not the session of another task
+            other = await asyncio.ensure_future(_get_session())
+            assert other is not session
+        assert len(tracker) == 0
+        assert not rb.scoped_session.has()
+        await rb.primary.dispose()
+
+    asyncio.run(_main())
+    # sessions of finished tasks are dropped with the tasks
+    gc.collect()
+    assert not rb.scoped_session._tasks
+
+
+def test_fan_out():
+    import time
+    from joker.broker.fanout import FanOutError, FanOutTimeout
+
+    conf = {
+        'standby_01': {'type': 'nullredis'},
+        'standby_02': {'type': 'nullredis'},
+        'standby_03': {'type': 'nullredis'},
+        'cache': {'type': 'nullredis'},
+    }
+    rb = ResourceBroker(Conf(conf))
+    names = {id(rb[n]): n for n in conf}
+
+    def _call(interf):
+        name = names[id(interf)]
+        if name == 'standby_02':
+            raise ValueError(name)
+        if name == 'standby_03':
+            time.sleep(.5)
+        return name
+
+    results = rb.fan_out(_call, ['standby_01', 'cache'])
+    assert results == {'standby_01': 'standby_01', 'cache': 'cache'}
+    with pytest.raises(FanOutError) as info:
+        rb.fan_out(_call, 'standby*', timeout=.2)
+    assert set(info.value.errors) == {'standby_02', 'standby_03'}
+    assert isinstance(info.value.errors['standby_03'], FanOutTimeout)
+    assert info.value.results == {'standby_01': 'standby_01'}
+    t0 = time.monotonic()
+    assert rb.fan_out(_call, 'standby*', 'first') == \
+        ('standby_01', 'standby_01')
+    assert time.monotonic() - t0 < .4
+    result = rb.fan_out(_call, ['standby_02', 'missing'], 'partial')
+    assert not result.results
+    assert set(result.errors) == {'standby_02', 'missing'}
+
+
+def test_fan_out_with_busy_workers():
+    import threading
+    import time
+    from joker.broker.fanout import FanOutError, FanOutTimeout
+
+    conf = {'standby_01': {'type': 'nullredis'},
+            'standby_02': {'type': 'nullredis'}}
+    rb = ResourceBroker(Conf(conf))
+    rb.fan_out_workers = 1
+    hung = threading.Event()
+    t0 = time.monotonic()
+    with pytest.raises(FanOutError) as info:
+        rb.fan_out(lambda _: hung.wait(3), timeout=.2)
+    # the queued call times out as well, without waiting for the first
+    assert time.monotonic() - t0 < 1.
+    errors = info.value.errors
+    assert set(errors) == {'standby_01', 'standby_02'}
+    assert all(isinstance(e, FanOutTimeout) for e in errors.values())
+    hung.set()
+    assert len(rb.fan_out(lambda _: 1)) == 2
+
+
 if __name__ == '__main__':
-    test_resource_broker()
\ No newline at end of file
+    test_resource_broker()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+from sqlalchemy import text
+
+from joker.broker.interfaces.sequel import SQLInterface
+from joker.broker.metrics import MetricsRegistry, instrument_interface
+
+
+def test_histogram():
+    registry = MetricsRegistry(enabled=True)
+    for i in range(1, 1001):
+        registry.observe('latency_seconds', i / 1e4, op='x')
+    h = registry.histogram('latency_seconds', op='x')
+    assert h.count == 1000
+    # relative error of buckets is less than 1/16
+    assert abs(h.percentile(50) - .05) < .05 / 16
+    assert abs(h.percentile(99) - .099) < .099 / 16
+    registry.observe('latency_seconds', .1, op='y')
+    text_ = registry.export_prometheus()
+    assert 'latency_seconds_count{op="x"} 1000' in text_
+    assert 'latency_seconds_bucket{op="x",le="+Inf"} 1000' in text_
+    assert text_.count('# TYPE latency_seconds histogram\n') == 1
+
+
+def test_instrument_sql_interface():
+    registry = MetricsRegistry(enabled=True)
+    interf = SQLInterface.from_default()
+    instrument_interface(interf, 'primary', registry)
+    snapshots = []
+    registry.add_callback(snapshots.append)
+    with interf.engine.connect() as conn:
+        conn.execute(text('SELECT 1'))
+    h = registry.histogram('broker_sql_query_seconds', interface='primary')
+    assert h.count == 1
+    registry.report()
+    gauges = {n for n, _, _ in snapshots[0]['gauges']}
+    assert 'broker_sql_pool_checkouts' in gauges
+    registry.enabled = False
+    with interf.engine.connect() as conn:
+        conn.execute(text('SELECT 1'))
+    assert h.count == 1
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+from joker.broker.interfaces.redis import NearCache
+
+
+class CountingBackend(dict):
+    def __init__(self):
+        super(CountingBackend, self).__init__()
+        self.reads = 0
+
+    def get(self, name):
+        self.reads += 1
+        return super(CountingBackend, self).get(name)
+
+    def get_many(self, names):
+        self.reads += 1
+        return [super(CountingBackend, self).get(n) for n in names]
+
+    def set(self, name, value, **_):
+        self[name] = value
+
+    def delete(self, *names):
+        for name in names:
+            self.pop(name, None)
+
+
+def test_near_cache():
+    backend = CountingBackend()
+    nc = NearCache(backend, maxsize=2, ttl=60)
+    backend['a'] = b'1'
+    assert nc.get('a') == b'1'
+    assert nc.get('a') == b'1'
+    assert backend.reads == 1
+    # negative caching
+    assert nc.get('b') is None
+    assert nc.get('b') is None
+    assert backend.reads == 2
+    # invalidated on writes
+    nc.set('b', b'2')
+    assert nc.get_many(['a', 'b']) == [b'1', b'2']
+    assert backend.reads == 3
+    # bounded
+    nc.get('c')
+    assert len(nc._entries) == 2
+    nc.delete('a')
+    assert nc.get('a') is None
+
+
+def test_near_cache_invalidation_during_fill():
+    backend = CountingBackend()
+    nc = NearCache(backend, maxsize=10, ttl=60)
+    backend.update(a=b'1', b=b'2')
+    get_many = backend.get_many
+
+    def _get_many(names):
+        values = get_many(names)
+        # written by others during the round trip
+        nc.invalidate('b', 'x')
+        return values
+
+    backend.get_many = _get_many
+    assert nc.get_many(['a', 'b']) == [b'1', b'2']
+    # a filled; b possibly stale, not filled
+    assert list(nc._entries) == ['a']
+    assert not nc._fills
+
+
+class DictBackend(CountingBackend):
+    def set_many(self, kvpairs, **_):
+        self.update(kvpairs)
+
+    def just_after_fork(self):
+        pass
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+def test_sharded_redis_interface():
+    from joker.broker.interfaces.redis import ShardedRedisInterface
+    shards = [DictBackend() for _ in range(3)]
+    sharded = ShardedRedisInterface(shards, ['a', 'b', 'c'])
+    names = ['key:{}'.format(i) for i in range(100)]
+    sharded.set_many([(n, n.encode()) for n in names])
+    assert all(len(s) > 10 for s in shards)
+    assert sum(len(s) for s in shards) == 100
+    for n in names:
+        assert n in sharded.get_shard(n)
+    assert sharded.get_many(names + ['x']) == [n.encode() for n in names] + [None]
+    assert sharded.get('key:1') == b'key:1'
+    sharded.delete(*names[:50])
+    assert sum(len(s) for s in shards) == 50
+    # consistent: keys of other shards stay in place if one is removed
+    smaller = ShardedRedisInterface(shards[:2], ['a', 'b'])
+    for n in names:
+        if sharded.get_shard_index(n) < 2:
+            assert smaller.get_shard_index(n) == sharded.get_shard_index(n)
+    # closing a near cache over a sharded backend
+    nc = NearCache(sharded, maxsize=2, ttl=60)
+    assert nc.get('key:60') == b'key:60'
+    nc.close()
+    assert all(s.disconnected for s in shards)
+
+
+def test_sentinel_redis_interface():
+    from joker.broker.interfaces.redis import SentinelRedisInterface
+    master, replica = DictBackend(), DictBackend()
+    interf = SentinelRedisInterface(master, replica)
+    interf.set('a', b'1')
+    assert 'a' in master
+    assert interf.get('a') is None
+    assert replica.reads == 1
+    replica['a'] = b'1'
+    assert interf.get_many(['a']) == [b'1']